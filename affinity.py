@@ -0,0 +1,76 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+取込スレッドを決まったCPUコアに固定し、優先度（nice値）を変える。ローダーの affinity / nice 引数で使う。
+スレッドがコアの間を移ったり検出（推論）の処理と取り合ったりすると、フレームの間隔が揺らぐので、それを減らす。
+usage :
+    dataset = LoadT4TISCams(source, affinity='auto')            # カメラiをコア i+1 に（コア0は検出ループ用に空けておく）
+    dataset = LoadT4TISCams(source, affinity=[2, 3, 4, 5], nice=-5) # カメラごとのコアと優先度（下げる方向は管理者権限が要る）
+    pin_thread([0])                                             # 呼んだスレッド（検出ループなど）をコア0に固定する
+    python bench.py --loaders T4TIS --cams 4 --affinity none auto --intervals --load 2 # フレーム間隔の分布を比べる
+"""
+
+import os
+import sys
+import threading
+
+
+def available_cpus():
+    # このプロセスが使えるCPU番号のリスト
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_affinity(affinity, n):
+    # ローダーの affinity 引数の解釈。カメラごとのCPU番号の集合（固定しないカメラはNone）のリストを返す
+    #   None   : 固定しない
+    #   'auto' : カメラiを使えるコアの i+1 番目に（足りなければ折り返す）。1番目のコアは検出ループ用に空けておく
+    #   リスト : カメラごとにCPU番号か、CPU番号のリスト/集合（Noneならそのカメラは固定しない）
+    if affinity is None:
+        return [None] * n
+    if affinity == 'auto':
+        cpus = available_cpus()
+        if len(cpus) < 2:
+            return [None] * n # 1コアでは固定しても意味が無い
+        rest = cpus[1:]
+        return [{rest[i % len(rest)]} for i in range(n)]
+    if isinstance(affinity, str):
+        raise ValueError(f"unknown affinity: {affinity} (choose from None, 'auto' or a list per camera)")
+    plan = [None if a is None else ({a} if isinstance(a, int) else set(a)) for a in affinity]
+    return (plan + [None] * n)[:n]
+
+
+def pin_thread(cpus=None, nice=None):
+    # 呼んだスレッドをcpus（CPU番号の集合）に固定し、優先度をnice（-20～19、小さいほど優先）にする。Noneなら変えない
+    # Linuxは os.sched_setaffinity / os.setpriority をスレッドIDに対して使う。Windowsは SetThreadAffinityMask / SetThreadPriority
+    # 失敗しても止めずに警告を出してFalseを返す（権限が無い時など）
+    ok = True
+    if cpus:
+        try:
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cpus) # Linuxでは0は呼んだスレッドだけを指す
+            elif sys.platform == 'win32':
+                import ctypes
+                k32 = ctypes.windll.kernel32
+                k32.SetThreadAffinityMask.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+                if not k32.SetThreadAffinityMask(k32.GetCurrentThread(), sum(1 << c for c in cpus)):
+                    raise OSError(ctypes.get_last_error(), 'SetThreadAffinityMask failed')
+            else:
+                raise OSError('thread affinity is not supported on this platform')
+        except OSError as e:
+            print(f'WARNING: {threading.current_thread().name}: CPU affinity {sorted(cpus)} not set ({e})')
+            ok = False
+    if nice is not None:
+        try:
+            if sys.platform == 'win32': # Windowsはniceを5段階のスレッド優先度に読み替える
+                import ctypes
+                k32 = ctypes.windll.kernel32
+                prio = 2 if nice <= -10 else 1 if nice < 0 else 0 if nice == 0 else -1 if nice < 10 else -2
+                if not k32.SetThreadPriority(k32.GetCurrentThread(), prio):
+                    raise OSError(ctypes.get_last_error(), 'SetThreadPriority failed')
+            else: # Linuxのniceはスレッドごと
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except OSError as e:
+            print(f'WARNING: {threading.current_thread().name}: nice {nice} not set ({e})')
+            ok = False
+    return ok
@@ -0,0 +1,373 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+カメラ無し（疑似カメラ）でローダーの性能を測るベンチマーク。Linux CIでも動く。
+usage :
+    python bench.py
+    python bench.py --loaders T4TIS V4Streams --cams 1 2 4 --sizes 640x480 1280x960 --frames 300
+    python bench.py --replay ./recorded_dir --loaders T4Streams
+    python bench.py --replay line1.mp4 --loaders T4Streams --speed 0 --policy block # 録画を最速で全フレーム処理
+    python bench.py --loaders T4Batch --cams 4 8 16
+    python bench.py --loaders T4TIS --cams 4 --trace trace.json # ui.perfetto.dev で開く
+    python bench.py --loaders V4TIS --layout auto # letterboxの余白が少ない並べ方。real% がモデル入力のうちカメラ画像の割合
+    python bench.py --convert --sizes 640x480 1280x960 # ピクセル形式ごとのBGR変換（上下反転込み）の時間
+    python bench.py --loaders T4TIS --pixel-format BY8 # 疑似カメラをベイヤーの生画像にして測る
+    python bench.py --loaders T4TIS --tis stub --acquisition snap callback --pull-fps 25 # tisgrabberのスタブで取込み方を比べる（cpu%, age ms）
+    python bench.py --loaders T4TIS --tis stub --pull-fps 25 --rate-control skip device # 検出側の速さに合わせて取込みを減らす
+    python bench.py --loaders T4TIS --cams 4 --blackbox bb.bin --blackbox-format jpg raw # ブラックボックスに残しながら測る（fpsが落ちないこと）
+    python bench.py --loaders T4TIS --cams 4 --affinity none auto --intervals --load 2 # 負荷をかけて、コア固定の有無で取込間隔の揺らぎを比べる
+    python bench.py --loaders T4TIS --cams 4 --cam-fps-list 80 40 20 10 --compose full incremental # 変わったタイルだけ合成し直す（tiles = 1枚あたり合成したタイル数）
+    python bench.py --loaders T4TIS --cams 4 --pull-fps 25 --schedule none auto --budget 0.1 # 合成画像と1台ずつ元の解像度を切り替える
+    python bench.py --loaders T4Streams --cams 4 --net none raw jpg delta # カメラを別プロセスのキャプチャノード（netcam.py）からlocalhostで受け取る
+    python bench.py --loaders T4Streams --cams 4 --quality 0 30 5 # 取込スレッドで画質を測る（quality.py）。測る間隔ごとのfpsと、1回あたりのms・CPU
+    python bench.py --loaders T4Streams --cams 4 --policy block --temporal 1 4 8 16 --batch-cost 20 2 # K枚ずつまとめた時のframes/s（モデルの代わりに1回20ms + 1枚2ms待つ）
+    python bench.py --alloc-limit 64 # 定常状態で1枚あたり64KBより多くメモリを確保したら終了コード1（CI用）
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from threading import Thread, Event
+import numpy as np
+import cam_loader
+from cam_backends import SyntheticCapture, ReplayCapture, PixelConverter, PIXEL_FORMATS, raw_image
+from tracer import Tracer
+from scheduler import Scheduler, MODES
+from netcam import CaptureNode, ENCODINGS
+from frame_queue import POLICIES
+import tis_stub
+from blackbox import BlackBox
+
+LOADERS = {'T4TIS': cam_loader.LoadT4TISCams,
+           'V4TIS': cam_loader.LoadV4TISCams,
+           'T4Streams': cam_loader.LoadT4Streams,
+           'V4Streams': cam_loader.LoadV4Streams,
+           'T4Batch': cam_loader.LoadT4Batch,
+           }
+
+# 結果の表の列 (キー, 見出し, 寄せと幅, 書式)。列を足す時はここに1行足す
+COLUMNS = [('loader', 'loader', '<12', ''), ('cams', 'cams', '>5', ''), ('size', 'size', '>11', ''), ('fps', 'fps', '>9', '.1f'),
+           ('p50', 'p50 ms', '>9', '.2f'), ('p90', 'p90 ms', '>9', '.2f'), ('p99', 'p99 ms', '>9', '.2f'),
+           ('alloc_kb', 'alloc KB/frame', '>16', '.1f'), ('drops', 'drops', '>8', ''), ('real', 'real%', '>7', '.1f'),
+           ('cpu', 'cpu%', '>7', '.0f'), ('age', 'age ms', '>8', '.2f'), ('skipped', 'skipped', '>9', ''),
+           ('cam_fps', 'cam fps', '>9', '.1f'), ('tiles', 'tiles', '>7', '.2f')]
+TEMPORAL_COLUMNS = [('loader', 'loader', '<12', ''), ('cams', 'cams', '>5', ''), ('size', 'size', '>11', ''), ('k', 'K', '>5', ''),
+                    ('fps', 'frames/s', '>10', '.1f'), ('batches', 'batches/s', '>11', '.1f'), ('fill', 'fill ms', '>9', '.2f'),
+                    ('partial', 'partial', '>9', '')]
+
+
+def header(columns):
+    # 表の見出しの1行
+    return ''.join(f'{title:{width}}' for key, title, width, fmt in columns)
+
+
+def row(columns, r):
+    # 結果 r（dict）の1行
+    return ''.join(f'{r[key]:{width}{fmt}}' for key, title, width, fmt in columns)
+
+
+def make_backend(opt):
+    # ローダーに渡すbackend。--replay が有ればそのファイル/フォルダを全カメラで再生する
+    if opt.replay:
+        return lambda s, w, h, fps: ReplayCapture(opt.replay, w, h, opt.cam_fps, speed=opt.speed)
+    return lambda s, w, h, fps: SyntheticCapture(s, w, h, cam_fps(opt, s), opt.jitter, opt.dropout, seed=s, pixel_format=opt.pixel_format)
+
+
+def cam_fps(opt, source):
+    # 疑似カメラ source（'cam{i}'）のFPS。--cam-fps-list が有ればカメラごとにその値を順に使う
+    if opt.cam_fps_list:
+        return opt.cam_fps_list[int(source[3:]) % len(opt.cam_fps_list)]
+    return opt.cam_fps
+
+
+def pull(dataset):
+    # 1枚取り出す。疑似カメラより速く回すとTISローダーの画像停止検出(cnt)に引っかかるので、測定中は毎回戻しておく
+    dataset.cnt = 0
+    return next(dataset)
+
+
+def alloc_per_frame(dataset, frames, fps):
+    # 1枚ごとの、取り出しと取込スレッドが確保したメモリの最大（バイト）。tracemalloc は全てのスレッドの確保を数えるので、
+    # 取り出した後にカメラの1フレーム分（1/fps 秒）待って、その間の取込スレッドの grab / retrieve / 受け渡しも同じ区間に入れる
+    tracemalloc.start()
+    peaks = np.zeros(frames)
+    try:
+        for k in range(frames):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            pull(dataset)
+            if fps:
+                time.sleep(1 / fps)
+            peaks[k] = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def stop(dataset):
+    # 取込スレッドを止めて終了を待ち、カメラを開放する
+    dataset.close()
+
+
+def frame_age(dataset, n_cams):
+    # tis_stub のRGB24画像は最後の行の先頭8バイトに作られた時刻が入っているので、今までの経過時間(ms)をカメラごとに返す
+    now = time.perf_counter_ns()
+    return [(now - int(dataset.imgs[i][-1].reshape(-1)[:8].view(np.int64)[0])) / 1e6 for i in range(n_cams)]
+
+
+def intervals(tracer, t_start, n_cams):
+    # tracerに記録された t_start 以降の 'snap' の終わりの時刻から、カメラごとの取込間隔(ms)を全カメラ分まとめて返す
+    ends = [[] for _ in range(n_cams)]
+    for name, tid, t0, dur, cam in list(tracer.events):
+        if name == 'snap' and t0 >= t_start and 0 <= cam < n_cams:
+            ends[cam].append(t0 + dur)
+    return np.concatenate([np.diff(np.sort(e)) / 1e6 for e in ends if len(e) > 1] or [np.zeros(0)])
+
+
+def cpu_load(n, stop_event):
+    # 検出（推論）の代わりに、GILを離す行列積で n 本のスレッドがCPUを使い続ける
+    def work():
+        a = np.random.rand(256, 256)
+        while not stop_event.is_set():
+            a @ a
+    threads = [Thread(target=work, name=f'load{k}', daemon=True) for k in range(n)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def run_one(loader, n_cams, size, opt, tracer=None, acquisition='snap', rate_control=None, blackbox=None, affinity=None, compose='full', schedule=None, net=None, quality=None):
+    # 1条件分を測定して結果の辞書を返す
+    # 疑似カメラ名をsourcesファイルに書いてローダーに渡す
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(f'cam{i}' for i in range(n_cams)))
+    node = node_ds = None
+    if net: # 疑似カメラはキャプチャノード（LoadT4Batch + netcam.CaptureNode）で取り込み、測るローダーは localhost から受け取る
+        node_ds = LOADERS['T4Batch'](f.name, preview=False, size=size, backend=make_backend(opt))
+        node = CaptureNode(node_ds, port=0, encoding=net)
+        with open(f.name, 'w') as nf:
+            nf.write('\n'.join(f'tcp://127.0.0.1:{node.port}/{i}' for i in range(n_cams)))
+    if opt.intervals and tracer is None: # 取込間隔は 'snap' の記録から測る
+        tracer = Tracer()
+    kw = {} if loader == 'T4Batch' else {'layout': opt.layout} # T4Batchはタイルの大きさで決まる
+    if schedule and loader != 'T4Batch':
+        kw.update(schedule=Scheduler(schedule, opt.budget, opt.priority))
+    stub = opt.tis == 'stub' and loader in ('T4TIS', 'V4TIS') and not net
+    if net:
+        kw.update(backend='remote')
+    elif stub: # tisgrabberのスタブで実際のTISの取込み処理を通す
+        kw.update(backend=None, tis_lib=tis_stub.load(fps=opt.cam_fps), acquisition=acquisition, pixel_format=opt.pixel_format)
+    else:
+        kw.update(backend=make_backend(opt))
+    box = None
+    if blackbox: # rawは1枚がそのままスロットに入る大きさにする
+        slot_kb = size[0] * size[1] * 3 / 1024 if blackbox == 'raw' else 256
+        box = BlackBox(opt.blackbox, opt.blackbox_mb, slot_kb, fmt=blackbox, fps=opt.blackbox_fps)
+    dataset = LOADERS[loader](f.name, preview=False, tracer=tracer, size=size, policy=opt.policy, depth=opt.depth,
+                              rate_control=rate_control, blackbox=box, affinity=affinity, nice=opt.nice,
+                              incremental=compose == 'incremental', quality=quality, **kw)
+    try:
+        iter(dataset)
+        time.sleep(opt.warmup) # 最初の画像が揃うまで待つ
+        for _ in range(10):
+            pull(dataset)
+
+        # 速度と1枚あたりの処理時間、プロセス全体のCPU使用率
+        t_start = time.perf_counter_ns()
+        lat = np.zeros(opt.frames)
+        ages = []
+        t0, c0 = time.perf_counter(), time.process_time()
+        for k in range(opt.frames):
+            t = time.perf_counter()
+            pull(dataset)
+            lat[k] = time.perf_counter() - t
+            if stub and opt.pixel_format == 'RGB24':
+                ages += frame_age(dataset, n_cams)
+            if opt.pull_fps: # 検出側の速さを真似る
+                wait = t0 + (k + 1) / opt.pull_fps - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+        elapsed = time.perf_counter() - t0
+        cpu = (time.process_time() - c0) / elapsed * 100
+
+        # 1枚あたりのメモリ確保量（tracemallocは遅いので別に測る）
+        peaks = alloc_per_frame(dataset, opt.alloc_frames, max(cam_fps(opt, f'cam{i}') for i in range(n_cams)))
+        gaps = intervals(dataset.tracer, t_start, n_cams) if opt.intervals else None
+        latency = dataset.latency() # 止めるとカメラが無くなるので先に
+    finally:
+        stop(dataset)
+        os.unlink(f.name)
+        if box is not None:
+            box.close()
+        if node is not None:
+            node.close()
+            node_ds.close()
+    p50, p90, p99 = np.percentile(lat, [50, 90, 99]) * 1000
+    n_pulls = 10 + opt.frames + opt.alloc_frames
+    drops = sum(dataset.drops)
+    skipped = sum(dataset.rate.skipped) if dataset.rate is not None else 0
+    # 表の loader 欄に、既定から変えた条件を (条件, 付ける文字) の順に付ける
+    labels = [(stub and acquisition == 'callback', '/cb'), (rate_control == 'skip', '/s'), (rate_control == 'device', '/d'),
+              (blackbox, f'/{blackbox}'), (affinity, '/a'), (compose == 'incremental', '/i'),
+              (kw.get('schedule'), f"/{getattr(dataset.schedule, 'plan', '')}"), (net, f'/net:{net}'), (quality, f'/q{quality}')]
+    name = loader + ''.join(label for flag, label in labels if flag)
+    return {'loader': name, 'cams': n_cams, 'size': f'{size[0]}x{size[1]}', 'skipped': skipped,
+            'cam_fps': dataset.rate.target if dataset.rate is not None else float('nan'),
+            'cpu': cpu, 'age': float(np.median(ages)) if ages else float('nan'),
+            'fps': opt.frames / elapsed, 'p50': p50, 'p90': p90, 'p99': p99,
+            'alloc_kb': float(np.median(peaks)) / 1024, 'drops': drops,
+            'real': dataset.plan.fill * 100 if hasattr(dataset, 'plan') else float('nan'),
+            'box': box, 'gaps': gaps, 'tiles': dataset.redrawn / n_pulls, 'node': node, 'elapsed': elapsed, 'latency': latency, 'quality': dataset.quality}
+
+
+def run_temporal(opt):
+    # K 枚ずつまとめて取り出した時の frames/s（temporal.TemporalBatcher）。--batch-cost A B でモデルの代わりに1バッチごとに A + B*K ms 待つ（GILを離すので取込は続く）
+    print(header(TEMPORAL_COLUMNS))
+    a, b = opt.batch_cost
+    for loader in opt.loaders:
+        for size in opt.sizes:
+            w, h = (int(x) for x in size.split('x'))
+            for n_cams in opt.cams:
+                for k in opt.temporal:
+                    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+                        f.write('\n'.join(f'cam{i}' for i in range(n_cams)))
+                    kw = {} if loader == 'T4Batch' else {'layout': opt.layout}
+                    dataset = LOADERS[loader](f.name, preview=False, size=(w, h), policy=opt.policy, depth=opt.depth, backend=make_backend(opt), **kw)
+                    try:
+                        batches = dataset.temporal(k, opt.flush, letterbox=True, composed=True, pull=pull)
+                        time.sleep(opt.warmup)
+                        next(batches)
+                        frames = fill = 0
+                        n0, p0 = batches.nout, batches.partial
+                        t0 = time.perf_counter()
+                        while frames < opt.frames:
+                            t = time.perf_counter()
+                            imgs = next(batches)[2]
+                            fill += time.perf_counter() - t
+                            frames += len(imgs)
+                            if a or b: # モデルの代わり
+                                time.sleep((a + b * len(imgs)) / 1000)
+                        elapsed = time.perf_counter() - t0
+                        nb = batches.nout - n0
+                    finally:
+                        stop(dataset)
+                        os.unlink(f.name)
+                    print(row(TEMPORAL_COLUMNS, {'loader': loader, 'cams': n_cams, 'size': size, 'k': k, 'fps': frames / elapsed,
+                                                 'batches': nb / elapsed, 'fill': fill * 1000 / nb, 'partial': batches.partial - p0}))
+
+
+def run_convert(opt):
+    # ピクセル形式ごとに、生画像からBGRへの変換（TISと同じく上下反転込み）にかかる時間と、カメラ1台分のUSB帯域を表示する
+    print(f"{'format':<8}{'size':>11}{'ms/frame':>10}{'MB/s @' + str(int(opt.cam_fps)) + 'fps':>14}")
+    for size in opt.sizes:
+        w, h = (int(x) for x in size.split('x'))
+        bgr = SyntheticCapture(0, w, h, 0).patterns[0]
+        for fmt, bpp in PIXEL_FORMATS.items():
+            raw = raw_image(bgr, fmt)
+            convert = PixelConverter(fmt, flip=True)
+            dst = np.empty((h, w, 3), dtype=np.uint8)
+            for _ in range(10):
+                convert(raw, dst)
+            t = time.perf_counter()
+            for _ in range(opt.frames):
+                convert(raw, dst)
+            ms = (time.perf_counter() - t) / opt.frames * 1000
+            print(f"{fmt:<8}{size:>11}{ms:>10.3f}{w * h * bpp * opt.cam_fps / 1e6:>14.1f}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loaders', nargs='+', default=list(LOADERS), choices=list(LOADERS), help='measured loaders')
+    parser.add_argument('--cams', nargs='+', type=int, default=[1, 2, 4], help='camera counts')
+    parser.add_argument('--sizes', nargs='+', default=['640x480', '1280x960'], help='camera resolutions WxH')
+    parser.add_argument('--frames', type=int, default=200, help='timed frames per case')
+    parser.add_argument('--alloc-frames', type=int, default=20, help='frames measured with tracemalloc per case (capture threads included)')
+    parser.add_argument('--cam-fps', type=float, default=80, help='synthetic camera FPS, 0 = unthrottled')
+    parser.add_argument('--cam-fps-list', nargs='+', type=float, default=[], help='per-camera synthetic FPS (cycled), overrides --cam-fps')
+    parser.add_argument('--compose', nargs='+', default=['full'], choices=['full', 'incremental'], help='compose all tiles or only changed ones')
+    parser.add_argument('--jitter', type=float, default=0.0, help='synthetic frame interval jitter (seconds, stddev)')
+    parser.add_argument('--dropout', type=float, default=0.0, help='synthetic dropped frame ratio')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed, 1 = real time, 0 = as fast as possible')
+    parser.add_argument('--policy', type=str, default='latest', choices=POLICIES, help='capture to consumer hand-off policy')
+    parser.add_argument('--depth', type=int, default=4, help='FIFO depth for drop_oldest/drop_newest/block')
+    parser.add_argument('--replay', type=str, default='', help='replay this video file/image dir instead of synthetic cams')
+    parser.add_argument('--trace', type=str, default='', help='write a Chrome trace (Perfetto) JSON of all cases to this file')
+    parser.add_argument('--layout', type=str, default='fixed', choices=['fixed', 'auto'], help='mosaic layout of the 4-camera loaders')
+    parser.add_argument('--pixel-format', type=str, default='RGB24', choices=list(PIXEL_FORMATS), help='synthetic camera pixel format')
+    parser.add_argument('--convert', action='store_true', help='only measure raw -> BGR conversion cost per pixel format')
+    parser.add_argument('--tis', type=str, default='synthetic', choices=['synthetic', 'stub'], help='TIS loaders: synthetic backend or tisgrabber stub (tis_stub.py)')
+    parser.add_argument('--acquisition', nargs='+', default=['snap'], choices=['snap', 'callback'], help='TIS acquisition modes with --tis stub')
+    parser.add_argument('--pull-fps', type=float, default=0, help='consumer pull rate (emulates the detector), 0 = as fast as possible')
+    parser.add_argument('--rate-control', nargs='+', default=['none'], choices=['none', 'skip', 'device'], help='consumer-adaptive capture rate modes')
+    parser.add_argument('--blackbox', type=str, default='', help='also record every case into this blackbox file (blackbox.py)')
+    parser.add_argument('--blackbox-format', nargs='+', default=['jpg'], choices=['none', 'jpg', 'raw'], help='blackbox formats to compare with --blackbox')
+    parser.add_argument('--blackbox-mb', type=float, default=256, help='blackbox file size in MB')
+    parser.add_argument('--blackbox-fps', type=float, default=0, help='frames per second and camera kept in the blackbox, 0 = all')
+    parser.add_argument('--affinity', nargs='+', default=['none'], choices=['none', 'auto'], help='capture thread CPU affinity modes')
+    parser.add_argument('--nice', type=int, default=None, help='nice value of the capture threads')
+    parser.add_argument('--intervals', action='store_true', help='also print the distribution of capture inter-frame intervals')
+    parser.add_argument('--load', type=int, default=0, help='background threads keeping the CPU busy (emulates inference)')
+    parser.add_argument('--schedule', nargs='+', default=['none'], choices=('none',) + MODES, help='mosaic / full-resolution scheduling modes')
+    parser.add_argument('--budget', type=float, default=0.1, help='schedule: longest time in seconds any camera may go unseen')
+    parser.add_argument('--priority', type=int, default=None, help='schedule: camera shown at full resolution every other frame')
+    parser.add_argument('--net', nargs='+', default=['none'], choices=('none',) + ENCODINGS, help='receive cameras from a localhost capture node with this encoding')
+    parser.add_argument('--quality', nargs='+', type=int, default=[0], help='measure image quality every N frames in the capture threads, 0 = off')
+    parser.add_argument('--temporal', nargs='+', type=int, default=[], help='only measure temporal batching with these batch sizes K (temporal.py)')
+    parser.add_argument('--flush', type=float, default=0.5, help='temporal: seconds before a partial batch is returned')
+    parser.add_argument('--batch-cost', nargs=2, type=float, default=[0, 0], metavar=('MS', 'MS_PER_FRAME'), help='temporal: emulated model time per batch')
+    parser.add_argument('--warmup', type=float, default=0.3, help='seconds to wait before measuring')
+    parser.add_argument('--alloc-limit', type=float, default=0, help='fail (exit 1) if any case allocates more KB/frame, 0 = no check')
+    return parser.parse_args()
+
+
+def main(opt):
+    if opt.convert:
+        return run_convert(opt)
+    if opt.temporal:
+        return run_temporal(opt)
+    tracer = Tracer(opt.trace) if opt.trace else None
+    over = [] # --alloc-limit を超えた条件
+    stop_load = Event()
+    cpu_load(opt.load, stop_load)
+    print(header(COLUMNS))
+    for loader in opt.loaders:
+        for size in opt.sizes:
+            w, h = (int(x) for x in size.split('x'))
+            acqs = opt.acquisition if opt.tis == 'stub' and loader in ('T4TIS', 'V4TIS') else ['snap']
+            boxes = opt.blackbox_format if opt.blackbox else ['none']
+            cases = [(n, a, r, b, af, c, sc, nt, q) for n in opt.cams for a in acqs for r in opt.rate_control for b in boxes for af in opt.affinity
+                     for c in opt.compose for sc in opt.schedule for nt in opt.net for q in opt.quality]
+            for n_cams, acq, rc, bb, af, comp, sc, nt, q in cases:
+                r = run_one(loader, n_cams, (w, h), opt, tracer, acq, None if rc == 'none' else rc, None if bb == 'none' else bb,
+                            None if af == 'none' else af, comp, None if sc == 'none' else sc, None if nt == 'none' else nt, q or None)
+                print(row(COLUMNS, r))
+                if r['box'] is not None: # 書いた枚数と、書込みが追いつかずに捨てた枚数
+                    print(f"{'':<12}blackbox: {r['box'].written} written, {r['box'].dropped} dropped, {r['box'].too_big} too big")
+                if r['node'] is not None: # ノードが送った量と、受け側が遅くて送らなかった枚数、ノードで画像になってから受け側で戻るまでの時間
+                    nd, lat = r['node'], [v for v in r['latency'] if v is not None]
+                    print(f"{'':<12}net: {nd.bytes / 1e6 / r['elapsed']:.1f} MB/s, encode {nd.t_encode * 1000 / max(1, sum(nd.sent)):.2f} ms/frame, "
+                          f"{sum(nd.sent)} sent, {sum(nd.skipped)} skipped, latency p50 {np.median(lat) if lat else float('nan'):.1f} ms")
+                if r['quality'] is not None: # 画質を測るのにかかった時間と、取込スレッド1本あたりのCPU
+                    qm = r['quality']
+                    alerts = sorted({a for st in qm.stats if st for a in st['alerts']})
+                    print(f"{'':<12}quality: {np.mean(qm.ms):.3f} ms/sample, {sum(qm.samples)} samples, cpu {np.mean(qm.cost) * 100:.2f}% per camera"
+                          + (f", alerts {' '.join(alerts)}" if alerts else ''))
+                if r['gaps'] is not None and len(r['gaps']): # 取込間隔の分布。揺らぎが少ないほど p99 と max が p50 に近い
+                    g = r['gaps']
+                    p50, p99 = np.percentile(g, [50, 99])
+                    print(f"{'':<12}intervals: p50 {p50:.2f}  p99 {p99:.2f}  max {g.max():.2f}  std {g.std():.2f} ms ({len(g)} frames)")
+                if opt.alloc_limit and r['alloc_kb'] > opt.alloc_limit:
+                    over.append(f"{r['loader']} {r['cams']} cams {r['size']}: {r['alloc_kb']:.1f} KB/frame")
+    stop_load.set()
+    if tracer is not None:
+        tracer.stop()
+        print(f'trace saved to {opt.trace}')
+    if over: # 定常状態でメモリを確保し続けている
+        print(f'allocation per frame over {opt.alloc_limit} KB:\n  ' + '\n  '.join(over))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parse_opt())
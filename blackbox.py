@@ -0,0 +1,211 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+ブラックボックス（フライトレコーダー）。取り込んだ画像を決まった大きさのメモリマップファイルに輪番で書き続ける。
+プロセスが落ちても書いた所までは残るので、再起動の後で障害直前の数秒間を見返せる。
+usage :
+    box = BlackBox('blackbox.bin', size_mb=512, fps=20)    # 無ければ作る。有れば続きから書く（古いものから上書き）。カメラごとに最大20枚/秒残す
+    box = BlackBox('blackbox.bin', size_mb=2048, slot_kb=640 * 480 * 3 / 1024, fmt='raw') # 圧縮しない（スロットは1枚が入る大きさにする）
+    dataset = LoadT4TISCams(source, blackbox=box)
+    ...
+    box.close()
+
+    python blackbox.py blackbox.bin --last 10 --out dump   # 最後の10秒分をカメラごとの画像ファイルに書き出す
+"""
+
+import os
+import mmap
+import time
+import struct
+import argparse
+from threading import Thread, Condition
+import cv2
+import numpy as np
+
+MAGIC = b'BLACKBOX'
+HEADER = struct.Struct('<8sIIIQ') # MAGIC, version, スロット数, スロットのバイト数, 最後に書いた通し番号
+HEADER_SIZE = 64
+# 索引1件: 通し番号(0は空), 時刻(time.time), カメラ番号, 形式(0:raw 1:jpg), 高さ, 幅, カメラごとの番号, データのバイト数
+INDEX = struct.Struct('<QdHHHHII')
+FORMATS = {'raw': 0, 'jpg': 1}
+
+
+class BlackBox:
+    # ファイルは [ヘッダ][索引 x slots][データ x slots]。i番目の画像は i % slots 番目のスロットに入る
+    # 書込みは専用スレッドで行い、取込スレッドは put() で画像をカメラごとの置き場にコピーするだけ（JPEG圧縮などを待たない）
+    # 書込みスレッドが追いつかない間に来た画像は捨てる（dropped）。スロットに入りきらない画像も捨てる（too_big）
+    # fps を指定すると、カメラごとにその間隔より速く来た画像は残さない（JPEG圧縮のCPUを取込側に回すため）
+    # 書く順番: スロットの索引を空(通し番号0)にする → データ → 索引 → ヘッダ。落ちた瞬間に書きかけだった1枚は索引に載らない
+    def __init__(self, path='blackbox.bin', size_mb=256, slot_kb=256, fmt='jpg', quality=80, fps=None):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown blackbox format: {fmt} (choose from {tuple(FORMATS)})')
+        self.path = path
+        self.fmt, self.quality = fmt, quality
+        self.interval = 1 / fps if fps else 0 # カメラごとに残す間隔（秒）
+        slot_size = int(slot_kb * 1024)
+        slots = max(1, int(size_mb * 1024 * 1024) // (slot_size + INDEX.size))
+        if os.path.isfile(path): # 前回のファイルが同じ作りなら続きから書く
+            with open(path, 'rb') as f:
+                magic, version, old_slots, old_size, head = HEADER.unpack(f.read(HEADER.size))
+            if magic == MAGIC and (old_slots, old_size) == (slots, slot_size) and os.path.getsize(path) == self.file_size(slots, slot_size):
+                self.head = head
+            else:
+                os.remove(path)
+        if not os.path.isfile(path):
+            with open(path, 'wb') as f:
+                f.truncate(self.file_size(slots, slot_size))
+            self.head = 0
+        self.slots, self.slot_size = slots, slot_size
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.mm[:HEADER.size] = HEADER.pack(MAGIC, 1, slots, slot_size, self.head)
+        self.data0 = HEADER_SIZE + slots * INDEX.size # データ部の先頭
+        self.staging = {} # カメラ番号 → (画像の置き場, 時刻, カメラごとの番号)。書込み待ちのもの
+        self.spare = {} # カメラ番号 → 書込みスレッドが使い終わった置き場
+        self.seq = {} # カメラ番号 → put() された枚数
+        self.t_put = {} # カメラ番号 → 最後に残した時刻
+        self.written = 0
+        self.dropped = 0
+        self.too_big = 0
+        self.cond = Condition()
+        self.flag = True
+        self.thread = Thread(target=self.run, name='blackbox', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def file_size(slots, slot_size):
+        return HEADER_SIZE + slots * (INDEX.size + slot_size)
+
+    def put(self, cam, im):
+        # 取込スレッドから呼ぶ。前の画像がまだ書かれていなければ捨てるので、待つことは無い
+        seq = self.seq[cam] = self.seq.get(cam, 0) + 1
+        now = time.time()
+        if now - self.t_put.get(cam, 0) < self.interval:
+            return
+        with self.cond:
+            if cam in self.staging:
+                self.dropped += 1
+                return
+            buf = self.spare.pop(cam, None)
+        if buf is None or buf.shape != im.shape:
+            buf = np.empty_like(im)
+        np.copyto(buf, im) # 取込側のバッファは使い回されるのでコピーしておく
+        with self.cond:
+            self.staging[cam] = (buf, now, seq)
+            self.t_put[cam] = now
+            self.cond.notify()
+
+    def run(self):
+        # 書込みスレッド
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.staging or not self.flag)
+                if not self.staging:
+                    break
+                cam, (buf, t, seq) = self.staging.popitem()
+            self.write(cam, buf, t, seq)
+            with self.cond:
+                self.spare[cam] = buf
+
+    def write(self, cam, im, t, seq):
+        if self.fmt == 'jpg':
+            ok, enc = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            data = enc.data if ok else b''
+        else:
+            data = im.reshape(-1).data # uint8なので len() がバイト数になる
+        n = len(data)
+        if n == 0 or n > self.slot_size:
+            self.too_big += 1
+            return
+        gen = self.head + 1
+        k = (gen - 1) % self.slots
+        off = self.data0 + k * self.slot_size
+        idx = HEADER_SIZE + k * INDEX.size
+        self.mm[idx:idx + 8] = bytes(8) # 先に前の画像の索引を消す（上書きの途中で落ちても、書きかけのデータを前の画像として読まない）
+        self.mm[off:off + n] = data
+        h, w = im.shape[:2]
+        self.mm[idx:idx + INDEX.size] = INDEX.pack(gen, t, cam, FORMATS[self.fmt], h, w, seq, n)
+        self.head = gen
+        self.mm[:HEADER.size] = HEADER.pack(MAGIC, 1, self.slots, self.slot_size, gen)
+        self.written += 1
+
+    def close(self):
+        # 書込み待ちの分を書いてから閉じる
+        with self.cond:
+            self.flag = False
+            self.cond.notify()
+        self.thread.join(timeout=5.0)
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class BlackBoxReader:
+    # BlackBoxのファイルを読む。entries は残っている画像の索引を古い順に並べたもの
+    # 各要素は (通し番号, 時刻, カメラ番号, 形式, 高さ, 幅, カメラごとの番号, バイト数, スロット番号)
+    def __init__(self, path='blackbox.bin'):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slots, self.slot_size, self.head = HEADER.unpack(self.mm[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a blackbox file')
+        self.data0 = HEADER_SIZE + self.slots * INDEX.size
+        entries = []
+        for k in range(self.slots):
+            e = INDEX.unpack_from(self.mm, HEADER_SIZE + k * INDEX.size)
+            if e[0] and e[0] <= self.head and e[7] <= self.slot_size: # 空のスロットと書きかけを除く
+                entries.append(e + (k,))
+        self.entries = sorted(entries)
+
+    def image(self, entry):
+        # 索引1件分の画像（BGR）を返す
+        gen, t, cam, fmt, h, w, seq, n, k = entry
+        off = self.data0 + k * self.slot_size
+        data = np.frombuffer(self.mm, dtype=np.uint8, count=n, offset=off)
+        if fmt == FORMATS['jpg']:
+            return cv2.imdecode(data, cv2.IMREAD_COLOR)
+        return data.reshape(h, w, -1).copy()
+
+    def last(self, seconds=10.0, cam=None):
+        # 最後に書かれた画像から遡って seconds 秒分の索引（camを指定すればそのカメラだけ）
+        if not self.entries:
+            return []
+        t_end = self.entries[-1][1]
+        return [e for e in self.entries if e[1] >= t_end - seconds and (cam is None or e[2] == cam)]
+
+    def dump(self, out, seconds=10.0, cam=None):
+        # last() の画像を out フォルダに cam{カメラ}_{番号}_{時刻}.jpg として書き出し、書いた枚数を返す
+        os.makedirs(out, exist_ok=True)
+        entries = self.last(seconds, cam)
+        for e in entries:
+            stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(e[1])) + f'_{int(e[1] * 1000) % 1000:03d}'
+            cv2.imwrite(os.path.join(out, f'cam{e[2]}_{e[6]:08d}_{stamp}.jpg'), self.image(e))
+        return len(entries)
+
+    def close(self):
+        self.mm.close()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs='?', default='blackbox.bin', help='blackbox file')
+    parser.add_argument('--last', type=float, default=10.0, help='seconds before the last frame to dump')
+    parser.add_argument('--cam', type=int, default=None, help='only this camera')
+    parser.add_argument('--out', type=str, default='', help='write the frames as images to this directory')
+    return parser.parse_args()
+
+
+def main(opt):
+    reader = BlackBoxReader(opt.path)
+    entries = reader.last(opt.last, opt.cam)
+    print(f'{opt.path}: {len(reader.entries)} frames in {reader.slots} slots, {len(entries)} in the last {opt.last} s')
+    for cam in sorted({e[2] for e in entries}):
+        es = [e for e in entries if e[2] == cam]
+        print(f'  cam{cam}: {len(es)} frames, seq {es[0][6]}-{es[-1][6]}, '
+              f"{time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(es[0][1]))} - {time.strftime('%H:%M:%S', time.localtime(es[-1][1]))}")
+    if opt.out:
+        print(f'{reader.dump(opt.out, opt.last, opt.cam)} images saved to {opt.out}')
+    reader.close()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,635 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+VideoCapture互換のキャプチャ（isOpened / grab / retrieve / read / get / release）。
+ローダーの backend 引数で切り替える。retrieve(image) / read(image) に同じ大きさの配列を渡すと、新しく作らずにそこへ書き込む。
+usage :
+    dataset = LoadT4TISCams(source, backend='synthetic', preview=False) # カメラ無しで動かす
+    dataset = LoadT4Streams('replay.txt', backend='replay') # 録画ファイル/画像フォルダを実時間で再生する
+    dataset = LoadT4Streams('replay.txt', backend=partial(ReplayCapture, speed=0, loop=False), policy='block') # 全フレームを最速で
+    dataset = LoadT4TISCams(source, backend=partial(SyntheticCapture, jitter=0.002, dropout=0.01))
+    dataset = LoadT4TISCams(source, pixel_format='Y800') # モノクロで取り込んでUSBの帯域を1/3にする。BGRへの変換は取込スレッドで行う
+    dataset = LoadT4Streams('streams.txt', backend='v4l2', size=(1280, 720)) # LinuxのUSBカメラをMJPGで、ドライバのバッファ1枚で開く
+"""
+
+import os
+import glob
+import time
+import random
+from collections import deque
+from threading import Thread, Condition
+import cv2
+import numpy as np
+
+IMG_FORMATS = ('.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff')
+PIXEL_FORMATS = {'RGB24': 3, 'Y800': 1, 'BY8': 1} # カメラのピクセル形式と1画素のバイト数（USBの帯域はこれに比例する）
+
+
+def open_capture(source, backend, w, h, fps, pixel_format='RGB24'):
+    # backendの指定（名前かcallable）に従ってVideoCapture互換のオブジェクトを返す
+    if callable(backend):
+        return backend(source, w, h, fps)
+    if backend == 'synthetic':
+        return SyntheticCapture(source, w, h, fps, pixel_format=pixel_format)
+    if backend == 'replay':
+        return ReplayCapture(source, w, h, fps)
+    if backend == 'dshow': # Windowsの従来の開き方
+        return cv2.VideoCapture(source + cv2.CAP_DSHOW) if isinstance(source, int) else cv2.VideoCapture(source)
+    if backend == 'v4l2': # Linux
+        return V4L2Capture(source, w, h, fps)
+    if backend == 'remote': # 別のPCのキャプチャノード（netcam.CaptureNode）。source は tcp://ノード:ポート/カメラ番号
+        from netcam import RemoteCapture
+        return RemoteCapture(source, w, h, fps)
+    raise ValueError(f'unknown capture backend: {backend}')
+
+
+def raw_image(bgr, pixel_format):
+    # BGR画像から、カメラがその形式で送ってくる生画像を作る（疑似カメラ用）。BY8は RGGB の並びとする
+    if pixel_format == 'Y800':
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    if pixel_format == 'BY8':
+        raw = np.empty(bgr.shape[:2], dtype=np.uint8)
+        raw[0::2, 0::2] = bgr[0::2, 0::2, 2] # R
+        raw[0::2, 1::2] = bgr[0::2, 1::2, 1] # G
+        raw[1::2, 0::2] = bgr[1::2, 0::2, 1] # G
+        raw[1::2, 1::2] = bgr[1::2, 1::2, 0] # B
+        return raw
+    return bgr.copy()
+
+
+class PixelConverter:
+    # カメラの生画像（RGB24 / Y800 / BY8）を、モデルが使う3チャンネルのBGR画像にする。取込スレッドで呼ぶ
+    # flip=True なら上下反転も一緒に行う（TISの画像は下の行から並んでいる）。途中の画像と出力先は使い回す
+    # bayer はBY8の色の並びに合わせたOpenCVの変換コード（RGGB の並びは cv2.COLOR_BayerBG2BGR）
+    def __init__(self, pixel_format='RGB24', flip=False, bayer=cv2.COLOR_BayerBG2BGR):
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError(f'unknown pixel format: {pixel_format} (choose from {tuple(PIXEL_FORMATS)})')
+        self.pixel_format = pixel_format
+        self.flip = flip
+        self.bayer = bayer
+        self.work = None # 変換途中の画像
+
+    def __call__(self, raw, dst=None):
+        # raw: (H, W) または (H, W, 1|3) の生画像。dstに同じ大きさのBGR画像を渡せばそこに書き込む
+        if raw.ndim == 3 and raw.shape[2] == 1:
+            raw = raw[..., 0]
+        if dst is not None and dst.shape != raw.shape[:2] + (3,):
+            dst = None
+        if self.pixel_format == 'RGB24':
+            if self.flip:
+                return cv2.flip(raw, 0, dst=dst)
+            if dst is None:
+                return raw.copy()
+            np.copyto(dst, raw)
+            return dst
+        if self.pixel_format == 'Y800': # 1チャンネルのまま反転してから3チャンネルに広げる
+            if self.flip:
+                raw = self.work = cv2.flip(raw, 0, dst=self.work)
+            return cv2.cvtColor(raw, cv2.COLOR_GRAY2BGR, dst=dst)
+        # BY8: 反転すると色の並びが変わるので、先に色を付けてから反転する
+        if not self.flip:
+            return cv2.cvtColor(raw, self.bayer, dst=dst)
+        self.work = cv2.cvtColor(raw, self.bayer, dst=self.work)
+        return cv2.flip(self.work, 0, dst=dst)
+
+
+class SharedFrames:
+    # 1つのグラバーの画像を、同じグラバーを使う全てのローダーに配る（tis_manager で共有したグラバー）
+    # 取り込むスレッドは1本だけで、publish() で最新の1枚を写して番号を進める。受け取る側は wait() で次の番号を待ってから copy() で写す
+    # 書き込む画像と読む画像は分けてあるので、publish() の変換・コピーの間も読む側は待たない
+    def __init__(self):
+        self.cond = Condition()
+        self.front = None # 最新の画像
+        self.back = None # 次に書き込む画像
+        self.seq = 0 # 届いた枚数
+
+    def publish(self, src, convert=None):
+        # src を back に写して（convert があれば変換しながら）front と入れ替える
+        if convert is not None:
+            back = convert(src, self.back)
+        else:
+            back = self.back if self.back is not None and self.back.shape == src.shape else np.empty_like(src)
+            np.copyto(back, src)
+        with self.cond:
+            self.front, self.back = back, self.front
+            self.seq += 1
+            self.cond.notify_all()
+
+    def wait(self, seen, timeout):
+        # seen より新しい画像が届くまで待って、その番号を返す。timeout 秒来なければNone
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seen, timeout):
+                return None
+            return self.seq
+
+    def copy(self, image=None):
+        with self.cond:
+            if self.front is None:
+                return False, None
+            if image is None or image.shape != self.front.shape:
+                return True, self.front.copy()
+            np.copyto(image, self.front)
+            return True, image
+
+    def wake(self):
+        # 待っている grab() を起こす（release() した時）
+        with self.cond:
+            self.cond.notify_all()
+
+
+class TISCapture:
+    # tisgrabberのグラバーをVideoCapture風に包む。画像は上下反転して返す
+    # pixel_format はカメラに設定したビデオフォーマット（RGB24 / Y800 / BY8）。BGRへの変換はretrieveで行う
+    # manager（tis_manager.TISManager）から借りたグラバーなら、release() で開放せずに返す
+    # 他のローダーも同じグラバーを使う時は、manager が share() を呼ぶ。その後は retrieve() する度に frames に写して配る
+    pushed = False # フレームをドライバが送ってくるか（コールバック）。False なら grab() を呼ぶスレッドが取りに行く
+
+    def __init__(self, ic, hGrabber, tis, ctypes, pixel_format='RGB24', manager=None):
+        self.ic = ic
+        self.hGrabber = hGrabber
+        self.manager = manager
+        self.frames = None # 他のローダーに配る SharedFrames（share() してから）
+        self.tis = tis
+        self.ctypes = ctypes
+        self.convert = PixelConverter(pixel_format, flip=True)
+        self.Width = ctypes.c_long()
+        self.Height = ctypes.c_long()
+        self.BitsPerPixel = ctypes.c_int()
+        self.colorformat = ctypes.c_int()
+        self.fps = None # set() で設定したFPS
+        self.shape = None # 画像の (高さ, 幅, バイト数)。describe() で1回だけ問い合わせる
+        self.views = {} # ドライバのバッファのアドレス → そのバッファを見るnumpy配列
+        if manager is not None:
+            manager.bind(hGrabber, self)
+
+    def share(self):
+        # 他のローダーに配り始める。配る SharedFrames を返す
+        if self.frames is None:
+            self.frames = SharedFrames()
+        return self.frames
+
+    def describe(self):
+        # 画像の大きさとビット数を問い合わせて、ポインタのキャスト先の型を作っておく。フォーマットを変えたら呼び直す
+        ic, ctypes = self.ic, self.ctypes
+        # Query values of image description
+        ic.IC_GetImageDescription(self.hGrabber, self.Width, self.Height, self.BitsPerPixel, self.colorformat)
+        # Calculate the buffer size
+        bpp = int(self.BitsPerPixel.value / 8.0)
+        self.shape = (self.Height.value, self.Width.value, bpp)
+        self.buffer_type = ctypes.c_ubyte * (self.Width.value * self.Height.value * bpp)
+        self.views = {}
+
+    def view(self, ptr):
+        # ドライバのバッファをコピーせずにnumpy配列として見る。バッファ（アドレス）ごとに1回だけ作って使い回す
+        address = self.ctypes.cast(ptr, self.ctypes.c_void_p).value
+        im = self.views.get(address)
+        if im is None:
+            im = np.ndarray(buffer=self.buffer_type.from_address(address), dtype=np.uint8, shape=self.shape)
+            self.views[address] = im
+        return im
+
+    def isOpened(self):
+        return bool(self.ic.IC_IsDevValid(self.hGrabber))
+
+    def grab(self):
+        return self.ic.IC_SnapImage(self.hGrabber) == self.tis.IC_SUCCESS
+
+    def retrieve(self, image=None):
+        # ドライバのバッファを直接見て、上下反転とBGRへの変換をしながら image に書き込む
+        if self.shape is None:
+            self.describe()
+        imagePtr = self.ic.IC_GetImagePtr(self.hGrabber)
+        if not imagePtr:
+            return False, None
+        image = self.convert(self.view(imagePtr), image)
+        frames = self.frames
+        if frames is not None: # 同じグラバーを使う他のローダーにも配る
+            frames.publish(image)
+        return True, image
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.Width.value
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.Height.value
+        if prop == cv2.CAP_PROP_FPS and self.fps:
+            return self.fps
+        return 0.0
+
+    def set(self, prop, value):
+        # FPSはライブを止めないと変えられないので、止めて設定して再開する（時間がかかるので頻繁に呼ばないこと）
+        if prop == cv2.CAP_PROP_FPS:
+            self.ic.IC_StopLive(self.hGrabber)
+            self.ic.IC_SetFrameRate(self.hGrabber, self.ctypes.c_float(value))
+            self.ic.IC_StartLive(self.hGrabber, 0)
+            self.fps = value
+            return True
+        return False
+
+    def release(self):
+        if self.manager is not None: # 止めて取っておくかは manager が決める（他のローダーも使っていれば止めない）
+            self.manager.release(self.hGrabber, self)
+            return
+        self.ic.IC_StopLive(self.hGrabber)
+        self.ic.IC_ReleaseGrabber(self.hGrabber)
+
+
+class TISCallbackCapture(TISCapture):
+    # IC_SnapImage で1枚ずつ取りに行く代わりに、フレームが届く度にドライバのスレッドから呼ばれるコールバックで受け取る
+    # コールバックの中でBGRに変換して最新の1枚を持っておき（frames）、grab() は次のフレームが届くまでCPUを使わずに待つ
+    # コールバックの登録は IC_StartLive より前に行う必要があるので、StartLiveの前に作ること
+    pushed = True
+
+    def __init__(self, ic, hGrabber, tis, ctypes, pixel_format='RGB24', timeout=1.0, manager=None):
+        super().__init__(ic, hGrabber, tis, ctypes, pixel_format, manager)
+        self.timeout = timeout # この秒数フレームが来なければ grab() は False
+        self.frames = SharedFrames() # 他のローダーと共有する時もこれをそのまま配る
+        self.read_seq = 0 # grab() で受け取った所までの枚数
+        proto = getattr(tis, 'FRAMEREADYCALLBACK', None) or ctypes.CFUNCTYPE(
+            ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong, ctypes.py_object)
+        self.callback = proto(self.frame_ready) # 参照を持っておかないとコールバックが消されてしまう
+        ic.IC_SetFrameReadyCallback(hGrabber, self.callback, None)
+        ic.IC_SetContinuousMode(hGrabber, 0) # 0 で毎フレームコールバックを呼ぶ
+
+    def frame_ready(self, hGrabber, pBuffer, framenumber, pData):
+        # ドライバのスレッドから呼ばれる。戻るとバッファは次のフレームに使われるので、ここで変換して持っておく
+        if self.shape is None:
+            self.describe()
+        self.frames.publish(self.view(pBuffer), self.convert)
+
+    def grab(self):
+        seq = self.frames.wait(self.read_seq, self.timeout)
+        if seq is None:
+            return False
+        self.read_seq = seq
+        return True
+
+    def retrieve(self, image=None):
+        return self.frames.copy(image)
+
+    def release(self):
+        super().release()
+        self.frames.wake()
+
+
+class SharedCapture:
+    # tis_manager で他のローダーと共有しているグラバーを受け取る側。自分では IC_SnapImage せず、
+    # 取り込んでいる1本のスレッド（最初に開いたローダー、そのローダーが閉じた後は manager）が配る画像を待って写す
+    # カメラの設定（FPSなど）は最初に開いたローダーのものなので、set() は何もしない
+    paced = True # grab() が次のフレームを待つ
+
+    def __init__(self, manager, hGrabber, timeout=1.0):
+        self.manager, self.hGrabber, self.timeout = manager, hGrabber, timeout
+        self.ic = manager.ic
+        self.frames = manager.share(hGrabber)
+        self.read_seq = self.frames.seq # 前から持っている画像ではなく、次に届くものから受け取る
+        self.closed = False
+
+    def isOpened(self):
+        return not self.closed and bool(self.ic.IC_IsDevValid(self.hGrabber))
+
+    def grab(self):
+        seq = None if self.closed else self.frames.wait(self.read_seq, self.timeout)
+        if seq is None:
+            return False
+        self.read_seq = seq
+        return True
+
+    def retrieve(self, image=None):
+        return self.frames.copy(image)
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def get(self, prop):
+        front = self.frames.front
+        if front is not None and prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT):
+            return front.shape[1] if prop == cv2.CAP_PROP_FRAME_WIDTH else front.shape[0]
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        if not self.closed:
+            self.closed = True
+            self.manager.release(self.hGrabber, self)
+            self.frames.wake()
+
+
+def fourcc_str(v):
+    # CAP_PROP_FOURCC の数値を 'MJPG' などの4文字に戻す
+    v = int(v)
+    return ''.join(chr((v >> 8 * k) & 0xFF) for k in range(4)) if v > 0 else '?'
+
+
+class V4L2Capture:
+    # LinuxのUSBカメラ（/dev/videoN）を cv2.CAP_V4L2 で開く。ドライバの既定（YUYVで何枚もバッファする）に任せず、
+    # fourcc（既定 MJPG）、解像度、FPS と CAP_PROP_BUFFERSIZE（既定 1）を指定して、いつも一番新しいフレームを受け取る
+    # 実際に決まった形式は mode に入る。指定と違えば警告を出す（カメラがその形式を持っていない時など）
+    # latency: ドライバがフレームに付けた時刻（CAP_PROP_POS_MSEC、CLOCK_MONOTONIC）から retrieve（MJPGのデコード）が終わるまでの ms
+    # api に VideoCapture の代わりを渡せば、カメラ無しで試せる
+    paced = True # grab() がドライバの次のフレームを待つので、ローダー側で 1/fps 待たなくてよい（待つとその分古くなる）
+
+    def __init__(self, source=0, w=640, h=480, fps=30, fourcc='MJPG', buffersize=1, api=cv2.VideoCapture, history=300):
+        self.source = f'/dev/video{source}' if isinstance(source, int) else source
+        self.want = (fourcc, int(w), int(h), fps, buffersize)
+        self.latencies = deque(maxlen=history) # 最近の latency（ms）
+        self.stamp = None # grab() したフレームのドライバの時刻（ms）
+        self.mode = {}
+        self.cap = api(source, cv2.CAP_V4L2)
+        if self.cap.isOpened():
+            self.configure()
+
+    def configure(self):
+        # 形式を先に決めないと、解像度やFPSがYUYVの範囲で決まってしまう
+        fourcc, w, h, fps, buffersize = self.want
+        if fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, w)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, h)
+        if fps:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if buffersize:
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, buffersize)
+        self.mode = {'fourcc': fourcc_str(self.cap.get(cv2.CAP_PROP_FOURCC)),
+                     'size': (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))),
+                     'fps': self.cap.get(cv2.CAP_PROP_FPS), 'buffers': int(self.cap.get(cv2.CAP_PROP_BUFFERSIZE))}
+        print(f'v4l2 {self.source}: {self}')
+        want = {'fourcc': fourcc or self.mode['fourcc'], 'size': (w, h)}
+        if any(self.mode[k] != v for k, v in want.items()):
+            print(f"WARNING: v4l2 {self.source}: asked for {want['fourcc']} {w}x{h}, got {self.mode['fourcc']} {self.mode['size'][0]}x{self.mode['size'][1]}")
+
+    def __repr__(self):
+        m = self.mode
+        return f"{m['fourcc']} {m['size'][0]}x{m['size'][1]} @ {m['fps']:.1f} FPS, {m['buffers']} buffers" if m else 'not opened'
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def grab(self):
+        ok = self.cap.grab()
+        self.stamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) if ok else None
+        return ok
+
+    def retrieve(self, image=None):
+        ok, im = self.cap.retrieve(image)
+        if ok and self.stamp: # 時刻を返さないドライバ（0）や、CLOCK_MONOTONIC以外の時刻は数えない
+            lat = time.monotonic() * 1000 - self.stamp
+            if 0 <= lat < 10000:
+                self.latencies.append(lat)
+        return ok, im
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def latency(self, q=50):
+        # 最近のフレームの latency の q パーセンタイル（ms）。測れていなければ None
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def open(self, source):
+        # 開き直した時も同じ形式を指定し直す
+        ok = self.cap.open(source, cv2.CAP_V4L2)
+        if ok:
+            self.configure()
+        return ok
+
+    def release(self):
+        self.cap.release()
+
+
+class SyntheticCapture:
+    # カメラ無しで動かすための疑似カメラ。解像度・FPS・取込み間隔の揺らぎ(jitter 秒)・取りこぼし率(dropout)を指定できる
+    # 毎フレーム中央部分が変わるので、ローダーの画像停止検出にも引っかからない
+    # pixel_format を Y800 / BY8 にすると、その形式の生画像からBGRへの変換を retrieve で毎回行う（変換の負荷を測る用）
+    paced = True # grab()がFPSに合わせて待つので、ローダー側で 1/fps 待たなくてよい
+
+    def __init__(self, source=0, w=640, h=480, fps=30, jitter=0.0, dropout=0.0, seed=None, patterns=16, pixel_format='RGB24'):
+        self.w, self.h, self.fps = int(w), int(h), fps
+        self.jitter, self.dropout = jitter, dropout
+        self.rng = random.Random(str(source) if seed is None else seed)
+        self.opened = True
+        self.n = 0 # 何枚目か
+        self.t0 = None
+        # 毎フレーム絵を描くと重いので、縞模様の位置が違う絵を予め作っておいて順に使う
+        base = np.zeros((self.h, self.w, 3), dtype=np.uint8)
+        base[..., 0] = np.linspace(0, 255, self.w, dtype=np.uint8)[None]
+        base[..., 1] = np.linspace(0, 255, self.h, dtype=np.uint8)[:, None]
+        base[..., 2] = self.rng.randrange(256)
+        self.patterns = []
+        for k in range(patterns):
+            im = base.copy()
+            x = int(self.w * k / patterns)
+            im[:, x:x + max(1, self.w // patterns)] = 255 - im[:, x:x + max(1, self.w // patterns)]
+            im[self.h // 2 - 10:self.h // 2 + 10, self.w // 2 - 10:self.w // 2 + 10] = (k * 16) % 256
+            self.patterns.append(raw_image(im, pixel_format))
+        self.convert = PixelConverter(pixel_format)
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        # 実カメラと同じく、次のフレームの時刻まで待つ（fps=0なら待たない）
+        if self.t0 is None:
+            self.t0 = time.perf_counter()
+        self.n += 1
+        if self.fps:
+            due = self.t0 + self.n / self.fps + (self.rng.gauss(0, self.jitter) if self.jitter else 0)
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        return not (self.dropout and self.rng.random() < self.dropout)
+
+    def retrieve(self, image=None):
+        return True, self.convert(self.patterns[self.n % len(self.patterns)], image)
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.w
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.h
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0.0 # CAP_PROP_FRAME_COUNT など。0は無限ストリーム扱い
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FPS: # 今のフレームから新しいFPSで続ける
+            self.fps = value
+            if self.t0 is not None and value:
+                self.t0 = time.perf_counter() - self.n / value
+            return True
+        return False
+
+    def open(self, source):
+        self.opened = True
+        return True
+
+    def release(self):
+        self.opened = False
+
+
+class ReplayCapture:
+    # 録画ファイル、または画像フォルダ（ファイル名順）を再生する。大きさが違う場合は w x h にリサイズする
+    # 別スレッドで先読み（デコードとリサイズ）して最大ahead枚を貯めておくので、読む側はデコードを待たない
+    # speed: 1.0で実時間、2.0なら2倍速、0なら待たずに最速（ベンチマーク用）。fpsは録画にFPS情報が無い時（画像フォルダ）に使う
+    # loop=Trueなら最後まで行ったら先頭に戻る。seek(n) または set(cv2.CAP_PROP_POS_FRAMES, n) でn枚目に飛ぶ
+    paced = True # 自分で再生速度を合わせるので、ローダー側で 1/fps 待たなくてよい
+
+    def __init__(self, source, w=640, h=480, fps=30, loop=True, speed=1.0, ahead=8):
+        self.source = str(source)
+        self.w, self.h, self.fps, self.loop = int(w), int(h), fps, loop
+        self.speed = speed
+        self.ahead = max(1, int(ahead))
+        self.files = None
+        self.cap = None
+        if os.path.isdir(self.source):
+            self.files = sorted(x for x in glob.glob(os.path.join(self.source, '*')) if x.lower().endswith(IMG_FORMATS))
+            self.frame_count = len(self.files)
+        else:
+            self.cap = cv2.VideoCapture(self.source)
+            self.frame_count = max(int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+            if self.cap.get(cv2.CAP_PROP_FPS) > 0: # 録画時のFPSに合わせる
+                self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.opened = self.files is not None and len(self.files) > 0 or self.cap is not None and self.cap.isOpened()
+        self.q = deque() # 先読みした (フレーム番号, 画像)。Noneは終わりの印
+        self.cond = Condition()
+        self.seek_to = None # 先読みスレッドに頼む飛び先
+        self.pos = -1 # 今読んでいるフレーム番号
+        self.im = None
+        self.clock = None # (基準時刻, 基準フレーム番号)。実時間再生の時刻合わせに使う
+        self.thread = Thread(target=self.decode, daemon=True)
+        if self.opened:
+            self.thread.start()
+
+    def decode(self):
+        # 先読みスレッド。キューが満杯なら空くまで待つ
+        n = 0 # 次にデコードするフレーム番号
+        while self.opened:
+            with self.cond:
+                while self.opened and self.seek_to is None and len(self.q) >= self.ahead:
+                    self.cond.wait(0.1)
+                if self.seek_to is not None:
+                    n, self.seek_to = self.seek_to, None
+                    if self.cap is not None:
+                        self.cap.set(cv2.CAP_PROP_POS_FRAMES, n)
+            if not self.opened:
+                break
+            im = self.decode_one(n)
+            if im is None and n > 0 and self.loop: # 最後まで行ったら先頭に戻る
+                n = 0
+                if self.cap is not None:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                im = self.decode_one(n)
+            with self.cond:
+                if self.seek_to is not None: # デコード中に飛び先が変わったら捨てる
+                    continue
+                self.q.append(None if im is None else (n, im))
+                self.cond.notify_all()
+            if im is None: # ループしない再生の終わり
+                break
+            n += 1
+
+    def decode_one(self, n):
+        # n枚目をデコードして w x h にそろえて返す。無ければNone
+        if self.files is not None:
+            im = cv2.imread(self.files[n]) if n < len(self.files) else None
+        else:
+            ok, im = self.cap.read()
+            im = im if ok else None
+        if im is not None and (im.shape[1] != self.w or im.shape[0] != self.h):
+            im = cv2.resize(im, (self.w, self.h), interpolation=cv2.INTER_AREA)
+        return im
+
+    def seek(self, n):
+        # n枚目に飛ぶ。先読み済みの画像は捨てる
+        with self.cond:
+            self.seek_to = max(0, int(n))
+            self.q.clear()
+            self.clock = None
+            self.cond.notify_all()
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.q or not self.opened, 1.0)
+            if not self.q: # 先読みが間に合わない。前の画像を retrieve で返さないように捨てる
+                self.im = None
+                return False
+            item = self.q.popleft()
+            self.cond.notify_all()
+        if item is None: # 再生終わり
+            self.opened = False
+            self.im = None
+            return False
+        n, self.im = item
+        if self.clock is None or n < self.pos: # 最初、飛んだ後、ループして戻った時は時刻合わせをやり直す
+            self.clock = (time.perf_counter(), n)
+        self.pos = n
+        if self.speed and self.fps:
+            wait = self.clock[0] + (n - self.clock[1]) / (self.fps * self.speed) - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        return True
+
+    def retrieve(self, image=None):
+        # 先読みスレッドが毎回新しくデコードした画像なので、imageには書かずにそのまま渡す
+        if self.im is None:
+            return False, None
+        return True, self.im
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.w
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.h
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.pos
+        if prop == cv2.CAP_PROP_FRAME_COUNT and not self.loop:
+            return self.frame_count
+        return 0.0 # ループ再生は無限ストリーム扱い
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.seek(value)
+            return True
+        return False
+
+    def open(self, source):
+        return self.isOpened()
+
+    def release(self):
+        self.opened = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+        if self.cap is not None:
+            self.cap.release()
@@ -6,11 +6,23 @@ usage :
 
 import os, sys
 import time
-from threading import Thread
+import ctypes
+from threading import Thread, Lock
 import re
 import cv2
 import numpy as np
 import warnings
+from cam_backends import open_capture, TISCapture, TISCallbackCapture, SharedCapture
+from tracer import NULL_TRACER
+from frame_queue import FrameQueue
+from layout import Layout, choose_layout
+from rate_control import RateController
+from scheduler import Scheduler
+from reconnect import Reconnector, HOLDS
+from affinity import plan_affinity, pin_thread
+from quality import QualityMonitor
+from temporal import TemporalBatcher
+import tis_manager
 warnings.filterwarnings("ignore") # Warning will make operation confuse!!!
 
 def clean_str(s):
@@ -46,35 +58,315 @@ def letterbox(
     )
     return im, ratio, (dw, dh)
 
-class LoadT4TISCams:
-    # Tile
-    def __init__(self, sources='4TISCams.txt', img_size=640, stride=32, auto=True):
+def letterbox_geometry(shape, new_shape):
+    # shape=(h, w) の画像を new_shape=(h, w) にletterboxする時の 倍率, 縮小後の(w, h), 余白(dw, dh), 画像を置く(top, left)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = (new_shape[1] - new_unpad[0]) / 2, (new_shape[0] - new_unpad[1]) / 2  # wh padding
+    top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+    return r, new_unpad, (dw, dh), (top, left)
+
+def letterbox_into(im, out, color=(114, 114, 114)):
+    # letterbox() と同じ配置で、予め作った out（new_shapeの大きさ）に直接書き込む。毎回新しい画像を作らない
+    # 余白は out を作る時に color で塗っておき、画像の大きさが変わらない限り二度と書かない
+    shape = im.shape[:2]  # current shape [height, width]
+    r, new_unpad, (dw, dh), (top, left) = letterbox_geometry(shape, out.shape[:2])
+    dst = out[top:top + new_unpad[1], left:left + new_unpad[0]]
+    if shape[::-1] != new_unpad:  # resize
+        cv2.resize(im, new_unpad, dst=dst, interpolation=cv2.INTER_LINEAR)
+    else:
+        np.copyto(dst, im)
+    return out, (r, r), (dw, dh)
+
+def compose_into(out, imgs, rects, keys=None, drawn=None, rois=None):
+    # imgs[k] を out の rects[k] = (x, y, w, h) の位置に縮小しながら直接書き込む（hconcat/vconcat/resizeの途中の画像を作らない）
+    # keys と drawn を渡すと差分合成: keys[k]（今の画像の番号）が drawn[k]（前回 out に書いた画像の番号）と同じタイルは書かない
+    # rois を渡すと（layout.plan_rois）、rects[k] には rois[k] = (カメラ, x, y, w, h) の範囲だけを書く。1台から何か所でもよい
+    if rois is not None:
+        imgs = [imgs[i][y:y + h, x:x + w] for i, x, y, w, h in rois]
+        keys = keys if keys is None else [keys[r[0]] for r in rois]
+    for k, (im, (x, y, w, h)) in enumerate(zip(imgs, rects)):
+        if keys is not None:
+            if drawn[k] == keys[k]:
+                continue
+            drawn[k] = keys[k]
+        dst = out[y:y + h, x:x + w]
+        if im.shape[:2] == (h, w):
+            np.copyto(dst, im)
+        else:
+            cv2.resize(im, (w, h), dst=dst, interpolation=cv2.INTER_AREA)
+    return out
+
+def frame_keys(queues, imgs):
+    # 差分合成で使う、各カメラの今の画像の番号。取込スレッドから来た画像は受け取った順の番号（FrameQueue.seq）
+    # 書き込み禁止のダミー画像（placeholder）やカメラの無い所の画像は配列そのもの（id）なので、同じダミーが続いても書き直さない
+    return [q.seq if q is not None and im.flags.writeable else id(im) for q, im in zip(queues, imgs)]
+
+_placeholders = {}
+
+def placeholder(shape, color):
+    # 単色のダミー画像（赤：未接続、灰：カメラ無し、青：取込エラー など）。
+    # 同じ大きさ・色なら毎回同じ配列を返すので、エラーが続いてもメモリを確保し続けない。書き込み禁止にしてある
+    key = (tuple(shape), tuple(color))
+    im = _placeholders.get(key)
+    if im is None:
+        im = np.full(shape, color, dtype=np.uint8)
+        im.flags.writeable = False
+        _placeholders[key] = im
+    return im
+
+def out_buffers(n, plan):
+    # __next__ が返す合成画像と letterbox 画像のバッファをn組作っておく。順番に使い回す
+    # 合成画像はカメラの無い所を灰色、帯を白で塗っておく
+    outs = [np.full(plan.shape + (3,), 128, dtype=np.uint8) for _ in range(n)]
+    for out in outs:
+        for y0, y1 in plan.bands:
+            out[y0:y1] = 255
+    lbs = [np.full((plan.img_size, plan.img_size, 3), 114, dtype=np.uint8) for _ in range(n)]
+    return outs, lbs
+
+def quit_key(preview, key=ord('q')):
+    # 終了キーの判定。previewを渡していれば表示スレッドが受けたキーを見るだけでwaitKeyは呼ばない。
+    # preview=False はウインドウを使わない場合（ベンチマークなど）でキーを見ない。
+    if preview is None:
+        return cv2.waitKey(1) == key
+    return bool(preview) and preview.quit
+
+_release_lock = Lock() # カメラの開放を取込スレッドと close() の両方から呼ぶ時の排他
+
+class LoaderControl:
+    # 5つのローダー共通の停止と再起動。with ローダー(...) as dataset: と書けば抜ける時に close() する
+    # 止める順番: flagを倒す → 取込スレッドの終わりを待つ（各スレッドが自分のカメラを開放する）
+    #            → timeout秒で終わらないスレッドのカメラはこちらで開放する → TISはグラバーを全て返してから detach
+    #            （close_library=True なら、同じライブラリを使う他のローダーが無い時だけ IC_CloseLibrary）
+    def setup(self, args, slots=4, fps=None):
+        # 5つのローダーで同じ引数の処理と状態の初期化。__init__ の最初に self.setup(locals(), ...) と呼ぶ
+        # slots はキューやスレッドの設定を持つ数（田の字・縦並びは4、LoadT4Batch はカメラの数 None）
+        # fps はTISのようにローダーが決めるFPS。None ならカメラごとに開いてから決める（self.fps はカメラごとのリスト）
+        # sources のファイルを読んで、カメラの一覧（clean_str する前のもの）を返す
+        self.init_args = {k: v for k, v in args.items() if k != 'self'} # restart() で同じ引数で開き直すため
+        a = self.init_args
         self.mode = 'stream'
-        self.img_size = img_size
-        self.stride = stride
-        self.flag = True
+        self.img_size = a['img_size']
+        self.stride = a['stride']
+        self.auto = a['auto']
+        self.preview = a['preview'] # 表示スレッド(preview.Preview)。Noneなら従来通りここでwaitKeyする
+        self.tracer = a['tracer'] if a['tracer'] is not None else NULL_TRACER # 区間の記録(tracer.Tracer)。Noneなら記録しない
+        self.t_yield = 0 # 前回画像を返した時刻（検出側の処理時間の記録用）
+        self.flag = True # 複数開いたカメラスレッドを閉じるためのフラグ
         self.rbt_flag = False # デバイスロストなどで自動的に自分を止める（再起動要否の目印）フラグ
-        self.bubun = 40 # 前と新しい画像の比較に使う四角形部分の一辺のピクセル数 ★必ず偶数にすること！！！
         self.bad_cam = "" # デバイスロストしたカメラの位置情報を渡す変数
 
+        sources = a['sources']
         if os.path.isfile(sources):
             with open(sources) as f:
                 sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip()) and x[0] != '#']
         else:
             sources = [sources]
-
         print(sources)
         n = len(sources)
-        try:
-            # TISカメラのためにimportする
-            import ctypes
-            import tisgrabber as tis
-        except:
-            print('tisgrabber is not installed. Please check !')
-            sys.exit(0)
-        self.imgs, self.frames, self.threads = [None] * 4, [0] * n, [None] * n
+        slots = n if slots is None else slots
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
-        self.auto = auto
+        self.imgs, self.frames, self.threads = [None] * slots, [0] * n, [None] * n
+        self.caps = [None] * n # 取込スレッドが使っているカメラ（close() で開放する）
+        self.fps = fps if fps is not None else [0] * n
+
+        self.policy, self.depth = a['policy'], a['depth'] # 取込スレッドから検出ループへの受け渡し方（frame_queue.FrameQueue参照）
+        self.queues = [None] * slots # カメラごとの受け渡しキュー。開けなかったカメラはNoneのまま
+        self.buffers = max(1, int(a['buffers'])) # 返す画像のバッファ数。返した画像は次の buffers-1 回の __next__ の間は書き換えない
+        self.nout = 0 # 何回画像を返したか（使うバッファの番号）
+        # rate_control='skip' / 'device' で、検出側が取りに来る速さに合わせて取込側の仕事を減らす（rate_control.RateController）
+        # カメラのFPSが開くまで分からない時は、全部開いてから reset する
+        self.rate = RateController(fps or 1000, slots, a['rate_control']) if a['rate_control'] else None
+        self.blackbox = a['blackbox'] # 取り込んだ画像を残すブラックボックス(blackbox.BlackBox)。Noneなら残さない
+        # quality=N で取込スレッドが N 枚に1回、明るさ・白飛び・ピントなどを測る（quality.QualityMonitor。dataset.quality.stats で読む）
+        quality = a['quality']
+        self.quality = (QualityMonitor(quality) if isinstance(quality, int) else quality).bind(slots) if quality else None
+        # 取込スレッドごとのCPUコアと優先度（affinity.pin_thread）。affinity='auto' でカメラiをコア i+1 に固定する
+        self.affinity, self.nice = plan_affinity(a['affinity'], slots), a['nice']
+        # incremental=True なら、前回から画像が変わったカメラのタイルだけ合成し直す（返す画像は同じ。写す分のコピーは増える）
+        self.incremental = a['incremental']
+        self.redrawn = 0 # 合成し直したタイルの枚数（差分合成の効果を見る用）
+        # schedule='auto' などで、合成画像と1台ずつ元の解像度で返すのを検出側の速さに合わせて切り替える（scheduler.Scheduler）
+        schedule = a.get('schedule')
+        self.schedule = Scheduler(schedule) if isinstance(schedule, str) else schedule
+        self.meta = None # 直前に返した画像に何が入っているか（kind: 'mosaic' / 'single' / 'batch', cams, sources, rects, shape）
+        self.singles = {} # 1台だけ返す時のバッファ（カメラの解像度ごと）
+        if 'hold' in a: # ウェブカメラ用ローダー
+            # 映像が切れたら別スレッドで開き直す（reconnect.Reconnector）。待ち時間は backoff=(最初, 最大) 秒で、失敗する度に倍にする
+            # hold='placeholder' なら切れている間は黒い画像、'last' なら最後に取れた画像を検出ループに渡し続ける
+            if a['hold'] not in HOLDS:
+                raise ValueError(f"unknown hold: {a['hold']} (choose from {HOLDS})")
+            self.links, self.hold, self.backoff = [None] * n, a['hold'], a['backoff']
+        return sources
+
+    def release_cap(self, i):
+        # カメラiを開放する。取込スレッドと close() のどちらが先に呼んでも1回だけ開放する
+        with _release_lock:
+            cap, self.caps[i] = self.caps[i], None
+        if cap is not None:
+            cap.release()
+
+    def close(self, timeout=2.0, close_library=False):
+        # 取込を止めてカメラを開放する。全てのスレッドが時間内に終わればTrue。何度呼んでもよい
+        self.flag = False
+        for link in getattr(self, 'links', ()): # 開き直しの待ちもやめる
+            if link is not None:
+                link.close()
+        deadline = time.perf_counter() + timeout
+        for t in self.threads:
+            if t is not None:
+                t.join(max(0.0, deadline - time.perf_counter()))
+        stuck = [i for i, t in enumerate(self.threads) if t is not None and t.is_alive()]
+        for i in stuck: # grab() から戻らないスレッド。カメラを先に開放すると待ちが解けることが多い
+            print(f'WARNING: Cam{i} の取込スレッドが {timeout} 秒で終わらないので、カメラを先に開放します')
+            self.release_cap(i)
+            self.threads[i].join(0.5)
+        mgr, self.tis_manager = getattr(self, 'tis_manager', None), None
+        if mgr is not None: # 全てのグラバーを返した後で（何度 close() しても1回だけ）
+            mgr.detach(close_library)
+        return not stuck
+
+    def restart(self, timeout=2.0):
+        # 同じ引数で開き直す（プロセスごと再起動するより速い）。TISはロードと初期化が済んだライブラリと、返したグラバーをそのまま使う
+        self.close(timeout)
+        self.__init__(**self.init_args)
+        return self
+
+    def mosaic_meta(self):
+        # 合成画像を返す時の self.meta。rects はタイルごとの (カメラ番号, x, y, w, h)
+        # layout に注目領域（layout.plan_rois）を渡した時は、rois にタイルごとの元の画像の範囲 (カメラ番号, x, y, w, h) が入る
+        cams = [i for i, q in enumerate(self.queues) if q is not None]
+        rois = self.plan.rois
+        ids = [r[0] for r in rois] if rois is not None else range(len(self.rects))
+        return {'kind': 'mosaic', 'cams': cams, 'sources': [self.sources[i] for i in cams],
+                'rects': [(i,) + tuple(rect) for i, rect in zip(ids, self.rects)], 'shape': self.plan.shape, 'rois': rois}
+
+    def single(self, i):
+        # schedule で今回はカメラiだけを返す時の __next__ の残り。縮小せずに返すバッファに写してletterboxする
+        im = self.imgs[i]
+        h, w = im.shape[:2]
+        if im.shape not in self.singles: # 返すバッファはカメラの解像度ごとに作って使い回す
+            self.singles[im.shape] = out_buffers(self.buffers, Layout((h, w), [(0, 0, w, h)], img_size=self.img_size))
+        outs, lbs = self.singles[im.shape]
+        b = self.nout % self.buffers
+        t = self.tracer.now()
+        img0 = self.concimg = outs[b]
+        np.copyto(img0, im) # 取込側のバッファは次の __next__ で書き換えられるので写しておく
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
+        img_lb = letterbox_into(img0, lbs[b])[0]
+        self.tracer.add('letterbox', t)
+        self.nout += 1
+        self.meta = {'kind': 'single', 'cams': [i], 'sources': [self.sources[i]], 'rects': [(i, 0, 0, w, h)], 'shape': (h, w), 'rois': None}
+        self.t_yield = self.tracer.now()
+        return self.meta['sources'], img_lb, img0, self.rbt_flag, self.bad_cam
+
+    def tile_map(self):
+        # 直前に返した画像の幾何マップ。タイルごとの (カメラ番号, モザイク, x, y, w, h, sx, sy, sw, sh) と合成画像の (H, W)
+        # (x, y, w, h) は合成画像の上の位置、(sx, sy, sw, sh) はそこに写した元の画像の範囲（注目領域が無ければ画像全体）
+        if len(self.rects[0]) == 5: # LoadT4Batch の rects は (モザイク, x, y, w, h)
+            rects, shape, rois = [(i,) + tuple(rect) for i, rect in enumerate(self.rects)], self.batches[0][0].shape[:2], None
+        else: # schedule で1台だけ返した時はそのカメラだけ
+            meta = self.meta or self.mosaic_meta()
+            rects, shape, rois = [(i, 0, x, y, w, h) for i, x, y, w, h in meta['rects']], meta['shape'], meta.get('rois')
+        tiles = []
+        for k, rect in enumerate(rects):
+            im = self.imgs[rect[0]]
+            if im is not None:
+                tiles.append(rect + (tuple(rois[k][1:]) if rois else (0, 0, im.shape[1], im.shape[0])))
+        return tiles, shape
+
+    def project(self, boxes, letterboxed=False, clip=True):
+        # 直前に返した画像の上の枠（検出結果）を、元のカメラ画像の座標に戻す
+        # boxes: (N, 4) の x1, y1, x2, y2。LoadT4Batch は (N, 5) で先頭がモザイクの番号。letterboxed=True ならletterbox後（モデル入力）の座標
+        # 戻り値: (N, 5) のカメラ番号と元画像上の x1, y1, x2, y2（float）。枠の中心が入っているタイルのカメラに戻す。どこにも入らない枠はカメラ番号 -1
+        # clip=True なら、そのタイルに写した元の画像の範囲の中に切り詰める
+        boxes = np.asarray(boxes, dtype=np.float64)
+        tiles, shape = self.tile_map()
+        batch = len(self.rects[0]) == 5
+        boxes = boxes.reshape(-1, 5 if batch else 4)
+        ms, xyxy = (boxes[:, 0].astype(int), boxes[:, 1:].copy()) if batch else (np.zeros(len(boxes), int), boxes.copy())
+        if letterboxed: # モデル入力の座標 → 合成画像の座標
+            r, _, _, (top, left) = letterbox_geometry(shape, (self.img_size, self.img_size))
+            xyxy = (xyxy - [left, top, left, top]) / r
+        out = np.full((len(boxes), 5), -1.0)
+        for n, (m, (x1, y1, x2, y2)) in enumerate(zip(ms, xyxy)):
+            cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+            for i, mi, x, y, w, h, sx, sy, sw, sh in tiles: # 枠の中心が入っているタイル
+                if mi == m and x <= cx < x + w and y <= cy < y + h:
+                    break
+            else:
+                continue
+            kx, ky = sw / w, sh / h # タイル → 元の画像の倍率
+            b = [sx + (x1 - x) * kx, sy + (y1 - y) * ky, sx + (x2 - x) * kx, sy + (y2 - y) * ky]
+            if clip:
+                b = np.clip(b, [sx, sy, sx, sy], [sx + sw, sy + sh, sx + sw, sy + sh])
+            out[n] = [i] + list(b)
+        return out
+
+    def crops(self, boxes, size=(224, 224), letterboxed=False, pad=0.0):
+        # 直前の __next__ で返した合成画像（schedule で1台だけ返した時はその画像）の上の枠から、その合成に使った元の解像度の画像を切り出して size=(w, h) に揃えて返す（2段目の分類用）
+        # 元の画像（self.imgs）は次の __next__ まで取込側に書き換えられないので、合成に使ったものと同じ画像から切り出せる
+        # boxes と letterboxed は project() と同じ。注目領域を並べた時も、切り出すのは元の画像なので領域の外の周りも入る
+        # pad: 枠の幅と高さに対して、周りを何割広げて切り出すか
+        # 戻り値: (N, h, w, 3) の画像と、(N, 5) のカメラ番号と元画像上の x1, y1, x2, y2。どのカメラのタイルにも入らない枠はカメラ番号 -1 で画像は黒
+        where = self.project(boxes, letterboxed, clip=False)
+        out = np.zeros((len(where), size[1], size[0], 3), dtype=np.uint8)
+        meta = np.full((len(where), 5), -1, dtype=np.int64)
+        for n, (i, x1, y1, x2, y2) in enumerate(where):
+            if i < 0:
+                continue
+            im = self.imgs[int(i)]
+            px, py = (x2 - x1) * pad / 2, (y2 - y1) * pad / 2
+            bx1, bx2 = [int(np.clip(round(v), 0, im.shape[1])) for v in (x1 - px, x2 + px)]
+            by1, by2 = [int(np.clip(round(v), 0, im.shape[0])) for v in (y1 - py, y2 + py)]
+            if bx2 <= bx1 or by2 <= by1:
+                continue
+            cv2.resize(im[by1:by2, bx1:bx2], size, dst=out[n], interpolation=cv2.INTER_LINEAR)
+            meta[n] = (i, bx1, by1, bx2, by2)
+        return out, meta
+
+    @property
+    def reconnects(self):
+        # カメラごとに、切れた映像を開き直せた回数（ウェブカメラ用ローダー）
+        return [link.reconnects if link is not None else 0 for link in getattr(self, 'links', [None] * len(self.caps))]
+
+    @property
+    def downtime(self):
+        # カメラごとに、映像が切れていた合計秒（今切れていればその分も含む）
+        return [link.downtime if link is not None else 0.0 for link in getattr(self, 'links', [None] * len(self.caps))]
+
+    def latency(self, q=50):
+        # カメラごとの、ドライバがフレームに時刻を付けてから取込スレッドが画像にするまでの ms（q パーセンタイル）
+        # backend='v4l2'（cam_backends.V4L2Capture）のように測れるキャプチャだけ。測れないカメラはNone
+        return [cap.latency(q) if hasattr(cap, 'latency') else None for cap in self.caps]
+
+    def temporal(self, k=8, flush=0.5, **kw):
+        # K 枚続けて取り込んだ合成画像を (K, H, W, 3) にまとめて返すイテレーター（temporal.TemporalBatcher）。録画の再生などで、モデルをバッチで回す時に
+        # for sources, imgs_lb, imgs, stamps, rbt_flag, bad in dataset.temporal(8): の形で使う
+        return TemporalBatcher(self, k, flush, **kw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+class LoadT4TISCams(LoaderControl):
+    # Tile
+    def __init__(self, sources='4TISCams.txt', img_size=640, stride=32, auto=True, preview=None, tracer=None, backend=None, size=(640, 480), policy='latest', depth=1, buffers=4, layout='fixed', pixel_format='RGB24', acquisition='snap', tis_lib=None, rate_control=None, blackbox=None, affinity=None, nice=None, incremental=False, schedule=None, quality=None):
+        sources = self.setup(locals(), fps=70)
+        self.bubun = 40 # 前と新しい画像の比較に使う四角形部分の一辺のピクセル数 ★必ず偶数にすること！！！
+        n = len(sources)
+        if backend is None and tis_lib is None: # 実際のTISカメラを使う
+            try:
+                # TISカメラのためにimportする
+                import tisgrabber as tis
+            except:
+                print('tisgrabber is not installed. Please check !')
+                sys.exit(0)
 
         self.cnt = 0 # maenoとnowの同一画像検出の回数カウンタ
         self.maeno = [None] * 4 # 比較用画像を保存する変数
@@ -82,14 +374,29 @@ class LoadT4TISCams:
         for i in range(4): # 初めに画像比較用の前の画像に当たるものを用意しておく
             self.maeno[i] = np.full((self.bubun, self.bubun, 3), (0, 255, 0), dtype=np.uint8)        
 
-        self.fps = 70
-        self.w = 640
-        self.h = 480 # temporary definition
-        vformat = "RGB24 ({0}x{1})".format(self.w, self.h) # カメラのビデオフォーマットを指定する定数
+        self.w, self.h = size # カメラ1台分の画素数
+        # 従来の合成画像は 800x600 の田の字 + 下に白い帯20。カメラ画像を置く位置 (x, y, w, h) は 左上, 右上, 右下, 左下 の順
+        # layout='auto' ならletterboxの余白が一番少ない並べ方にする（layout.plan_layout）
+        fixed = Layout((620, 800), [(0, 0, 400, 300), (400, 0, 400, 300), (400, 300, 400, 300), (0, 300, 400, 300)], [(600, 620)])
+        self.plan = choose_layout(layout, fixed, [(self.w, self.h)] * 4, img_size, stride)
+        self.rects = self.plan.rects
+        self.outs, self.lbs = out_buffers(self.buffers, self.plan)
+        # incremental=True の時に持ち続ける合成画像とそのletterbox、各タイルに書いた画像の番号
+        (self.canvas,), (self.lb_canvas,) = out_buffers(1, self.plan)
+        self.drawn = [None] * len(self.rects)
+        print(f'layout: {self.plan}')
+        # カメラのピクセル形式。RGB24 / Y800（モノクロ）/ BY8（ベイヤー）。カメラごとに変えるならリストで渡す
+        # Y800とBY8はUSBの帯域がRGB24の1/3で済む。BGRへの変換は取込スレッドで行う（cam_backends.PixelConverter）
+        self.pixel_formats = [pixel_format] * n if isinstance(pixel_format, str) else list(pixel_format)
         
-        ic = ctypes.cdll.LoadLibrary("./tisgrabber_x64.dll") # TISおまじない1
-        tis.declareFunctions(ic) # TISおまじない2
-        ic.IC_InitLibrary(0) # TISおまじない3
+        # acquisition='snap' は従来通り IC_SnapImage で1枚ずつ取る。'callback' はフレームが届く度にドライバから呼んでもらう
+        if acquisition not in ('snap', 'callback'):
+            raise ValueError(f"unknown acquisition: {acquisition} (choose from 'snap', 'callback')")
+        # TISのライブラリとグラバーはプロセスで共有する（tis_manager.TISManager）。ロードと初期化は1回だけで、他のローダーと同じカメラ一覧・グラバーを使う
+        # tis_lib は tisgrabberの代わり（(ic, tis) の組。tis_stub.load() など）
+        self.tis_manager = tis_manager.manager(tis_lib).attach() if backend is None else None # close() で detach する
+        self.ic, self.tis = (self.tis_manager.ic, self.tis_manager.tis) if backend is None else (None, None)
+        ic, tis = self.ic, self.tis
         hGrabber = [None] * 4 # カメラインスタンスを格納するリストを定義しておく
         # カメラの立上り順によるエラーを回避するために予め赤色の画面をカメラの数だけ用意しておく
         for i in range(4):  # index, source
@@ -101,10 +408,17 @@ class LoadT4TISCams:
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
             s = str(s)
-            hGrabber[i] = ic.IC_CreateGrabber()
-            ic.IC_OpenDevByUniqueName(hGrabber[i], tis.T(s)) # シリアルナンバーの指定も可能
-            ic.IC_SetVideoFormat(hGrabber[i], tis.T(vformat))
-            if (ic.IC_IsDevValid(hGrabber[i])): # カメラが開けたら
+            if backend is not None: # TIS以外のキャプチャ（疑似カメラ、録画の再生など）
+                cap = open_capture(s, backend, self.w, self.h, self.fps, self.pixel_formats[i])
+            else:
+                cap = None
+                vformat = "{0} ({1}x{2})".format(self.pixel_formats[i], self.w, self.h) # カメラのビデオフォーマットを指定する定数
+                # シリアルでグラバーを借りる。前のローダー（restart() 前の自分など）が返したグラバーはデバイスを開き直さずに使い回す
+                hGrabber[i], first = self.tis_manager.acquire(s, vformat)
+                if hGrabber[i] is not None and not first: # 他のローダーがライブで使っている
+                    # 設定とStartLiveは済んでいる。取り込むのはそのローダーのスレッド1本だけにして、配られる画像を受け取る
+                    cap = SharedCapture(self.tis_manager, hGrabber[i])
+            if cap is None and hGrabber[i] is not None and first: # カメラが開けたら
                 # 個別に設定するならここで分岐か？
                 # カメラの露光時間、FPS、ホワイトバランス、ゲインなどを設定する 
                 # fps: - 549 と Exposure ：0.000001 - 30.0              
@@ -122,14 +436,21 @@ class LoadT4TISCams:
                 ic.IC_SetPropertyAbsoluteValue(hGrabber[i], tis.T("WhiteBalance"), tis.T("White Balance Green"), ctypes.c_float(1.00))              
                 ic.IC_SetPropertyAbsoluteValue(hGrabber[i], tis.T("WhiteBalance"), tis.T("White Balance Blue"), ctypes.c_float(2.48))
                 # ここまででカメラパラメータ設定は終了
+                if acquisition == 'callback': # コールバックはStartLiveの前に登録する
+                    cap = TISCallbackCapture(ic, hGrabber[i], tis, ctypes, self.pixel_formats[i], manager=self.tis_manager)
+                else:
+                    cap = TISCapture(ic, hGrabber[i], tis, ctypes, self.pixel_formats[i], manager=self.tis_manager)
                 
                 # Start the live video stream, but show no own live video window. We will use OpenCV for this.
                 ic.IC_StartLive(hGrabber[i], 0) # 引数を「１」にするとライブ画像が開く。OpenCVでの描画をするので「０」とする。
                 #print('★★ic.IC_SnapImage(hGrabber[',i, ']: ', ic.IC_SnapImage(hGrabber[i])) #debugprint
 
+            if cap is not None and cap.isOpened():
                 # 連続取り込みのスレッドを起動する
-                self.threads[i] = Thread(target=self.update, args=([i, hGrabber[i], s, ic, ctypes, tis]), daemon=False)
-                print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} at {self.fps:.2f} FPS)")
+                self.queues[i] = FrameQueue(policy, depth, first=self.imgs[i], alive=lambda: self.flag)
+                self.caps[i] = cap
+                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), name=f'cam{i}', daemon=True) # 止める時は close() で待つ
+                print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} {self.pixel_formats[i]} at {self.fps:.2f} FPS)")
                 self.threads[i].start()
 
             else: # カメラが開けない時
@@ -137,52 +458,73 @@ class LoadT4TISCams:
         self.rect = True  # dummy code. rect inference if all shapes equal
 
 
-    def update(self, i, hGrabber, stream, ic, ctypes, tis):
+    def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
-        f, read = self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        Width = ctypes.c_long()
-        Height = ctypes.c_long()
-        BitsPerPixel = ctypes.c_int()
-        colorformat = ctypes.c_int()
-        while (ic.IC_IsDevValid(hGrabber)) and self.flag:
-            # かなり長い記述になるが以下self.imgs[i] = im までで画像をOpenCVに渡せる形で取得している
-            if ic.IC_SnapImage(hGrabber) == tis.IC_SUCCESS:
-                # Query values of image description
-                ic.IC_GetImageDescription(hGrabber, Width, Height, BitsPerPixel, colorformat)
-                # Calculate the buffer size
-                bpp = int(BitsPerPixel.value / 8.0)
-                buffer_size = Width.value * Height.value * BitsPerPixel.value
-                imagePtr = ic.IC_GetImagePtr(hGrabber)
-                imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_ubyte * buffer_size))
-                # Create the numpy array
-                im = np.ndarray(buffer=imagedata.contents, dtype=np.uint8, shape=(Height.value, Width.value, bpp))
-                im = cv2.flip(im, 0)
-                self.imgs[i] = im
+        if self.affinity[i] or self.nice is not None:
+            pin_thread(self.affinity[i], self.nice)
+        while cap.isOpened() and self.flag:
+            buf = None # 取込側で書き込むために借りたバッファ
+            t = self.tracer.now()
+            success = cap.grab()
+            self.tracer.add('snap', t, i)
+            if self.rate is not None:
+                self.rate.apply(i, cap) # rate_control='device' なら、カメラのFPSを検出側の速さに合わせる
+                if success and not self.rate.want(i):
+                    continue # 検出側が読みに来ない画像は変換しない
+            if success:
+                t = self.tracer.now()
+                buf = self.queues[i].buffer() # 空いているバッファに直接書き込む
+                success, im = cap.retrieve(buf) # TISはここで上下反転もする
+                self.tracer.add('flip', t, i)
+            if success:
+                if self.blackbox is not None:
+                    self.blackbox.put(i, im) # 障害の後で見返せるように残す（コピーして渡すだけで待たない）
+                self.queues[i].put(im, buf)
+                if self.quality is not None:
+                    self.quality.measure(i, im) # 受け渡した後で測る（測る間も検出側は待たない）
                 #time.sleep(1 / self.fps)  # wait timeはTISカメラでは不要
             
             else: # 画像が上手く取り込めなかったときの処理。メッセージを出してブルーバックにする。
                 print('WARNING: 画像が正常に取込めていません。　確認の上、プログラムを再起動して下さい。')
-                self.imgs[i] =  np.full((Height.value, Width.value, 3), (255, 0, 0), dtype=np.uint8)
+                self.queues[i].put(placeholder((self.h, self.w, 3), (255, 0, 0)), buf)
 
         # 何らかの理由でループを抜けてしまった場合もブルーバック画像とする。ここに来るのはEscで意識的に止めた時とic.IC_IsDevValid(hGrabber)がFalseの時。
         print('画像取込のループを抜けました。 Cam:', i)
-        self.imgs[i] =  np.full((Height.value, Width.value, 3), (255, 0, 0), dtype=np.uint8)
-        ic.IC_StopLive(hGrabber)
-        ic.IC_ReleaseGrabber(hGrabber)        
+        self.queues[i].put(placeholder((self.h, self.w, 3), (255, 0, 0)))
+        self.release_cap(i)
+
+    @property
+    def drops(self):
+        # カメラごとに受け渡しキューで捨てた枚数
+        return [q.drops if q is not None else 0 for q in self.queues[:len(self.sources)]]
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if cv2.waitKey(1) == ord('q') or self.rbt_flag: # q to quit 
+        self.tracer.add('yield', self.t_yield) # 前回画像を返してから今までが検出側の処理時間
+        if self.rate is not None:
+            self.rate.pulled() # 検出側が取りに来る速さを測る
+        if self.schedule is not None:
+            self.schedule.pulled()
+        if quit_key(self.preview) or self.rbt_flag: # q to quit 
             self.flag = False
-            cv2.destroyAllWindows()
+            if self.preview is None:
+                cv2.destroyAllWindows()
             raise StopIteration
 
+        for i, q in enumerate(self.queues): # 取込スレッドから次の画像を受け取る
+            if q is not None:
+                self.imgs[i] = q.get()
+
         self.now[0] = self.imgs[0][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]
         self.now[1] = self.imgs[1][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]   
         self.now[2] = self.imgs[2][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]
         self.now[3] = self.imgs[3][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)] 
+        if self.quality is not None: # カメラごとの止まっている判断を画質のチェックに渡す（止める判断は下の cnt のまま）
+            for k, q in enumerate(self.queues):
+                if q is not None:
+                    self.quality.stall(k, (self.now[k] == self.maeno[k]).all(), self.fps * 1)
         if (self.now[0] == self.maeno[0]).all() or (self.now[1] == self.maeno[1]).all() or (self.now[2] == self.maeno[2]).all() or (self.now[3] == self.maeno[3]).all():
             self.cnt +=1
             if self.cnt >= self.fps * 1 : # 画像が更新されないという判断が数秒続いたら…
@@ -199,55 +541,63 @@ class LoadT4TISCams:
         else:
             self.cnt = 0 # 比較結果が異なればカウンタをリセット
 
-        # ここで4つの画像を合成する
-        self.concimg = cv2.hconcat([self.imgs[0], self.imgs[1]])
-        conc2 = cv2.hconcat([self.imgs[3], self.imgs[2]])
-        self.concimg = cv2.vconcat([self.concimg, conc2])
-        self.concimg = cv2.resize(self.concimg, (800, 600), interpolation = cv2.INTER_AREA)
-        self.obi = np.full((20, 800, 3), (255, 255, 255), dtype=np.uint8)
-        self.concimg = cv2.vconcat([self.concimg, self.obi])
+        if self.schedule is not None: # 今回は1台だけ元の解像度で返すか
+            if not self.schedule.cams:
+                self.schedule.bind([i for i, q in enumerate(self.queues) if q is not None])
+            cam = self.schedule.next()
+            if cam is not None:
+                return self.single(cam)
+        if self.meta is None or self.meta['kind'] != 'mosaic':
+            self.meta = self.mosaic_meta()
+        t = self.tracer.now()
+        # ここで4つの画像を合成する。予め作ったバッファの self.rects の位置（従来は 左上, 右上, 右下, 左下）に縮小しながら直接書き込む
+        b = self.nout % self.buffers # 今回使うバッファ
+        if self.incremental: # 前回から画像が変わったカメラのタイルだけ、持ち続けている合成画像に書き直してから返すバッファに写す
+            keys = frame_keys(self.queues, self.imgs)
+            fresh = sum(d != key for d, key in zip(self.drawn, keys))
+            compose_into(self.canvas, self.imgs, self.rects, keys, self.drawn, self.plan.rois)
+            img0 = self.concimg = self.outs[b]
+            np.copyto(img0, self.canvas)
+        else:
+            fresh = len(self.rects)
+            img0 = self.concimg = compose_into(self.outs[b], self.imgs, self.rects, rois=self.plan.rois)
+        self.redrawn += fresh
+        for y0, y1 in self.plan.bands: # 動画情報を表示するための帯（前回書かれた文字を消す）
+            img0[y0:y1] = 255
         #self.concimg = np.expand_dims(self.concimg, axis=0) # CHW > BCHW 
 
-        self.maeno[0] = self.now[0] # 比較用画像の入れ替え
-        self.maeno[1] = self.now[1] # 比較用画像の入れ替え
-        self.maeno[2] = self.now[2] # 比較用画像の入れ替え
-        self.maeno[3] = self.now[3] # 比較用画像の入れ替え
+        for k in range(4): # 比較用画像の入れ替え（取込側のバッファは使い回されるので中身をコピーしておく）
+            np.copyto(self.maeno[k], self.now[k])
 
-        img0 = self.concimg.copy()
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
         # Letterbox
-        img_lb = letterbox(img0)[0] # letterbox関数から返ってきた画像部分のみ
+        if self.incremental: # 合成画像が変わった時だけletterboxし直す
+            if fresh:
+                letterbox_into(self.canvas, self.lb_canvas)
+            img_lb = self.lbs[b]
+            np.copyto(img_lb, self.lb_canvas)
+        else:
+            img_lb = letterbox_into(img0, self.lbs[b])[0] # letterbox関数から返ってきた画像部分のみ
+        self.tracer.add('letterbox', t)
+        self.nout += 1
 
+        self.t_yield = self.tracer.now()
         return self.sources, img_lb, img0, self.rbt_flag, self.bad_cam
 
-class LoadV4TISCams:
+class LoadV4TISCams(LoaderControl):
     # Vertical
-    def __init__(self, sources='V4TISCams.txt', img_size=640, stride=32, auto=True):
-        self.mode = 'stream'
-        self.img_size = img_size
-        self.stride = stride
-        self.flag = True
-        self.rbt_flag = False # デバイスロストなどで自動的に自分を止める（再起動要否の目印）フラグ
+    def __init__(self, sources='V4TISCams.txt', img_size=640, stride=32, auto=True, preview=None, tracer=None, backend=None, size=(720, 180), policy='latest', depth=1, buffers=4, layout='fixed', pixel_format='RGB24', acquisition='snap', tis_lib=None, rate_control=None, blackbox=None, affinity=None, nice=None, incremental=False, schedule=None, quality=None):
+        sources = self.setup(locals(), fps=70)
         self.bubun = 40 # 前と新しい画像の比較に使う四角形部分の一辺のピクセル数 ★必ず偶数にすること！！！
-        self.bad_cam = "" # デバイスロストしたカメラの位置情報を渡す変数
-
-        if os.path.isfile(sources):
-            with open(sources) as f:
-                sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip()) and x[0] != '#']
-        else:
-            sources = [sources]
-
-        print(sources)
         n = len(sources)
-        try:
-            # TISカメラのためにimportする
-            import ctypes
-            import tisgrabber as tis
-        except:
-            print('tisgrabber is not installed. Please check !')
-            sys.exit(0)
-        self.imgs, self.fps, self.frames, self.threads = [None] * 4, [0] * n, [0] * n, [None] * n
-        self.sources = [clean_str(x) for x in sources]  # clean source names for later
-        self.auto = auto
+        if backend is None and tis_lib is None: # 実際のTISカメラを使う
+            try:
+                # TISカメラのためにimportする
+                import tisgrabber as tis
+            except:
+                print('tisgrabber is not installed. Please check !')
+                sys.exit(0)
 
         self.cnt = 0 # maenoとnowの同一画像検出の回数カウンタ
         self.maeno = [None] * 4 # 比較用画像を保存する変数
@@ -255,14 +605,29 @@ class LoadV4TISCams:
         for i in range(4): # 初めに画像比較用の前の画像に当たるものを用意しておく
             self.maeno[i] = np.full((self.bubun, self.bubun, 3), (0, 255, 0), dtype=np.uint8)  
 
-        self.fps = 70
-        self.w = 720 #640
-        self.h = 180 #160 # temporary definition
-        vformat = "RGB24 ({0}x{1})".format(self.w, self.h) # カメラのビデオフォーマットを指定する定数　WDR機能を使うのでRGB64とした。
+        self.w, self.h = size # カメラ1台分の画素数 720x180 (640x160)
+        # 従来の合成画像は 上の帯20 + カメラ4台を縦に並べたもの + 下の帯20
+        # layout='auto' ならletterboxの余白が一番少ない並べ方にする（layout.plan_layout）
+        fixed = Layout((4 * self.h + 40, self.w), [(0, 20 + k * self.h, self.w, self.h) for k in range(4)], [(0, 20), (20 + 4 * self.h, 40 + 4 * self.h)])
+        self.plan = choose_layout(layout, fixed, [(self.w, self.h)] * 4, img_size, stride)
+        self.rects = self.plan.rects
+        self.outs, self.lbs = out_buffers(self.buffers, self.plan)
+        # incremental=True の時に持ち続ける合成画像とそのletterbox、各タイルに書いた画像の番号
+        (self.canvas,), (self.lb_canvas,) = out_buffers(1, self.plan)
+        self.drawn = [None] * len(self.rects)
+        print(f'layout: {self.plan}')
+        # カメラのピクセル形式。RGB24 / Y800（モノクロ）/ BY8（ベイヤー）。カメラごとに変えるならリストで渡す　WDR機能を使うのでRGB64とした。
+        # Y800とBY8はUSBの帯域がRGB24の1/3で済む。BGRへの変換は取込スレッドで行う（cam_backends.PixelConverter）
+        self.pixel_formats = [pixel_format] * n if isinstance(pixel_format, str) else list(pixel_format)
         
-        ic = ctypes.cdll.LoadLibrary("./tisgrabber_x64.dll") # TISおまじない1
-        tis.declareFunctions(ic) # TISおまじない2
-        ic.IC_InitLibrary(0) # TISおまじない3
+        # acquisition='snap' は従来通り IC_SnapImage で1枚ずつ取る。'callback' はフレームが届く度にドライバから呼んでもらう
+        if acquisition not in ('snap', 'callback'):
+            raise ValueError(f"unknown acquisition: {acquisition} (choose from 'snap', 'callback')")
+        # TISのライブラリとグラバーはプロセスで共有する（tis_manager.TISManager）。ロードと初期化は1回だけで、他のローダーと同じカメラ一覧・グラバーを使う
+        # tis_lib は tisgrabberの代わり（(ic, tis) の組。tis_stub.load() など）
+        self.tis_manager = tis_manager.manager(tis_lib).attach() if backend is None else None # close() で detach する
+        self.ic, self.tis = (self.tis_manager.ic, self.tis_manager.tis) if backend is None else (None, None)
+        ic, tis = self.ic, self.tis
         hGrabber = [None] * 4 # カメラインスタンスを格納するリストを定義しておく
         # カメラの立上り順によるエラーを回避するために予め赤色の画面をカメラの数だけ用意しておく
         for i in range(4):  # index, source
@@ -273,10 +638,18 @@ class LoadV4TISCams:
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
             s = str(s)
-            hGrabber[i] = ic.IC_CreateGrabber()
-            ic.IC_OpenDevByUniqueName(hGrabber[i], tis.T(s)) # シリアルナンバーの指定も可能
-            ic.IC_SetVideoFormat(hGrabber[i], tis.T(vformat))
-            if (ic.IC_IsDevValid(hGrabber[i])): # カメラが開けたら
+            if backend is not None: # TIS以外のキャプチャ（疑似カメラ、録画の再生など）
+                cap = open_capture(s, backend, self.w, self.h, self.fps, self.pixel_formats[i])
+            else:
+                cap = None
+                vformat = "{0} ({1}x{2})".format(self.pixel_formats[i], self.w, self.h) # カメラのビデオフォーマットを指定する定数
+                # シリアルでグラバーを借りる。前のローダー（restart() 前の自分など）が返したグラバーはデバイスを開き直さずに使い回す
+                # WDRは最後のローダーが返した時に manager が切る（他のローダーが使っている間は切らない）
+                hGrabber[i], first = self.tis_manager.acquire(s, vformat, resets={("Tone Mapping", "Enable"): 0})
+                if hGrabber[i] is not None and not first: # 他のローダーがライブで使っている
+                    # 設定とStartLiveは済んでいる。取り込むのはそのローダーのスレッド1本だけにして、配られる画像を受け取る
+                    cap = SharedCapture(self.tis_manager, hGrabber[i])
+            if cap is None and hGrabber[i] is not None and first: # カメラが開けたら
                 #ic.IC_printItemandElementNames(hGrabber[i])
                 # カメラの露光時間、FPS、ホワイトバランス、ゲインなどを設定する 
 
@@ -305,70 +678,97 @@ class LoadV4TISCams:
                 ic.IC_SetPropertyAbsoluteValue(hGrabber[i], tis.T("WhiteBalance"), tis.T("White Balance Green"), ctypes.c_float(1.00))              
                 ic.IC_SetPropertyAbsoluteValue(hGrabber[i], tis.T("WhiteBalance"), tis.T("White Balance Blue"), ctypes.c_float(2.48))
                 # ここまででカメラパラメータ設定は終了
+                if acquisition == 'callback': # コールバックはStartLiveの前に登録する
+                    cap = TISCallbackCapture(ic, hGrabber[i], tis, ctypes, self.pixel_formats[i], manager=self.tis_manager)
+                else:
+                    cap = TISCapture(ic, hGrabber[i], tis, ctypes, self.pixel_formats[i], manager=self.tis_manager)
                 
                 # Start the live video stream, but show no own live video window. We will use OpenCV for this.
                 ic.IC_StartLive(hGrabber[i], 0) # 引数を「１」にするとライブ画像が開く。OpenCVでの描画をするので「０」とする。
                 #print('★★ic.IC_SnapImage(hGrabber[',i, ']: ', ic.IC_SnapImage(hGrabber[i])) #debugprint
 
+            if cap is not None and cap.isOpened():
                 # 連続取り込みのスレッドを起動する
-                self.threads[i] = Thread(target=self.update, args=([i, hGrabber[i], s, ic, ctypes, tis]), daemon=False)
-                print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} at {self.fps:.2f} FPS)")
+                self.queues[i] = FrameQueue(policy, depth, first=self.imgs[i], alive=lambda: self.flag)
+                self.caps[i] = cap
+                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), name=f'cam{i}', daemon=True) # 止める時は close() で待つ
+                print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} {self.pixel_formats[i]} at {self.fps:.2f} FPS)")
                 self.threads[i].start()
 
             else: # カメラが開けない時
                 print(f'{st}Failed to open Cam {s}')
         self.rect = True  # dummy code. rect inference if all shapes equal
 
-    def update(self, i, hGrabber, stream, ic, ctypes, tis):
+    def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
-        f, read = self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        Width = ctypes.c_long()
-        Height = ctypes.c_long()
-        BitsPerPixel = ctypes.c_int()
-        colorformat = ctypes.c_int()
-        while (ic.IC_IsDevValid(hGrabber)) and self.flag:
-            # かなり長い記述になるが以下self.imgs[i] = im までで画像をOpenCVに渡せる形で取得している
-            if ic.IC_SnapImage(hGrabber) == tis.IC_SUCCESS:
-                # Query values of image description
-                ic.IC_GetImageDescription(hGrabber, Width, Height, BitsPerPixel, colorformat)
-                # Calculate the buffer size
-                bpp = int(BitsPerPixel.value / 8.0)
-                buffer_size = Width.value * Height.value * BitsPerPixel.value
-                imagePtr = ic.IC_GetImagePtr(hGrabber)
-                imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_ubyte * buffer_size))
-                # Create the numpy array
-                im = np.ndarray(buffer=imagedata.contents, dtype=np.uint8, shape=(Height.value, Width.value, bpp))
-                im = cv2.flip(im, 0)
-                self.imgs[i] = im
+        if self.affinity[i] or self.nice is not None:
+            pin_thread(self.affinity[i], self.nice)
+        while cap.isOpened() and self.flag:
+            buf = None # 取込側で書き込むために借りたバッファ
+            t = self.tracer.now()
+            success = cap.grab()
+            self.tracer.add('snap', t, i)
+            if self.rate is not None:
+                self.rate.apply(i, cap) # rate_control='device' なら、カメラのFPSを検出側の速さに合わせる
+                if success and not self.rate.want(i):
+                    continue # 検出側が読みに来ない画像は変換しない
+            if success:
+                t = self.tracer.now()
+                buf = self.queues[i].buffer() # 空いているバッファに直接書き込む
+                success, im = cap.retrieve(buf) # TISはここで上下反転もする
+                self.tracer.add('flip', t, i)
+            if success:
+                if self.blackbox is not None:
+                    self.blackbox.put(i, im) # 障害の後で見返せるように残す（コピーして渡すだけで待たない）
+                self.queues[i].put(im, buf)
+                if self.quality is not None:
+                    self.quality.measure(i, im) # 受け渡した後で測る（測る間も検出側は待たない）
                 #time.sleep(1 / self.fps)  # wait timeはTISカメラでは不要
             
             else: # 画像が上手く取り込めなかったときの処理。メッセージを出してブルーバックにする。
                 print('WARNING: 画像が正常に取込めていません。　確認の上、プログラムを再起動して下さい。')
-                self.imgs[i] =  np.full((Height.value, Width.value, 3), (255, 0, 0), dtype=np.uint8)
+                self.queues[i].put(placeholder((self.h, self.w, 3), (255, 0, 0)), buf)
                 #cap.open(stream)  # re-open stream if signal was lost         
 
         # 何らかの理由でループを抜けてしまった場合もブルーバック画像とする。ここに来るのはEscで意識的に止めた時とic.IC_IsDevValid(hGrabber)がFalseの時。
         print('画像取込のループを抜けました。 Cam:', i)
-        self.imgs[i] =  np.full((Height.value, Width.value, 3), (255, 0, 0), dtype=np.uint8)
-        ic.IC_StopLive(hGrabber)
-        ic.IC_SetPropertySwitch(hGrabber, tis.T("Tone Mapping"), tis.T("Enable"), 0)
-        ic.IC_ReleaseGrabber(hGrabber)        
+        self.queues[i].put(placeholder((self.h, self.w, 3), (255, 0, 0)))
+        self.release_cap(i) # WDRは最後のローダーが返した時に manager が切る
+
+    @property
+    def drops(self):
+        # カメラごとに受け渡しキューで捨てた枚数
+        return [q.drops if q is not None else 0 for q in self.queues[:len(self.sources)]]
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        self.tracer.add('yield', self.t_yield) # 前回画像を返してから今までが検出側の処理時間
+        if self.rate is not None:
+            self.rate.pulled() # 検出側が取りに来る速さを測る
+        if self.schedule is not None:
+            self.schedule.pulled()
         #if not all(x.isAlive() for x in self.threads) or cv2.waitKey(1) == 27: #ord('q'):  # q to quit
-        if cv2.waitKey(1) == ord('q') or self.rbt_flag: # q to quit 
+        if quit_key(self.preview) or self.rbt_flag: # q to quit 
             self.flag = False
-            cv2.destroyAllWindows()
+            if self.preview is None:
+                cv2.destroyAllWindows()
             raise StopIteration
 
+        for i, q in enumerate(self.queues): # 取込スレッドから次の画像を受け取る
+            if q is not None:
+                self.imgs[i] = q.get()
+
         # 比較用画像の切り出し
         self.now[0] = self.imgs[0][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]
         self.now[1] = self.imgs[1][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]   
         self.now[2] = self.imgs[2][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)]
         self.now[3] = self.imgs[3][int(self.h/2) - int(self.bubun/2):int(self.h/2) + int(self.bubun/2), int(self.w/2) - int(self.bubun/2):int(self.w/2) + int(self.bubun/2)] 
+        if self.quality is not None: # カメラごとの止まっている判断を画質のチェックに渡す（止める判断は下の cnt のまま）
+            for k, q in enumerate(self.queues):
+                if q is not None:
+                    self.quality.stall(k, (self.now[k] == self.maeno[k]).all(), self.fps * 1)
         if (self.now[0] == self.maeno[0]).all() or (self.now[1] == self.maeno[1]).all() or (self.now[2] == self.maeno[2]).all() or (self.now[3] == self.maeno[3]).all():
             self.cnt +=1
             if self.cnt >= self.fps * 1 : # 画像が更新されないという判断が数秒続いたら…
@@ -385,48 +785,57 @@ class LoadV4TISCams:
         else:
             self.cnt = 0 # 比較結果が異なればカウンタをリセット
             
-        # ここで4つの画像を合成する
-        self.concimg = cv2.vconcat([self.imgs[0], self.imgs[1]])
-        conc2 = cv2.vconcat([self.imgs[2], self.imgs[3]])
-        self.concimg = cv2.vconcat([self.concimg, conc2])
-        self.concimg = cv2.resize(self.concimg, (self.w, 4*self.h), interpolation = cv2.INTER_AREA)
-        self.obi = np.full((20, self.w, 3), (255, 255, 255), dtype=np.uint8)
-        self.concimg = cv2.vconcat([self.obi, self.concimg, self.obi])
+        if self.schedule is not None: # 今回は1台だけ元の解像度で返すか
+            if not self.schedule.cams:
+                self.schedule.bind([i for i, q in enumerate(self.queues) if q is not None])
+            cam = self.schedule.next()
+            if cam is not None:
+                return self.single(cam)
+        if self.meta is None or self.meta['kind'] != 'mosaic':
+            self.meta = self.mosaic_meta()
+        t = self.tracer.now()
+        # ここで4つの画像を合成する。予め作ったバッファの self.rects の位置（従来は上下の帯の間に上から順）に直接書き込む
+        b = self.nout % self.buffers # 今回使うバッファ
+        if self.incremental: # 前回から画像が変わったカメラのタイルだけ、持ち続けている合成画像に書き直してから返すバッファに写す
+            keys = frame_keys(self.queues, self.imgs)
+            fresh = sum(d != key for d, key in zip(self.drawn, keys))
+            compose_into(self.canvas, self.imgs, self.rects, keys, self.drawn, self.plan.rois)
+            img0 = self.concimg = self.outs[b]
+            np.copyto(img0, self.canvas)
+        else:
+            fresh = len(self.rects)
+            img0 = self.concimg = compose_into(self.outs[b], self.imgs, self.rects, rois=self.plan.rois)
+        self.redrawn += fresh
+        for y0, y1 in self.plan.bands: # 動画情報を表示するための帯（前回書かれた文字を消す）
+            img0[y0:y1] = 255
         #self.concimg = np.expand_dims(self.concimg, axis=0) # CHW > BCHW 
 
-        self.maeno[0] = self.now[0] # 比較用画像の入れ替え
-        self.maeno[1] = self.now[1] # 比較用画像の入れ替え
-        self.maeno[2] = self.now[2] # 比較用画像の入れ替え
-        self.maeno[3] = self.now[3] # 比較用画像の入れ替え
+        for k in range(4): # 比較用画像の入れ替え（取込側のバッファは使い回されるので中身をコピーしておく）
+            np.copyto(self.maeno[k], self.now[k])
 
-        img0 = self.concimg.copy()
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
         # Letterbox
-        img_lb = letterbox(img0)[0] # letterbox関数から返ってきた画像部分のみ
+        if self.incremental: # 合成画像が変わった時だけletterboxし直す
+            if fresh:
+                letterbox_into(self.canvas, self.lb_canvas)
+            img_lb = self.lbs[b]
+            np.copyto(img_lb, self.lb_canvas)
+        else:
+            img_lb = letterbox_into(img0, self.lbs[b])[0] # letterbox関数から返ってきた画像部分のみ
+        self.tracer.add('letterbox', t)
+        self.nout += 1
 
+        self.t_yield = self.tracer.now()
         return self.sources, img_lb, img0, self.rbt_flag, self.bad_cam
 
-class LoadT4Streams:
+class LoadT4Streams(LoaderControl):
     # for USB camera  Tile
-    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True):
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, preview=None, tracer=None, backend='dshow', size=(640, 480), policy='latest', depth=1, buffers=4, layout='fixed', rate_control=None, blackbox=None, affinity=None, nice=None, incremental=False, schedule=None, hold='placeholder', backoff=(0.5, 30.0), quality=None):
         global flag
-        self.mode = 'stream'
-        self.img_size = img_size
-        self.stride = stride
-        self.flag = True # 複数開いたカメラスレッドを閉じるためのフラグ
-        self.w = 640
-        self.h = 480
-
-        if os.path.isfile(sources):
-            with open(sources) as f:
-                sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip()) and x[0] != '#']
-        else:
-            sources = [sources]
-
-        print(sources)
+        sources = self.setup(locals())
         n = len(sources)
-        self.imgs, self.fps, self.frames, self.threads = [None] * 4, [0] * n, [0] * n, [None] * n
-        self.sources = [clean_str(x) for x in sources]  # clean source names for later
-        self.auto = auto
+        self.w, self.h = size # カメラ1台分の画素数
         # カメラの立ち上がり方次第でエラーを起こすことあるので、予め赤色の画面をカメラの数だけ用意しておく
         for i, s in enumerate(sources):  # index, source
             self.imgs[i] = np.full((self.h, self.w, 3), (0, 0, 255), dtype=np.uint8)
@@ -435,7 +844,7 @@ class LoadT4Streams:
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
             s = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
-            cap = cv2.VideoCapture(s + cv2.CAP_DSHOW)
+            cap = open_capture(s, backend, self.w, self.h, 30.0) # backend='dshow' は従来通り cv2.CAP_DSHOW で開く。Linuxは 'v4l2'
             #assert cap.isOpened(), f'{st}Failed to open {s}'
             w = self.w #int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = self.h #int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -444,8 +853,12 @@ class LoadT4Streams:
 
             if cap.isOpened():
                 _, self.imgs[i] = cap.read()  # guarantee first frame
-                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=False)
-                # threadsは、daemon=Trueで複数起動すると終了時にカメラを開放しなくなる。そのためdaemon=False（デフォ）とした。
+                self.queues[i] = FrameQueue(policy, depth, first=self.imgs[i], alive=lambda: self.flag)
+                self.caps[i] = cap
+                self.links[i] = Reconnector(cap, s, *self.backoff, name=f'Cam{i}')
+                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), name=f'cam{i}', daemon=True) # 止める時は close() で待つ
+                # 以前は終了時にカメラを開放させるためdaemon=Falseとしていたが、開放は close() が順番に行うのでdaemon=True。
+                # 止まった read() から戻らないスレッドがあってもプロセスを終われる
                 print(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
                 self.threads[i].start()
                 #print('** ', self.threads) # debug print
@@ -454,91 +867,146 @@ class LoadT4Streams:
                 self.imgs[i] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
 
         print('')  # newline
+        if self.rate is not None:
+            self.rate.reset(max(self.fps))
+        # 従来の合成画像は 800x600 の田の字（2台以下なら800x300の横並び）+ 下に白い帯20。位置 (x, y, w, h) は 左上, 右上, 左下, 右下 の順
+        # layout='auto' ならletterboxの余白が一番少ない並べ方にする（layout.plan_layout）
+        H = 620 if n > 2 else 320
+        fixed = Layout((H, 800), [(0, 0, 400, 300), (400, 0, 400, 300), (0, 300, 400, 300), (400, 300, 400, 300)][:n], [(H - 20, H)])
+        self.plan = choose_layout(layout, fixed, [(self.w, self.h)] * min(n, 4), img_size, stride)
+        self.rects = self.plan.rects
+        self.outs, self.lbs = out_buffers(self.buffers, self.plan)
+        # incremental=True の時に持ち続ける合成画像とそのletterbox、各タイルに書いた画像の番号
+        (self.canvas,), (self.lb_canvas,) = out_buffers(1, self.plan)
+        self.drawn = [None] * len(self.rects)
+        print(f'layout: {self.plan}')
 		
         self.rect = True #np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
 
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
+        if self.affinity[i] or self.nice is not None:
+            pin_thread(self.affinity[i], self.nice)
         n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        while cap.isOpened() and n < f and self.flag: # flagもループの条件に加えている
+        link = self.links[i]
+        while (cap.isOpened() or not link.live) and n < f and self.flag: # flagもループの条件に加えている
+            if not link.live: # 別スレッドで開き直している間はカメラに触らずに待つだけ（検出ループは止めない）
+                link.up.wait(0.1)
+                continue
             start_t = time.perf_counter()
             n += 1
             #_, self.imgs[i] = cap.read()
-            cap.grab()
-            if n % read == 0:
-                success, im = cap.retrieve()
+            t = self.tracer.now()
+            success = cap.grab()
+            self.tracer.add('snap', t, i)
+            if self.rate is not None:
+                self.rate.apply(i, cap) # rate_control='device' なら、カメラのFPSを検出側の速さに合わせる
+            if not success or (n % read == 0 and (self.rate is None or self.rate.want(i))): # 検出側が読みに来ない画像は変換しない
+                buf = None
+                if success: # 取込めなかった時は前の画像を返さないように retrieve しない
+                    t = self.tracer.now()
+                    buf = self.queues[i].buffer() # 空いているバッファに直接書き込む
+                    success, im = cap.retrieve(buf)
+                    self.tracer.add('retrieve', t, i)
                 if success:
-                    self.imgs[i] = im
-                else:
-                    print('WARNING: Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
-                    cap.open(stream)  # re-open stream if signal was lost
+                    if self.blackbox is not None:
+                        self.blackbox.put(i, im) # 障害の後で見返せるように残す（コピーして渡すだけで待たない）
+                    self.queues[i].put(im, buf)
+                    if self.quality is not None:
+                        self.quality.measure(i, im) # 受け渡した後で測る（測る間も検出側は待たない）
+                else: # 開き直しは別スレッドに任せて、ここでは待たない（以前はここで cap.open(stream) していた）
+                    if self.hold == 'placeholder':
+                        self.queues[i].put(placeholder(self.imgs[i].shape, (0, 0, 0)), buf)
+                        buf = None
+                    self.queues[i].hold(buf)
+                    link.lost()
+                    continue
             end_t = time.perf_counter()
-            print(str(i) + '　elapse time = {:.3f} Seconds'.format((end_t - start_t))) 
-            time.sleep(1 / self.fps[i])  # wait time
-        cap.release() # 無限ループから抜けたらカメラインスタンスを開放するのを忘れないこと！
+            #print(str(i) + '　elapse time = {:.3f} Seconds'.format((end_t - start_t))) 
+            if not getattr(cap, 'paced', False): # 録画の再生や疑似カメラは自分で速度を合わせるので待たない
+                time.sleep(1 / self.fps[i])  # wait time
+        self.release_cap(i) # 無限ループから抜けたらカメラインスタンスを開放するのを忘れないこと！
+
+    @property
+    def drops(self):
+        # カメラごとに受け渡しキューで捨てた枚数
+        return [q.drops if q is not None else 0 for q in self.queues[:len(self.sources)]]
 
     def __iter__(self):
         self.count = -1
         return self
 
     def __next__(self):
+        self.tracer.add('yield', self.t_yield) # 前回画像を返してから今までが検出側の処理時間
+        if self.rate is not None:
+            self.rate.pulled() # 検出側が取りに来る速さを測る
+        if self.schedule is not None:
+            self.schedule.pulled()
         self.count += 1
         #if not all(x.isAlive() for x in self.threads) or cv2.waitKey(1) == 27: #ord('q'):  # q to quit
-        if cv2.waitKey(1) == ord('q'):  # q to quit 
+        if quit_key(self.preview):  # q to quit 
             self.flag = False # 画像取込の無限ループを抜けるためフラグを書き換える
-            cv2.destroyAllWindows()          
+            if self.preview is None:
+                cv2.destroyAllWindows()
             raise StopIteration
 
+        for i, q in enumerate(self.queues): # 取込スレッドから次の画像を受け取る
+            if q is not None:
+                self.imgs[i] = q.get()
+
         #h, w, _ = self.imgs[0].shape # 画像のサイズを取込んでおく
-        # ここで4つの画像を合成する
-        if len(self.sources) == 1:
-            self.imgs[1] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
-        self.concimg = cv2.hconcat([self.imgs[0], self.imgs[1]])
-        if len(self.sources) > 2:
-            if len(self.sources) == 3:
-                self.imgs[3] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
-            conc2 = cv2.hconcat([self.imgs[2], self.imgs[3]])
-            self.concimg = cv2.vconcat([self.concimg, conc2])
-            self.concimg = cv2.resize(self.concimg, (800, 600), interpolation = cv2.INTER_AREA)
+        if self.schedule is not None: # 今回は1台だけ元の解像度で返すか
+            if not self.schedule.cams:
+                self.schedule.bind([i for i, q in enumerate(self.queues) if q is not None])
+            cam = self.schedule.next()
+            if cam is not None:
+                return self.single(cam)
+        if self.meta is None or self.meta['kind'] != 'mosaic':
+            self.meta = self.mosaic_meta()
+        t = self.tracer.now()
+        # ここで4つの画像を合成する。予め作ったバッファの self.rects の位置（従来は 左上, 右上, 左下, 右下）に縮小しながら直接書き込む（カメラの無い所は灰色のまま）
+        b = self.nout % self.buffers # 今回使うバッファ
+        if self.incremental: # 前回から画像が変わったカメラのタイルだけ、持ち続けている合成画像に書き直してから返すバッファに写す
+            keys = frame_keys(self.queues, self.imgs)
+            fresh = sum(d != key for d, key in zip(self.drawn, keys))
+            compose_into(self.canvas, self.imgs, self.rects, keys, self.drawn, self.plan.rois)
+            img0 = self.concimg = self.outs[b]
+            np.copyto(img0, self.canvas)
         else:
-            self.concimg = cv2.resize(self.concimg, (800, 300), interpolation = cv2.INTER_AREA)
-        self.obi = np.full((20, 800, 3), (255, 255, 255), dtype=np.uint8)
-        self.concimg = cv2.vconcat([self.concimg, self.obi])
+            fresh = len(self.rects)
+            img0 = self.concimg = compose_into(self.outs[b], self.imgs, self.rects, rois=self.plan.rois)
+        self.redrawn += fresh
+        for y0, y1 in self.plan.bands: # 動画情報を表示するための帯（前回書かれた文字を消す）
+            img0[y0:y1] = 255
         #self.concimg = np.expand_dims(self.concimg, axis=0) # CHW > BCHW 
 
-        img0 = self.concimg.copy()
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
         # Letterbox
-        img_lb = letterbox(img0)[0] # letterbox関数から返ってきた画像部分のみ
+        if self.incremental: # 合成画像が変わった時だけletterboxし直す
+            if fresh:
+                letterbox_into(self.canvas, self.lb_canvas)
+            img_lb = self.lbs[b]
+            np.copyto(img_lb, self.lb_canvas)
+        else:
+            img_lb = letterbox_into(img0, self.lbs[b])[0] # letterbox関数から返ってきた画像部分のみ
+        self.tracer.add('letterbox', t)
+        self.nout += 1
 
+        self.t_yield = self.tracer.now()
         return self.sources, img_lb, img0, self.rbt_flag, self.bad_cam
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
-class LoadV4Streams:
+class LoadV4Streams(LoaderControl):
     # for USB camera  Vertical
-    def __init__(self, sources='Vstreams.txt', img_size=640, stride=32, auto=True):
+    def __init__(self, sources='Vstreams.txt', img_size=640, stride=32, auto=True, preview=None, tracer=None, backend='dshow', size=(640, 480), policy='latest', depth=1, buffers=4, layout='fixed', rate_control=None, blackbox=None, affinity=None, nice=None, incremental=False, schedule=None, hold='placeholder', backoff=(0.5, 30.0), quality=None):
         global flag
-        self.mode = 'stream'
-        self.img_size = img_size
-        self.stride = stride
-        self.flag = True # 複数開いたカメラスレッドを閉じるためのフラグ
-
-        if os.path.isfile(sources):
-            with open(sources) as f:
-                sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip()) and x[0] != '#']
-        else:
-            sources = [sources]
-
-        print(sources)
+        sources = self.setup(locals())
         n = len(sources)
-        self.imgs, self.fps, self.frames, self.threads = [None] * 4, [0] * n, [0] * n, [None] * n
-        self.sources = [clean_str(x) for x in sources]  # clean source names for later
-        self.auto = auto
-        self.w = 640 #int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.w, full_h = size # カメラ1台分の画素数。full_hはクロップしない場合の縦画素数
         self.h = 160 #int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        full_h = 480 # クロップしない場合の縦画素数
         self.start_h = int((full_h - self.h) / 2)
         # 予め赤色の画面をカメラの数だけ用意しておく
         for i, s in enumerate(sources):  # index, source
@@ -548,7 +1016,7 @@ class LoadV4Streams:
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
             s = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
-            cap = cv2.VideoCapture(s + cv2.CAP_DSHOW)
+            cap = open_capture(s, backend, self.w, full_h, 30.0) # backend='dshow' は従来通り cv2.CAP_DSHOW で開く。Linuxは 'v4l2'
             #assert cap.isOpened(), f'{st}Failed to open {s}'
 
             self.fps[i] = max(cap.get(cv2.CAP_PROP_FPS) % 100, 0) or 30.0  # 30 FPS fallback
@@ -557,8 +1025,12 @@ class LoadV4Streams:
             if cap.isOpened():
                 _, im = cap.read()  # guarantee first frame
                 self.imgs[i] = im[self.start_h:(self.start_h + self.h), 0:self.w] # crop
-                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=False)
-                # threadsは、daemon=Trueで複数起動すると終了時にカメラを開放しなくなる。そのためdaemon=False（デフォ）とした。
+                self.queues[i] = FrameQueue(policy, depth, first=self.imgs[i], alive=lambda: self.flag)
+                self.caps[i] = cap
+                self.links[i] = Reconnector(cap, s, *self.backoff, name=f'Cam{i}')
+                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), name=f'cam{i}', daemon=True) # 止める時は close() で待つ
+                # 以前は終了時にカメラを開放させるためdaemon=Falseとしていたが、開放は close() が順番に行うのでdaemon=True。
+                # 止まった read() から戻らないスレッドがあってもプロセスを終われる
                 print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} at {self.fps[i]:.2f} FPS)")
                 self.threads[i].start()
                 #print('** ', self.threads) # debug print
@@ -567,63 +1039,325 @@ class LoadV4Streams:
                 self.imgs[i] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
 
         print('')  # newline
+        if self.rate is not None:
+            self.rate.reset(max(self.fps))
+        # 従来の合成画像はカメラを縦に並べたもの（2台以下なら2台分）+ 下に白い帯20
+        # layout='auto' ならletterboxの余白が一番少ない並べ方にする（layout.plan_layout）
+        H = (4 if n > 2 else 2) * self.h + 20
+        fixed = Layout((H, self.w), [(0, k * self.h, self.w, self.h) for k in range(min(n, 4))], [(H - 20, H)])
+        self.plan = choose_layout(layout, fixed, [(self.w, self.h)] * min(n, 4), img_size, stride)
+        self.rects = self.plan.rects
+        self.outs, self.lbs = out_buffers(self.buffers, self.plan)
+        # incremental=True の時に持ち続ける合成画像とそのletterbox、各タイルに書いた画像の番号
+        (self.canvas,), (self.lb_canvas,) = out_buffers(1, self.plan)
+        self.drawn = [None] * len(self.rects)
+        print(f'layout: {self.plan}')
         
         self.rect = True #np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
 
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
+        if self.affinity[i] or self.nice is not None:
+            pin_thread(self.affinity[i], self.nice)
         n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        while cap.isOpened() and n < f and self.flag: # flagもループの条件に加えている
+        frame = None # 取り込んだ画像（切り出す前）。このスレッド専用で使い回す
+        link = self.links[i]
+        while (cap.isOpened() or not link.live) and n < f and self.flag: # flagもループの条件に加えている
+            if not link.live: # 別スレッドで開き直している間はカメラに触らずに待つだけ（検出ループは止めない）
+                link.up.wait(0.1)
+                continue
             n += 1
             #_, self.imgs[i] = cap.read()
-            cap.grab()
-            if n % read == 0:
-                success, im = cap.retrieve()
+            t = self.tracer.now()
+            success = cap.grab()
+            self.tracer.add('snap', t, i)
+            if self.rate is not None:
+                self.rate.apply(i, cap) # rate_control='device' なら、カメラのFPSを検出側の速さに合わせる
+            if not success or (n % read == 0 and (self.rate is None or self.rate.want(i))): # 検出側が読みに来ない画像は変換しない
+                if success: # 取込めなかった時は前の画像を返さないように retrieve しない
+                    t = self.tracer.now()
+                    success, im = cap.retrieve(frame)
+                    self.tracer.add('retrieve', t, i)
                 if success:
-
-                    self.imgs[i] = im[self.start_h:(self.start_h + self.h), 0:self.w] # 取り込んだ画像の高さ方向で中心部分だけを使う
-                else:
-                    print('WARNING: Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
-                    cap.open(stream)  # re-open stream if signal was lost
-            time.sleep(1 / self.fps[i])  # wait time
-        cap.release() # 無限ループから抜けたらカメラインスタンスを開放するのを忘れないこと！
+                    frame = im
+                    crop = im[self.start_h:(self.start_h + self.h), 0:self.w] # 取り込んだ画像の高さ方向で中心部分だけを使う
+                    buf = self.queues[i].buffer() # 空いているバッファに切り出す
+                    if buf is None or buf.shape != crop.shape:
+                        buf = crop.copy()
+                    else:
+                        np.copyto(buf, crop)
+                    if self.blackbox is not None:
+                        self.blackbox.put(i, buf) # 障害の後で見返せるように残す（コピーして渡すだけで待たない）
+                    self.queues[i].put(buf)
+                    if self.quality is not None:
+                        self.quality.measure(i, buf) # 受け渡した後で測る（測る間も検出側は待たない）
+                else: # 開き直しは別スレッドに任せて、ここでは待たない（以前はここで cap.open(stream) していた）
+                    if self.hold == 'placeholder':
+                        self.queues[i].put(placeholder(self.imgs[i].shape, (0, 0, 0)))
+                    self.queues[i].hold()
+                    link.lost()
+                    continue
+            if not getattr(cap, 'paced', False): # 録画の再生や疑似カメラは自分で速度を合わせるので待たない
+                time.sleep(1 / self.fps[i])  # wait time
+        self.release_cap(i) # 無限ループから抜けたらカメラインスタンスを開放するのを忘れないこと！
+
+    @property
+    def drops(self):
+        # カメラごとに受け渡しキューで捨てた枚数
+        return [q.drops if q is not None else 0 for q in self.queues[:len(self.sources)]]
 
     def __iter__(self):
         self.count = -1
         return self
 
     def __next__(self):
+        self.tracer.add('yield', self.t_yield) # 前回画像を返してから今までが検出側の処理時間
+        if self.rate is not None:
+            self.rate.pulled() # 検出側が取りに来る速さを測る
+        if self.schedule is not None:
+            self.schedule.pulled()
         self.count += 1
         #if not all(x.isAlive() for x in self.threads) or cv2.waitKey(1) == 27: #ord('q'):  # q to quit
-        if cv2.waitKey(1) == 27: #ord('q'):  # q to quit 
+        if quit_key(self.preview, 27): #ord('q'):  # q to quit 
             self.flag = False # 画像取込の無限ループを抜けるためフラグを書き換える
-            cv2.destroyAllWindows()          
+            if self.preview is None:
+                cv2.destroyAllWindows()
             raise StopIteration
 
+        for i, q in enumerate(self.queues): # 取込スレッドから次の画像を受け取る
+            if q is not None:
+                self.imgs[i] = q.get()
+
         h, w, _ = self.imgs[0].shape # 画像のサイズを取込んでおく
-        # ここで4つの画像を合成する
-        if len(self.sources) == 1:
-            self.imgs[1] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
-        self.concimg = cv2.vconcat([self.imgs[0], self.imgs[1]])
-        if len(self.sources) > 2:
-            if len(self.sources) == 3:
-                self.imgs[3] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
-            conc2 = cv2.vconcat([self.imgs[2], self.imgs[3]])
-            self.concimg = cv2.vconcat([self.concimg, conc2])
-            self.concimg = cv2.resize(self.concimg, (self.w, 4*self.h), interpolation = cv2.INTER_AREA)
+        if self.schedule is not None: # 今回は1台だけ元の解像度で返すか
+            if not self.schedule.cams:
+                self.schedule.bind([i for i, q in enumerate(self.queues) if q is not None])
+            cam = self.schedule.next()
+            if cam is not None:
+                return self.single(cam)
+        if self.meta is None or self.meta['kind'] != 'mosaic':
+            self.meta = self.mosaic_meta()
+        t = self.tracer.now()
+        # ここで4つの画像を合成する。予め作ったバッファの self.rects の位置（従来は上から順）に直接書き込む（カメラの無い所は灰色のまま）
+        b = self.nout % self.buffers # 今回使うバッファ
+        if self.incremental: # 前回から画像が変わったカメラのタイルだけ、持ち続けている合成画像に書き直してから返すバッファに写す
+            keys = frame_keys(self.queues, self.imgs)
+            fresh = sum(d != key for d, key in zip(self.drawn, keys))
+            compose_into(self.canvas, self.imgs, self.rects, keys, self.drawn, self.plan.rois)
+            img0 = self.concimg = self.outs[b]
+            np.copyto(img0, self.canvas)
         else:
-            self.concimg = cv2.resize(self.concimg, (self.w, 2*self.h), interpolation = cv2.INTER_AREA)
-        self.obi = np.full((20, self.w, 3), (255, 255, 255), dtype=np.uint8)
-        self.concimg = cv2.vconcat([self.concimg, self.obi])
-        self.concimg = np.expand_dims(self.concimg, axis=0) # CHW > BCHW 
+            fresh = len(self.rects)
+            img0 = self.concimg = compose_into(self.outs[b], self.imgs, self.rects, rois=self.plan.rois)
+        self.redrawn += fresh
+        for y0, y1 in self.plan.bands: # 動画情報を表示するための帯（前回書かれた文字を消す）
+            img0[y0:y1] = 255
+        #self.concimg = np.expand_dims(self.concimg, axis=0) # CHW > BCHW 
 
-        img0 = self.concimg.copy()
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
         # Letterbox
-        img_lb = letterbox(img0)[0] # letterbox関数から返ってきた画像部分のみ
+        if self.incremental: # 合成画像が変わった時だけletterboxし直す
+            if fresh:
+                letterbox_into(self.canvas, self.lb_canvas)
+            img_lb = self.lbs[b]
+            np.copyto(img_lb, self.lb_canvas)
+        else:
+            img_lb = letterbox_into(img0, self.lbs[b])[0] # letterbox関数から返ってきた画像部分のみ
+        self.tracer.add('letterbox', t)
+        self.nout += 1
 
+        self.t_yield = self.tracer.now()
         return self.sources, img_lb, img0, self.rbt_flag, self.bad_cam
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
+
+class LoadT4Batch(LoaderControl):
+    # 台数制限なし。4台ずつ田の字に並べたモザイクをK枚、1つの連続した (K, H, W, 3) バッファにまとめて返す
+    # カメラiは必ず i//4 枚目のモザイクの i%4 番目のタイル（左上→右上→右下→左下）に入る。位置は self.rects で分かる
+    # 返す画像はbuffers個のバッファを順に使い回すので、buffers-1 回後の __next__ までに使い終わること（長く持つならコピーする）
+    POS = [(0, 0), (0, 1), (1, 1), (1, 0)] # タイル番号 → (行, 列)
+    POS_NAME = ["左上", "右上", "右下", "左下"]
+
+    def __init__(self, sources='batch.txt', img_size=640, stride=32, auto=True, preview=None, tracer=None, backend='dshow', size=(640, 480), policy='latest', depth=1, tile=(320, 240), buffers=4, rate_control=None, blackbox=None, affinity=None, nice=None, incremental=False, hold='placeholder', backoff=(0.5, 30.0), quality=None):
+        sources = self.setup(locals(), slots=None)
+        n = len(sources)
+        self.bubun = 40 # 前と新しい画像の比較に使う四角形部分の一辺のピクセル数 ★必ず偶数にすること！！！
+        self.w, self.h = size # カメラ1台分の画素数
+        self.tw, self.th = tile # モザイクの中のタイル1枚の画素数
+        self.k = (n + 3) // 4 # モザイクの枚数
+        self.cnt = 0 # maenoとnowの同一画像検出の回数カウンタ
+        self.maeno = [None] * n # 比較用画像を保存する変数
+
+        # カメラ → (モザイク番号, タイル番号) と、バッチの中の位置 (モザイク番号, x, y, w, h)
+        self.layout = [(i // 4, i % 4) for i in range(n)]
+        self.rects = [(m, self.POS[t][1] * self.tw, self.POS[t][0] * self.th, self.tw, self.th) for m, t in self.layout]
+        # 全モザイクを入れる1つの連続バッファをbuffers個。カメラの無いタイルは灰色のまま
+        self.batches = [np.full((self.k, 2 * self.th, 2 * self.tw, 3), 128, dtype=np.uint8) for _ in range(self.buffers)]
+        self.lbs = [np.full((self.k, img_size, img_size, 3), 114, dtype=np.uint8) for _ in range(self.buffers)]
+        self.batch = self.batches[0]
+        # incremental=True の時に持ち続けるモザイクとそのletterbox、各タイルに書いた画像の番号
+        self.canvas, self.lb_canvas = np.full_like(self.batches[0], 128), np.full_like(self.lbs[0], 114)
+        self.drawn = [None] * n
+
+        for i, s in enumerate(sources):  # index, source
+            self.imgs[i] = np.full((self.h, self.w, 3), (0, 0, 255), dtype=np.uint8) # 予め赤色の画面を用意しておく
+            self.maeno[i] = np.full((self.bubun, self.bubun, 3), (0, 255, 0), dtype=np.uint8)
+            # Start thread to read frames from video stream
+            st = f'{i + 1}/{n}: {s}... '
+            s = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
+            cap = open_capture(s, backend, self.w, self.h, 30.0)
+            self.fps[i] = max(cap.get(cv2.CAP_PROP_FPS) % 100, 0) or 30.0  # 30 FPS fallback
+            self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
+
+            if cap.isOpened():
+                self.queues[i] = FrameQueue(policy, depth, first=self.imgs[i], alive=lambda: self.flag)
+                self.caps[i] = cap
+                self.links[i] = Reconnector(cap, s, *self.backoff, name=f'Cam{i}')
+                self.threads[i] = Thread(target=self.update, args=([i, cap, s]), name=f'cam{i}', daemon=True) # 止める時は close() で待つ
+                print(f"{st} Success ({self.frames[i]} frames {self.w}x{self.h} at {self.fps[i]:.2f} FPS) -> mosaic {self.layout[i][0]} {self.POS_NAME[self.layout[i][1]]}")
+                self.threads[i].start()
+            else:
+                print(f'{st}Failed to open Cam {s}')
+                self.imgs[i] = np.full((self.h, self.w, 3), (128, 128, 128), dtype=np.uint8)
+
+        print('')  # newline
+        if self.rate is not None:
+            self.rate.reset(max(self.fps))
+        self.rect = True
+        # 返す画像に何が入っているか。並びは変わらないので最初に1回だけ作る（rects は (カメラ番号, モザイク, x, y, w, h)）
+        cams = [i for i, q in enumerate(self.queues) if q is not None]
+        self.meta = {'kind': 'batch', 'cams': cams, 'sources': [self.sources[i] for i in cams],
+                     'rects': [(i,) + tuple(self.rects[i]) for i in cams], 'shape': self.batches[0].shape[:3], 'rois': None}
+
+    def update(self, i, cap, stream):
+        # Read stream `i` frames in daemon thread
+        if self.affinity[i] or self.nice is not None:
+            pin_thread(self.affinity[i], self.nice)
+        n, f = 0, self.frames[i]
+        link = self.links[i]
+        misses = 0 # 続けて取り込めなかった回数
+        while (cap.isOpened() or not link.live) and n < f and self.flag:
+            if not link.live: # 別スレッドで開き直している間はカメラに触らずに待つだけ（検出ループは止めない）
+                link.up.wait(0.1)
+                continue
+            n += 1
+            buf = None # 取込側で書き込むために借りたバッファ
+            t = self.tracer.now()
+            success = cap.grab()
+            self.tracer.add('snap', t, i)
+            if self.rate is not None:
+                self.rate.apply(i, cap) # rate_control='device' なら、カメラのFPSを検出側の速さに合わせる
+                if success and not self.rate.want(i):
+                    continue # 検出側が読みに来ない画像は変換しない
+            if success:
+                t = self.tracer.now()
+                buf = self.queues[i].buffer() # 空いているバッファに直接書き込む
+                success, im = cap.retrieve(buf)
+                self.tracer.add('retrieve', t, i)
+            if success:
+                misses = 0
+                if self.blackbox is not None:
+                    self.blackbox.put(i, im) # 障害の後で見返せるように残す（コピーして渡すだけで待たない）
+                self.queues[i].put(im, buf)
+                if self.quality is not None:
+                    self.quality.measure(i, im) # 受け渡した後で測る（測る間も検出側は待たない）
+            elif misses < 2: # 時々の取りこぼしは従来通り黒い画像にする
+                misses += 1
+                print(f'WARNING: Cam{i} 画像が正常に取込めていません。')
+                self.queues[i].put(placeholder(self.imgs[i].shape, (0, 0, 0)), buf)
+            else: # 3回続けて取り込めなければ切れたと見なす。開き直しは別スレッドに任せて、ここでは待たない
+                misses = 0
+                if self.hold == 'placeholder':
+                    self.queues[i].put(placeholder(self.imgs[i].shape, (0, 0, 0)), buf)
+                    buf = None
+                self.queues[i].hold(buf)
+                link.lost()
+                continue
+            if not getattr(cap, 'paced', False): # 録画の再生や疑似カメラは自分で速度を合わせるので待たない
+                time.sleep(1 / self.fps[i])  # wait time
+        self.release_cap(i) # 無限ループから抜けたらカメラインスタンスを開放するのを忘れないこと！
+
+    @property
+    def drops(self):
+        # カメラごとに受け渡しキューで捨てた枚数
+        return [q.drops if q is not None else 0 for q in self.queues]
+
+    def __iter__(self):
+        self.count = -1
+        return self
+
+    def __next__(self):
+        self.tracer.add('yield', self.t_yield) # 前回画像を返してから今までが検出側の処理時間
+        if self.rate is not None:
+            self.rate.pulled() # 検出側が取りに来る速さを測る
+        self.count += 1
+        if quit_key(self.preview) or self.rbt_flag: # q to quit
+            self.flag = False # 画像取込の無限ループを抜けるためフラグを書き換える
+            if self.preview is None:
+                cv2.destroyAllWindows()
+            raise StopIteration
+
+        for i, q in enumerate(self.queues): # 取込スレッドから次の画像を受け取る
+            if q is not None:
+                self.imgs[i] = q.get()
+
+        # 比較用画像の切り出し。どれか1台でも画像が更新されない状態が続いたら止める
+        y0, x0 = int(self.h/2) - int(self.bubun/2), int(self.w/2) - int(self.bubun/2)
+        stale = None
+        for i, q in enumerate(self.queues):
+            now = self.imgs[i][y0:y0 + self.bubun, x0:x0 + self.bubun]
+            # 開き直している最中のカメラは数えない。画質のチェックにはカメラごとの判断を渡すので、全てのカメラを比べる
+            same = q is not None and self.links[i].live and (stale is None or self.quality is not None) and (now == self.maeno[i]).all()
+            if same and stale is None:
+                stale = i
+            if self.quality is not None and q is not None:
+                self.quality.stall(i, same, max(self.fps) * 1)
+            np.copyto(self.maeno[i], now) # 比較用画像の入れ替え（取込側のバッファは使い回されるので中身をコピーしておく）
+        if stale is not None:
+            self.cnt += 1
+            if self.cnt >= max(self.fps) * 1: # 画像が更新されないという判断が数秒続いたら…
+                self.flag = False
+                self.bad_cam = f"{self.layout[stale][0]}枚目の{self.POS_NAME[self.layout[stale][1]]}"
+                self.rbt_flag = True # 終了後、自分を再起動するフラグを立てる
+        else:
+            self.cnt = 0 # 比較結果が異なればカウンタをリセット
+
+        t = self.tracer.now()
+        # ここで各カメラの画像を縮小して、バッファの自分のタイルに直接書き込む
+        b = self.nout % self.buffers # 今回使うバッファ
+        img0 = self.batch = self.batches[b]
+        # incremental=True なら、前回から画像が変わったカメラのタイルだけ、持ち続けているモザイクに書き直してから返すバッファに写す
+        canvas = self.canvas if self.incremental else img0
+        keys = frame_keys(self.queues, self.imgs) if self.incremental else None
+        fresh = [False] * self.k # 書き直したタイルのあるモザイク
+        for i, (m, x, y, w, h) in enumerate(self.rects):
+            if keys is not None:
+                if self.drawn[i] == keys[i]:
+                    continue # 前回から画像が変わっていない
+                self.drawn[i] = keys[i]
+            compose_into(canvas[m], self.imgs[i:i + 1], [(x, y, w, h)])
+            fresh[m] = True
+            self.redrawn += 1
+        if self.incremental:
+            np.copyto(img0, canvas)
+        self.tracer.add('compose', t)
+        t = self.tracer.now()
+        # Letterbox
+        lb = self.lb_canvas if self.incremental else self.lbs[b]
+        for m in range(self.k): # モザイクごとにletterbox（書き直したタイルの無いモザイクはやり直さない）
+            if fresh[m]:
+                letterbox_into(canvas[m], lb[m])
+        img_lb = self.lbs[b]
+        if self.incremental:
+            np.copyto(img_lb, lb)
+        self.tracer.add('letterbox', t)
+        self.nout += 1
+
+        self.t_yield = self.tracer.now()
+        return self.sources, img_lb, img0, self.rbt_flag, self.bad_cam
+
+    def __len__(self):
+        return len(self.sources)
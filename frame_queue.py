@@ -0,0 +1,112 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+取込スレッドから検出ループへ画像を渡すためのキュー。ローダーの policy / depth 引数で選ぶ。
+usage :
+    dataset = LoadT4TISCams(source, policy='latest')            # 低遅延の検出用（従来通り最新だけ）
+    dataset = LoadT4TISCams(source, policy='block', depth=8)    # 1枚も捨てない（録画の検査など）
+    print(dataset.drops) # カメラごとに捨てた枚数
+"""
+
+from collections import deque
+from threading import Condition
+
+POLICIES = ('latest', 'drop_oldest', 'drop_newest', 'block')
+
+
+class FrameQueue:
+    # policy:
+    #   'latest'      : 最新1枚だけを置く（従来の self.imgs[i] の上書きと同じ）。検出ループは待たない
+    #   'drop_oldest' : 深さdepthのFIFO。満杯なら一番古いものを捨てる
+    #   'drop_newest' : 深さdepthのFIFO。満杯なら新しく来たものを捨てる
+    #   'block'       : 深さdepthのFIFO。満杯なら取込側が空くまで待つ（1枚も捨てない）
+    # FIFOの時、検出ループ側は次の1枚が来るまで最大timeout秒待ち、来なければ前回の画像をもう一度使う
+    # 取込側が hold() してから次に put() するまで（カメラを開き直している間など）は待たずに前回の画像を使う
+    # 取込側は buffer() で空きバッファを借りてそこに画像を書けば、毎フレーム新しい配列を作らずに済む。
+    # バッファは最初に put() された画像を（書き込み可能なものだけ）最大 depth + 3 枚まで預かって使い回す
+    def __init__(self, policy='latest', depth=1, first=None, timeout=1.0, alive=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown policy: {policy} (choose from {POLICIES})')
+        self.policy = policy
+        self.depth = 1 if policy == 'latest' else max(1, int(depth))
+        self.timeout = timeout
+        self.alive = alive or (lambda: True) # Falseを返したら 'block' の待ちをやめる（ローダー停止時）
+        self.q = deque()
+        self.last = first # 最後に検出ループへ渡した画像
+        self.puts = 0 # 取込側から来た枚数
+        self.drops = 0 # 捨てた枚数（'latest'では読まれずに上書きされた枚数）
+        self.seq = 0 # 検出ループへ渡した画像の番号。新しい画像を渡す度に1増える（同じ画像をもう一度渡す時は増えない）
+        self.idle = False # 取込側が止まっている（hold() された）
+        self.cond = Condition()
+        # キュー内の画像 + 検出ループが使っている1枚 + 取込側が書いている1枚 に余裕を1枚
+        self.pool_size = self.depth + 3
+        self.pool = [] # 使い回すバッファ（参照を持っておくためのリスト）
+        self.pooled = set() # そのid
+        self.free = deque() # 空いているバッファ
+
+    def buffer(self):
+        # 取込側が次の画像を書き込む空きバッファを返す。まだ無ければNone（その時は新しい配列を作ってputする）
+        with self.cond:
+            return self.free.popleft() if self.free else None
+
+    def recycle(self, im):
+        # 使い終わったバッファを空きに戻す（cond を持った状態で呼ぶ）
+        if im is not None and id(im) in self.pooled:
+            self.free.append(im)
+
+    def put(self, im, buf=None):
+        # 取込スレッドから呼ぶ。捨てたり置けなかったりしたらFalseを返す
+        # bufは buffer() で借りたバッファ。imに使われなかった時は空きに戻す
+        with self.cond:
+            if buf is not None and buf is not im:
+                self.recycle(buf)
+            if id(im) not in self.pooled and len(self.pool) < self.pool_size and im.flags.writeable and im.base is None:
+                self.pool.append(im) # 最初の何枚かを使い回し用のバッファとして預かる
+                self.pooled.add(id(im))
+            self.puts += 1
+            self.idle = False
+            if len(self.q) >= self.depth:
+                if self.policy in ('latest', 'drop_oldest'):
+                    self.recycle(self.q.popleft())
+                    self.drops += 1
+                elif self.policy == 'drop_newest':
+                    self.recycle(im)
+                    self.drops += 1
+                    return False
+                else: # block
+                    while len(self.q) >= self.depth:
+                        if not self.alive():
+                            self.recycle(im)
+                            return False
+                        self.cond.wait(0.1)
+            self.q.append(im)
+            self.cond.notify_all()
+            return True
+
+    def hold(self, buf=None):
+        # 取込側がしばらく画像を送れない時に呼ぶ。bufは buffer() で借りて使わなかったバッファ
+        with self.cond:
+            self.recycle(buf)
+            self.idle = True
+            self.cond.notify_all()
+
+    def get(self):
+        # 検出ループから呼ぶ。次の1枚（'latest'なら最新）を返す
+        with self.cond:
+            if not self.q and self.policy != 'latest' and not self.idle:
+                self.cond.wait_for(lambda: self.q or self.idle, self.timeout)
+            if self.q:
+                im = self.q.popleft()
+                if im is not self.last:
+                    self.recycle(self.last) # 前回渡した画像はもう使われないので空きに戻す
+                self.last = im
+                self.seq += 1
+                self.cond.notify_all()
+            return self.last
+
+    def wait(self, timeout=None):
+        # 次の画像が置かれるまで最大timeout秒待つ。置かれていればTrue（検出ループ以外が get() する時に使う。netcam.CaptureNode など）
+        with self.cond:
+            return bool(self.cond.wait_for(lambda: self.q, timeout))
+
+    def __len__(self):
+        return len(self.q)
@@ -0,0 +1,143 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+カメラの並べ方（合成画像のレイアウト）を決める。letterboxの灰色の余白が一番少なくなる並べ方を選ぶ。
+usage :
+    plan = plan_layout([(720, 180)] * 4, img_size=640, stride=32, band=20)
+    print(plan) # 4x1 620x155 -> 640x640, 93.8% real pixels（行x列。縦に4段）
+    dataset = LoadV4TISCams(source, layout='auto') # ローダーの中でこれを使う
+    plan = plan_rois([[(100, 80, 200, 160), (420, 300, 160, 120)]] * 4, [(640, 480)] * 4) # カメラごとの注目領域だけを元の解像度で詰める
+    dataset = LoadT4TISCams(source, layout=[[(100, 80, 200, 160), (420, 300, 160, 120)]] * 4) # ローダーに領域のリストを渡しても同じ
+"""
+
+import math
+
+
+def real_pixels(shape, rects, img_size=640):
+    # 合成画像 shape=(H, W) を img_size 四方にletterboxした時、カメラ画像が占める割合（0～1）
+    H, W = shape[:2]
+    r = min(img_size / H, img_size / W)
+    return sum(w * h for x, y, w, h in rects) * r * r / (img_size * img_size)
+
+
+class Layout:
+    # 合成画像のレイアウト。rects[i] = カメラiを置く位置 (x, y, w, h)、shape = 合成画像の (H, W)
+    # bands = 動画情報を表示する白い帯の行範囲 [(y0, y1)]、img_size = letterbox後の一辺、fill = モデル入力のうちカメラ画像の割合
+    # grid = (行, 列)、cell = タイル1枚の (w, h)。plan_layout() が選んだ時だけ入る
+    # rois = plan_rois() が作った時だけ入る。rects[k] に写す元の画像の範囲 (カメラ, x, y, w, h)。scale はその時の倍率
+    def __init__(self, shape, rects, bands=(), img_size=640, grid=None, cell=None, rois=None, scale=None):
+        self.shape = tuple(shape[:2])
+        self.rects = list(rects)
+        self.bands = list(bands)
+        self.img_size = img_size
+        self.grid, self.cell = grid, cell
+        self.rois, self.scale = (list(rois), scale) if rois is not None else (None, None)
+        self.fill = real_pixels(self.shape, self.rects, img_size)
+
+    def __repr__(self):
+        s = f'{self.grid[0]}x{self.grid[1]} {self.cell[0]}x{self.cell[1]} -> ' if self.grid else ''
+        if self.rois is not None:
+            s = f'{len(self.rois)} ROIs at {self.scale:.2f}x -> '
+        return s + f'{self.shape[1]}x{self.shape[0]}, {self.fill * 100:.1f}% real pixels'
+
+
+def plan_layout(sizes, img_size=640, stride=32, band=20):
+    # sizes: カメラごとの (w, h)。全ての 行x列 の並べ方を試して、カメラ画像の割合が一番大きいものを返す
+    # タイルの大きさは一番大きいカメラに合わせ、各カメラは縦横比を保ってタイルに収まるように縮小する
+    # 合成画像は縦横ともstrideの倍数で、長い方が img_size になるので、letterboxで拡大縮小はされない
+    # 短い方は letterbox が img_size 四方まで灰色で埋める（例: 640x480 4台は 2x2 640x512 -> 640x640、75.0%）。
+    # その余白とタイルの隙間を合わせた、モデル入力のうちカメラ画像でない部分が一番小さくなる並べ方を選ぶ
+    n = len(sizes)
+    cw, ch = max(w for w, h in sizes), max(h for w, h in sizes)
+    best = None
+    for rows in range(1, n + 1):
+        cols = math.ceil(n / rows)
+        s = min(img_size / (cols * cw), (img_size - band) / (rows * ch))
+        tw, th = int(cw * s), int(ch * s)
+        if tw < 1 or th < 1:
+            continue
+        W = math.ceil(cols * tw / stride) * stride
+        H = math.ceil((rows * th + band) / stride) * stride
+        rects = []
+        for i, (w, h) in enumerate(sizes):
+            k = min(tw / w, th / h) # カメラごとの縮小率
+            rects.append(((i % cols) * tw, (i // cols) * th, int(w * k), int(h * k)))
+        bands = [(rows * th, H)] if band else [] # 下の余りは帯にする
+        plan = Layout((H, W), rects, bands, img_size, (rows, cols), (tw, th))
+        if best is None or plan.fill > best.fill + 1e-9:
+            best = plan
+    return best
+
+
+def shelf_pack(sizes, width, gap=0):
+    # (w, h) の四角形を高い順に、幅 width の棚に左から詰める。各四角形の (x, y) と使った (幅, 高さ) を返す。入らない物が有れば None
+    order = sorted(range(len(sizes)), key=lambda k: (-sizes[k][1], -sizes[k][0]))
+    pos = [None] * len(sizes)
+    x = y = shelf = used = 0
+    for k in order:
+        w, h = sizes[k]
+        if w > width:
+            return None
+        if x and x + w > width: # 次の棚へ
+            x, y, shelf = 0, y + shelf + gap, 0
+        pos[k] = (x, y)
+        x += w + gap
+        shelf = max(shelf, h)
+        used = max(used, x - gap)
+    return pos, (used, y + shelf)
+
+
+def plan_rois(rois, sizes, img_size=640, stride=32, band=20, gap=4):
+    # rois: カメラごとの注目領域 (x, y, w, h) のリスト（元の画像の画素。dictなら {カメラ番号: リスト}）、sizes: カメラごとの (w, h)
+    # 全ての領域を、できるだけ元の解像度のまま（入らなければ全部を同じ倍率で少しだけ縮めて）棚詰めで1枚の合成画像に並べる
+    # 棚の幅を変えて試し、倍率が一番大きく、その中でモデル入力の実画素の割合が一番大きいものを選ぶ。起動時に1回だけ計算する
+    # 合成画像は縦横ともstrideの倍数。img_sizeより小さければletterboxで拡大される
+    if isinstance(rois, dict):
+        rois = [rois.get(i, []) for i in range(len(sizes))]
+    src = []
+    for i, (cam_rois, (cw, ch)) in enumerate(zip(rois, sizes)):
+        for x, y, w, h in cam_rois or []:
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            x1, y1 = min(cw, int(x + w)), min(ch, int(y + h)) # カメラ画像の外は切り捨てる
+            if x1 <= x0 or y1 <= y0:
+                raise ValueError(f'ROI {(x, y, w, h)} of camera {i} is outside its {cw}x{ch} image')
+            src.append((i, x0, y0, x1 - x0, y1 - y0))
+    if not src:
+        raise ValueError('no ROI given')
+    H_max = img_size - band
+    best = None
+    for width in range(stride, img_size + 1, stride):
+        def fits(s):
+            packed = shelf_pack([(max(1, int(w * s)), max(1, int(h * s))) for _, _, _, w, h in src], width, gap)
+            return packed is not None and packed[1][1] <= H_max
+        lo, hi = (1.0, 1.0) if fits(1.0) else (0.0, 1.0)
+        for _ in range(20 if lo == 0.0 else 0): # 元の解像度で入らなければ、入る一番大きい倍率を二分探索
+            s = (lo + hi) / 2
+            lo, hi = (s, hi) if fits(s) else (lo, s)
+        if lo == 0.0:
+            continue
+        sizes_s = [(max(1, int(w * lo)), max(1, int(h * lo))) for _, _, _, w, h in src]
+        pos, (uw, uh) = shelf_pack(sizes_s, width, gap)
+        W = math.ceil(uw / stride) * stride
+        H = math.ceil((uh + band) / stride) * stride
+        rects = [(x, y, w, h) for (x, y), (w, h) in zip(pos, sizes_s)]
+        bands = [(uh, H)] if band else []
+        plan = Layout((H, W), rects, bands, img_size, rois=src, scale=lo)
+        if best is None or (round(lo, 3), plan.fill) > (round(best.scale, 3), best.fill + 1e-9):
+            best = plan
+    if best is None:
+        raise ValueError(f'ROIs do not fit into {img_size}x{H_max}')
+    return best
+
+
+def choose_layout(layout, fixed, sizes, img_size=640, stride=32):
+    # ローダーの layout 引数の解釈。'fixed' は従来の並べ方 fixed、'auto' は plan_layout()、Layoutを渡せばそれを使う
+    # カメラごとの注目領域のリスト（またはdict）を渡すと plan_rois() でその領域だけを並べる
+    if isinstance(layout, Layout):
+        return layout
+    if isinstance(layout, (list, tuple, dict)):
+        return plan_rois(layout, sizes, img_size, stride)
+    if layout == 'fixed':
+        return fixed
+    if layout == 'auto':
+        return plan_layout(sizes, img_size, stride)
+    raise ValueError(f"unknown layout: {layout} (choose from 'fixed', 'auto', a Layout or ROIs per camera)")
@@ -0,0 +1,402 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+カメラを繋いだPC（キャプチャノード）から、検出（推論）を行うPCへ、カメラごとの画像をTCPで送る。
+ノード側は今のローダーの取込スレッドをそのまま使い、検出側は backend='remote' で他のカメラと同じように合成する。
+usage :
+    python netcam.py 4TISCams.txt --loader T4TIS --port 5600 --encoding jpg    # ノード（カメラのPC）
+    python netcam.py streams.txt --loader T4Streams --backend synthetic --port 5601 --encoding delta
+
+    node = CaptureNode(LoadT4TISCams(source, preview=False), port=5600, encoding='jpg') # 同じことをプログラムから
+
+    # 検出側。sourcesファイルに tcp://ノード:ポート/カメラ番号 を並べる（複数のノードを混ぜてよい）
+    #   tcp://192.168.0.11:5600/0
+    #   tcp://192.168.0.12:5600/1
+    dataset = LoadT4Streams('remote.txt', backend='remote')
+    python bench.py --loaders T4Streams --cams 4 --net none raw jpg delta  # localhostで送り方を比べる
+"""
+
+import json
+import time
+import zlib
+import socket
+import struct
+import argparse
+from collections import deque
+from threading import Thread, Lock, Condition
+from urllib.parse import urlparse
+import cv2
+import numpy as np
+
+MAGIC = b'NCAM'
+# 1通分の頭: MAGIC, 種類, カメラ番号, カメラごとの通し番号, 時刻(time.time), 高さ, 幅, チャンネル数, 中身のバイト数
+HEADER = struct.Struct('<4sBHQdHHBI')
+KINDS = {'raw': 0, 'jpg': 1, 'delta': 2, 'key': 3, 'hello': 9}
+ENCODINGS = ('raw', 'jpg', 'delta')
+
+
+def recv_exact(sock, n):
+    # ちょうどnバイト受け取る。相手が切ったら ConnectionError
+    buf = bytearray(n)
+    view, got = memoryview(buf), 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if not k:
+            raise ConnectionError('node closed the connection')
+        got += k
+    return buf
+
+
+def pack(kind, cam, seq, t, shape, payload):
+    h, w = shape[:2]
+    c = shape[2] if len(shape) > 2 else 1
+    return HEADER.pack(MAGIC, KINDS[kind], cam, seq, t, h, w, c, len(payload))
+
+
+class CaptureNode:
+    # ローダーの受け渡しキュー（dataset.queues）から画像を受け取り、繋いできた検出側へ送る。ローダーの __next__（合成）は使わない
+    # カメラごとの受取スレッドは新しい画像を最新の置き場に写すだけ。送るのは繋いできた相手ごとの送信スレッドで、
+    # 前回送った後に来た一番新しい画像だけを送る。ネットワークが遅ければ間の画像は送らない（skipped）ので、遅れは溜まらない
+    # encoding: 'raw'（そのまま）、'jpg'（quality）、'delta'（前に送った画像とのXORをzlibで圧縮。key_every 枚ごとに画像そのもの）
+    def __init__(self, dataset, port=5600, host='', encoding='jpg', quality=80, key_every=30):
+        if encoding not in ENCODINGS:
+            raise ValueError(f'unknown encoding: {encoding} (choose from {ENCODINGS})')
+        self.dataset = dataset
+        self.encoding, self.quality, self.key_every = encoding, quality, key_every
+        self.cams = [i for i, q in enumerate(dataset.queues) if q is not None]
+        n = len(dataset.queues)
+        self.latest = [None] * n # カメラごとの最新の画像（写し）
+        self.spare = [None] * n # 次に写す置き場
+        self.seq = [0] * n # カメラごとの通し番号
+        self.stamp = [0.0] * n # 受け取った時刻
+        self.sent = [0] * n # 送った枚数（全ての相手の合計）
+        self.skipped = [0] * n # 送らずに飛ばした枚数
+        self.bytes = 0 # 送ったバイト数
+        self.t_encode = 0.0 # 圧縮に掛かった合計秒
+        self.clients = [] # 繋いでいる相手のアドレス
+        self.cond = Condition()
+        self.flag = True
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1] # port=0 なら空いているポートになる
+        self.threads = [Thread(target=self.pump, args=(i,), name=f'node-cam{i}', daemon=True) for i in self.cams]
+        self.threads.append(Thread(target=self.accept, name='node-accept', daemon=True))
+        for t in self.threads:
+            t.start()
+        print(f'capture node: {len(self.cams)} cameras on port {self.port} ({encoding})')
+
+    def pump(self, i):
+        # カメラiの受取スレッド
+        q = self.dataset.queues[i]
+        while self.flag:
+            if not q.wait(0.5):
+                continue
+            im = q.get()
+            if self.spare[i] is None or self.spare[i].shape != im.shape:
+                self.spare[i] = np.empty_like(im)
+            np.copyto(self.spare[i], im) # 取込側のバッファは使い回されるので写しておく
+            with self.cond:
+                self.latest[i], self.spare[i] = self.spare[i], self.latest[i]
+                self.seq[i] += 1
+                self.stamp[i] = time.time()
+                self.cond.notify_all()
+
+    def hello(self):
+        # 繋いだ時に最初に送る、カメラの一覧
+        info = {'cams': self.cams, 'sources': [self.dataset.sources[i] for i in self.cams],
+                'fps': [float(self.dataset.fps[i] if isinstance(self.dataset.fps, list) else self.dataset.fps) for i in self.cams]}
+        data = json.dumps(info).encode()
+        return pack('hello', 0, 0, time.time(), (0, 0, 0), data) + data
+
+    def accept(self):
+        self.server.settimeout(0.5)
+        while self.flag:
+            try:
+                conn, addr = self.server.accept()
+            except (socket.timeout, OSError):
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.serve, args=(conn, addr), name=f'node-send-{addr[0]}:{addr[1]}', daemon=True).start()
+
+    def encode(self, i, im, state):
+        # 1枚分の (種類, 中身)。state は相手ごとの delta の基準画像と、前の key からの枚数
+        if self.encoding == 'jpg':
+            ok, enc = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return 'jpg', enc.data
+        if self.encoding == 'raw':
+            return 'raw', im.reshape(-1).data
+        ref, since = state.get(i, (None, 0))
+        if ref is None or ref.shape != im.shape or since + 1 >= self.key_every:
+            state[i] = (im.copy(), 0)
+            return 'key', zlib.compress(im.reshape(-1).data, 1)
+        diff = np.bitwise_xor(im, ref) # 変わっていない画素は0になるので、よく縮む
+        np.copyto(ref, im)
+        state[i] = (ref, since + 1)
+        return 'delta', zlib.compress(diff.reshape(-1).data, 1)
+
+    def serve(self, conn, addr):
+        # 相手1つ分の送信スレッド。送り終わるまで次を送らないのが受け側の速さに合わせる仕組み（backpressure）
+        name = f'{addr[0]}:{addr[1]}'
+        self.clients.append(name)
+        print(f'capture node: {name} connected')
+        done = {i: self.seq[i] for i in self.cams} # 送った（または繋いだ時点の）通し番号
+        mine = {} # 送る画像の写し
+        state = {} # delta の基準
+        try:
+            conn.sendall(self.hello())
+            while self.flag:
+                with self.cond:
+                    self.cond.wait_for(lambda: not self.flag or any(self.seq[i] != done[i] for i in self.cams), 0.5)
+                    todo = []
+                    for i in self.cams:
+                        if self.seq[i] != done[i] and self.latest[i] is not None:
+                            if i not in mine or mine[i].shape != self.latest[i].shape:
+                                mine[i] = np.empty_like(self.latest[i])
+                            np.copyto(mine[i], self.latest[i])
+                            self.skipped[i] += self.seq[i] - done[i] - 1
+                            done[i] = self.seq[i]
+                            todo.append((i, self.seq[i], self.stamp[i]))
+                for i, seq, t in todo:
+                    t0 = time.perf_counter()
+                    kind, payload = self.encode(i, mine[i], state)
+                    self.t_encode += time.perf_counter() - t0
+                    conn.sendall(pack(kind, i, seq, t, mine[i].shape, payload))
+                    conn.sendall(payload)
+                    self.sent[i] += 1
+                    self.bytes += HEADER.size + len(payload)
+        except OSError as e:
+            print(f'capture node: {name} disconnected ({e})')
+        finally:
+            conn.close()
+            self.clients.remove(name)
+
+    def close(self):
+        self.flag = False
+        self.server.close()
+        with self.cond:
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(1.0)
+
+
+class NodeClient:
+    # 検出側からノード1台への接続。同じノードのカメラ（RemoteCapture）で1本の接続を共有する（NodeClient.get / put）
+    # 受信スレッドは来た画像をカメラごとの最新の置き場に入れるだけ。jpg/raw の展開は各カメラの取込スレッドの retrieve() で行う
+    # delta は順番に当てないと元に戻らないので、受信スレッドで基準画像に当てる
+    # 切れたら backoff=(最初, 最大) 秒の間隔（失敗する度に倍）で繋ぎ直し続ける
+    _clients = {}
+    _lock = Lock()
+
+    @classmethod
+    def get(cls, host, port):
+        with cls._lock:
+            client = cls._clients.get((host, port))
+            if client is None:
+                client = cls._clients[(host, port)] = cls(host, port)
+            client.users += 1
+            return client
+
+    @classmethod
+    def put(cls, client):
+        with cls._lock:
+            client.users -= 1
+            if client.users <= 0:
+                cls._clients.pop((client.host, client.port), None)
+                client.close()
+
+    def __init__(self, host, port, backoff=(0.2, 5.0), timeout=2.0):
+        self.host, self.port = host, port
+        self.backoff, self.timeout = backoff, timeout
+        self.users = 0
+        self.info = None # ノードから来たカメラの一覧（hello）
+        self.frames = {} # カメラ番号 → (種類, 中身, 通し番号, 時刻, 形)
+        self.refs = {} # カメラ番号 → delta を当てた画像
+        self.connects = 0 # 繋いだ回数
+        self.bytes = 0
+        self.cond = Condition()
+        self.connected = False
+        self.flag = True
+        self.sock = None
+        self.thread = Thread(target=self.run, name=f'netcam-{host}:{port}', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        delay = self.backoff[0]
+        while self.flag:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                self.sock.settimeout(None)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self.cond:
+                    self.refs.clear()
+                    self.connected = True
+                    self.connects += 1
+                    self.cond.notify_all()
+                delay = self.backoff[0]
+                self.receive()
+            except OSError as e: # 繋がらない・切れた
+                if self.connected and self.flag:
+                    print(f'WARNING: capture node {self.host}:{self.port} lost ({e}), reconnecting')
+            finally:
+                with self.cond:
+                    self.connected = False
+                    self.cond.notify_all()
+                if self.sock is not None:
+                    self.sock.close()
+            if self.flag:
+                time.sleep(delay)
+                delay = min(delay * 2, self.backoff[1])
+
+    def receive(self):
+        while self.flag:
+            magic, kind, cam, seq, t, h, w, c, n = HEADER.unpack(recv_exact(self.sock, HEADER.size))
+            if magic != MAGIC:
+                raise ConnectionError('not a capture node')
+            payload = recv_exact(self.sock, n)
+            self.bytes += HEADER.size + n
+            shape = (h, w, c) if c > 1 else (h, w)
+            with self.cond:
+                if kind == KINDS['hello']:
+                    self.info = json.loads(payload)
+                elif kind in (KINDS['key'], KINDS['delta']):
+                    data = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(shape)
+                    ref = self.refs.get(cam)
+                    if kind == KINDS['key'] or ref is None or ref.shape != shape:
+                        self.refs[cam] = data.copy()
+                    else:
+                        np.bitwise_xor(ref, data, out=ref)
+                    self.frames[cam] = ('ref', None, seq, t, shape)
+                else:
+                    self.frames[cam] = ('raw' if kind == KINDS['raw'] else 'jpg', payload, seq, t, shape)
+                self.cond.notify_all()
+
+    def wait(self, cam, seq, timeout):
+        # カメラcamの通し番号 seq より新しい画像が来るまで待つ。来たらその (種類, 中身, 通し番号, 時刻, 形)
+        with self.cond:
+            ok = self.cond.wait_for(lambda: not self.flag or (cam in self.frames and self.frames[cam][2] != seq), timeout)
+            return self.frames[cam] if ok and self.flag else None
+
+    def close(self):
+        self.flag = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RemoteCapture:
+    # VideoCapture互換。source = 'tcp://ノード:ポート/カメラ番号'。ローダーの backend='remote' で使う
+    # grab() はそのカメラの次の画像が届くまで（最大timeout秒）待つ。届かなければFalse（ローダーは切れた時の処理をする）
+    # 繋ぎ直しは NodeClient が続けるので、open() は繋がるのを待つだけ
+    paced = True # grab() が次の画像を待つので、ローダー側で 1/fps 待たなくてよい
+
+    def __init__(self, source, w=640, h=480, fps=30, timeout=1.0, history=300):
+        url = urlparse(source)
+        if url.scheme != 'tcp' or not url.port:
+            raise ValueError(f'remote source must look like tcp://host:port/camera, got {source}')
+        self.cam = int(url.path.strip('/') or 0)
+        self.w, self.h, self.fps, self.timeout = w, h, fps, timeout
+        self.client = NodeClient.get(url.hostname, url.port)
+        self.opened = True
+        self.frame = None # grab() で受け取った分
+        self.seq = None # 最後に受け取った通し番号
+        self.stamp = None # その画像をノードが受け取った時刻
+        self.latencies = deque(maxlen=history) # ノードが受け取ってから、ここで画像になるまでの ms（時計の合っているPC同士でだけ意味がある）
+        self.open(source)
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        self.frame = self.client.wait(self.cam, self.seq, self.timeout)
+        if self.frame is None:
+            return False
+        self.seq, self.stamp = self.frame[2], self.frame[3]
+        return True
+
+    def retrieve(self, image=None):
+        if self.frame is None:
+            return False, None
+        kind, payload, seq, t, shape = self.frame
+        if kind == 'jpg':
+            im = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            im = image if image is not None and image.shape == shape else np.empty(shape, dtype=np.uint8)
+            if kind == 'raw':
+                np.copyto(im, np.frombuffer(payload, dtype=np.uint8).reshape(shape))
+            else:
+                with self.client.cond: # 受信スレッドが次の delta を当てないうちに写す
+                    np.copyto(im, self.client.refs[self.cam])
+        self.latencies.append((time.time() - t) * 1000)
+        return im is not None, im
+
+    def read(self, image=None):
+        if self.grab():
+            return self.retrieve(image)
+        return False, None
+
+    def latency(self, q=50):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    def get(self, prop):
+        shape = self.frame[4] if self.frame is not None else (self.h, self.w)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return shape[0]
+        if prop == cv2.CAP_PROP_FPS:
+            info = self.client.info
+            if info and self.cam in info['cams']:
+                return info['fps'][info['cams'].index(self.cam)]
+            return self.fps
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return (self.stamp or 0.0) * 1000
+        return 0.0 # CAP_PROP_FRAME_COUNT など。0は無限ストリーム扱い
+
+    def set(self, prop, value):
+        return False
+
+    def open(self, source=None):
+        # ノードに繋がるまで最大timeout秒待つ
+        with self.client.cond:
+            return self.client.cond.wait_for(lambda: self.client.connected, self.timeout)
+
+    def release(self):
+        if self.opened:
+            self.opened = False
+            NodeClient.put(self.client)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sources', type=str, nargs='?', default='4TISCams.txt', help='sources file of the local cameras')
+    parser.add_argument('--loader', type=str, default='T4TIS', choices=['T4TIS', 'V4TIS', 'T4Streams', 'V4Streams', 'T4Batch'])
+    parser.add_argument('--backend', type=str, default=None, help="capture backend of the loader ('synthetic', 'v4l2', ...)")
+    parser.add_argument('--size', type=str, default='640x480', help='camera resolution WxH')
+    parser.add_argument('--host', type=str, default='', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5600)
+    parser.add_argument('--encoding', type=str, default='jpg', choices=ENCODINGS)
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality')
+    parser.add_argument('--key-every', type=int, default=30, help='delta: send a full frame every N frames')
+    return parser.parse_args()
+
+
+def main(opt):
+    import cam_loader
+    loader = getattr(cam_loader, f'Load{opt.loader}' + ('Cams' if opt.loader.endswith('TIS') else ''))
+    kw = {} if opt.backend is None else {'backend': opt.backend}
+    w, h = (int(v) for v in opt.size.split('x'))
+    with loader(opt.sources, preview=False, size=(w, h), **kw) as dataset:
+        node = CaptureNode(dataset, opt.port, opt.host, opt.encoding, opt.quality, opt.key_every)
+        try:
+            while dataset.flag:
+                time.sleep(5)
+                print(f'clients {node.clients}, sent {node.sent}, skipped {node.skipped}, {node.bytes / 1e6:.1f} MB')
+        except KeyboardInterrupt:
+            pass
+        node.close()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
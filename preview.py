@@ -0,0 +1,266 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+usage :
+    preview = Preview('Cameras', fps=15, scale=0.5)
+    dataset = LoadV4TISCams(source, img_size=640, stride=32, auto=True, preview=preview)
+    for source, frame_lb, frame, rbt_flag, bad in dataset:
+        # ここでAIの処理など
+        preview.show(frame) # 最新の画像をコピーして置いていくだけ。表示を待たない
+        if preview.reboot:
+            break
+    preview.close()
+
+    web = WebPreview(port=8080, fps=10, scale=0.5) # ブラウザで http://このPC:8080/ を開く（/cam/0 でカメラ0だけ）
+    for source, frame_lb, frame, rbt_flag, bad in dataset:
+        web.show(frame, dataset.meta) # meta を渡すとカメラごとのページでそのタイルを切り出す（LoadT4Batch はモザイクを縦に並べて配信）
+    web.close()
+"""
+
+import re
+import time
+from threading import Thread, Lock, Condition
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+
+
+def spare(bufs, busy, frame):
+    # 表示用に預かるバッファ（2枚まで）から、別スレッドが使っている busy 以外の1枚を frame と同じ形で返す
+    # 大きさが変わった時だけ作り直すので、毎フレームの確保は無い
+    for k, buf in enumerate(bufs):
+        if buf is not busy:
+            if buf.shape != frame.shape or buf.dtype != frame.dtype:
+                bufs[k] = buf = np.empty_like(frame)
+            return buf
+    bufs.append(np.empty_like(frame))
+    return bufs[-1]
+
+
+class Preview:
+    # 表示専用スレッド。検出ループは show() で最新の画像を置くだけで、resize/imshow/waitKey は全てこのスレッドで行う。
+    # 表示が追いつかない分は上書きで捨てる（latest-only）ので、表示の遅さが検出ループに伝わらない。
+    def __init__(self, title='Cameras', fps=15, scale=0.5, quit_keys=(ord('q'), 27), reboot_keys=(ord('r'),)):
+        self.title = title
+        self.fps = fps # 表示の上限FPS。0なら上限なし
+        self.scale = scale # 表示倍率
+        self.quit_keys = quit_keys # 終了キー（q と Esc）
+        self.reboot_keys = reboot_keys # 再起動キー
+        self.quit = False # 終了キーが押されたら立つフラグ。ローダーはこれを見て止まる
+        self.reboot = False # 再起動キーが押されたら立つフラグ
+        self.flag = True # 表示スレッドを止めるためのフラグ
+        self.shown = 0 # 実際に表示した枚数
+        self.dropped = 0 # 表示されずに上書きされた枚数
+        self.frame = None # 最新画像1枚だけを置く場所（bufs のどちらか）
+        self.bufs = [] # show() でコピーしておくバッファ2枚。ローダーのバッファは次の呼び出しで上書きされるので参照は持たない
+        self.showing = None # 表示スレッドが使っているバッファ。show() はここには書かない
+        self.lock = Lock()
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def show(self, frame):
+        # 画像をコピーして直ちに戻る。前の画像がまだ表示されていなければ捨てる（同じバッファに上書きする）
+        with self.lock:
+            if self.frame is not None:
+                self.dropped += 1
+            buf = spare(self.bufs, self.showing, frame)
+            np.copyto(buf, frame)
+            self.frame = buf
+
+    def update(self):
+        interval = 1 / self.fps if self.fps else 0
+        while self.flag:
+            start_t = time.perf_counter()
+            with self.lock:
+                frame, self.frame = self.frame, None
+                if frame is not None:
+                    self.showing = frame # 次に取り出すまで show() に上書きさせない
+            if frame is not None:
+                if self.scale != 1.0:
+                    frame = cv2.resize(frame, dsize=None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+                cv2.imshow(self.title, frame)
+                self.shown += 1
+            # 次の表示時刻まで waitKey で待つ（待っている間もキー入力は受け付ける）
+            wait_ms = max(1, int((interval - (time.perf_counter() - start_t)) * 1000))
+            k = cv2.waitKey(wait_ms) & 0xFF
+            if k in self.quit_keys:
+                self.quit = True
+            elif k in self.reboot_keys:
+                self.reboot = True
+        cv2.destroyWindow(self.title)
+
+    def close(self, timeout=1.0):
+        # 表示スレッドを止めてウインドウを閉じる
+        self.flag = False
+        self.thread.join(timeout)
+
+
+class WebPreview:
+    # 監視用のMJPEG配信（標準ライブラリの http.server）。Preview と同じく show() で最新の画像を置くだけで、検出ループは待たない
+    #   /            : 配信の一覧
+    #   /stream      : 合成画像のMJPEG。?fps=5 でそのブラウザだけ間隔を落とせる（上限は fps）
+    #   /cam/<i>     : カメラiのタイルだけ（show() に meta を渡した時）
+    #   /snapshot.jpg: 今の合成画像1枚
+    # JPEG圧縮は専用スレッドで、見られている画像（合成画像・カメラ）ごとに1回だけ行い、全てのブラウザで共有する。見ている人がいなければ圧縮しない
+    # ブラウザごとの送信スレッドは、送り終わった時点で一番新しい画像だけを送る。遅いブラウザの分は古い画像を捨てる（dropped）
+    def __init__(self, port=8080, host='', fps=10, scale=0.5, quality=70, title='Cameras'):
+        self.fps, self.scale, self.quality, self.title = fps, scale, quality, title
+        self.quit = False # ローダーの終了判定（quit_key）と同じ形にしておく。ブラウザからは止めない
+        self.reboot = False
+        self.flag = True
+        self.frame, self.meta = None, None # 最新の画像（bufs のどちらか）と、その中身（ローダーの meta）
+        self.bufs = [] # show() でコピーしておくバッファ2枚（Preview と同じ）
+        self.encoding = None # 圧縮スレッドが使っているバッファ。show() はここには書かない
+        self.fresh = False # 最新の画像がまだ圧縮されていない
+        self.jpegs = {} # 見られている画像 → (番号, JPEG)
+        self.viewers = {} # 見られている画像 → 見ているブラウザの数
+        self.shown = 0 # show() された枚数
+        self.encoded = 0 # 圧縮した枚数
+        self.sent = 0 # ブラウザへ送った枚数（全てのブラウザの合計）
+        self.dropped = 0 # ブラウザが遅くて送らなかった枚数
+        self.seq = 0
+        self.cond = Condition()
+        web = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): # 1リクエストごとのログは出さない
+                pass
+
+            def do_GET(self):
+                web.handle(self)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1] # port=0 なら空いているポートになる
+        self.threads = [Thread(target=self.server.serve_forever, name='web-preview', daemon=True),
+                        Thread(target=self.encode, name='web-encode', daemon=True)]
+        for t in self.threads:
+            t.start()
+        print(f'web preview: http://localhost:{self.port}/')
+
+    def show(self, frame, meta=None):
+        # 画像をコピーして直ちに戻る。圧縮は専用スレッドで行う
+        with self.cond:
+            buf = spare(self.bufs, self.encoding, frame)
+            np.copyto(buf, frame)
+            self.frame, self.meta, self.fresh = buf, meta, True
+            self.shown += 1
+            self.cond.notify_all()
+
+    def view(self, name, frame, meta):
+        # 見られている画像 name（'mosaic' / 'cam<i>'）を frame から切り出す。無ければNone
+        # LoadT4Batch の画像は (モザイクの枚数, H, W, 3) で、rects は (カメラ番号, モザイク, x, y, w, h)。合成画像はモザイクを縦に並べる
+        if name == 'mosaic':
+            return cv2.vconcat(list(frame)) if frame.ndim == 4 else frame
+        cam = int(name[3:])
+        for rect in (meta or {}).get('rects', []):
+            if rect[0] == cam:
+                im = frame[rect[1]] if len(rect) == 6 else frame
+                x, y, w, h = rect[-4:]
+                return im[y:y + h, x:x + w]
+        return None
+
+    def encode(self):
+        # 圧縮スレッド。fps より速くは圧縮しない
+        interval = 1 / self.fps if self.fps else 0
+        while self.flag:
+            with self.cond:
+                self.cond.wait_for(lambda: not self.flag or (self.fresh and any(self.viewers.values())), 0.5)
+                if not (self.flag and self.fresh and any(self.viewers.values())):
+                    continue
+                frame, meta, self.fresh = self.frame, self.meta, False
+                self.encoding = frame # 次に取り出すまで show() に上書きさせない
+                names = [name for name, n in self.viewers.items() if n]
+            t = time.perf_counter()
+            out = {}
+            for name in names:
+                im = self.view(name, frame, meta)
+                if im is None:
+                    continue
+                if self.scale != 1.0:
+                    im = cv2.resize(im, dsize=None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+                ok, enc = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if ok:
+                    out[name] = enc.tobytes()
+            with self.cond:
+                self.seq += 1
+                for name, data in out.items():
+                    self.jpegs[name] = (self.seq, data)
+                self.encoded += len(out)
+                self.cond.notify_all()
+            time.sleep(max(0.0, interval - (time.perf_counter() - t)))
+
+    def handle(self, req):
+        # ブラウザ1つ分の処理（http.server のスレッドで呼ばれる）
+        url = urlparse(req.path)
+        m = re.fullmatch(r'/cam/(\d+)', url.path)
+        if url.path == '/':
+            body = (f'<html><head><title>{self.title}</title></head><body><h3>{self.title}</h3><img src="/stream"><p>'
+                    + ' '.join(f'<a href="/cam/{i}">cam{i}</a>' for i in self.cams()) + '</p></body></html>').encode()
+            req.send_response(200)
+            req.send_header('Content-Type', 'text/html; charset=utf-8')
+            req.send_header('Content-Length', str(len(body)))
+            req.end_headers()
+            req.wfile.write(body)
+        elif url.path in ('/stream', '/snapshot.jpg') or m:
+            self.stream(req, f'cam{m.group(1)}' if m else 'mosaic', url.path == '/snapshot.jpg', parse_qs(url.query))
+        else:
+            req.send_error(404)
+
+    def cams(self):
+        with self.cond:
+            return (self.meta or {}).get('cams', [])
+
+    def stream(self, req, name, once, query):
+        # MJPEG（multipart/x-mixed-replace）で送り続ける。once なら1枚だけ
+        try:
+            fps = max(0.0, float(query.get('fps', [0])[0])) # ?fps=N。0 や指定無し、数でない時は WebPreview の fps
+        except ValueError:
+            fps = 0.0
+        fps = min(fps, self.fps) if fps and self.fps else fps or self.fps
+        interval = 1 / fps if fps else 0
+        with self.cond:
+            self.viewers[name] = self.viewers.get(name, 0) + 1
+            self.fresh = self.fresh or self.frame is not None # 見始めた時に今の画像を圧縮させる
+            self.cond.notify_all()
+        try:
+            req.send_response(200)
+            req.send_header('Cache-Control', 'no-cache')
+            if once:
+                req.send_header('Content-Type', 'image/jpeg')
+            else:
+                req.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            req.end_headers()
+            last = 0
+            while self.flag:
+                t = time.perf_counter()
+                with self.cond: # 前に送ったものより新しい画像を待つ
+                    if not self.cond.wait_for(lambda: not self.flag or self.jpegs.get(name, (0,))[0] > last, 1.0):
+                        continue
+                    if not self.flag:
+                        break
+                    seq, data = self.jpegs[name]
+                    if last: # 数はブラウザごとのスレッドから足すのでロックの中で
+                        self.dropped += max(0, seq - last - 1)
+                last = seq
+                if once:
+                    req.wfile.write(data)
+                    break
+                req.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(data)).encode() + b'\r\n\r\n' + data + b'\r\n')
+                with self.cond:
+                    self.sent += 1
+                time.sleep(max(0.0, interval - (time.perf_counter() - t))) # このブラウザの上限FPS
+        except (BrokenPipeError, ConnectionResetError): # ブラウザが閉じられた
+            pass
+        finally:
+            with self.cond:
+                self.viewers[name] -= 1
+
+    def close(self, timeout=1.0):
+        self.flag = False
+        with self.cond:
+            self.cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        for t in self.threads:
+            t.join(timeout)
@@ -0,0 +1,115 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+カメラごとの画質の簡易チェック。取込スレッドの中で N 枚に1回、間引いた小さな画像で明るさ・白飛び/黒つぶれ・ピント（ラプラシアンの分散）・画像が止まっていないかを測る。
+ピンボケ、露出のずれ、レンズの汚れなどに、検出の精度が落ちる前に気づくため。ローダーの quality 引数で使う。
+止まっている判断はローダーのもの（TISローダーと LoadT4Batch の中央の切り出しの比較）をカメラごとに受け取って、再起動する前に警告する。
+usage :
+    dataset = LoadT4TISCams(source, quality=30)                                    # 30枚に1回測る
+    dataset = LoadT4Streams(source, quality=QualityMonitor(every=10, thresholds={'blur': 50}))
+    for sources, img_lb, img, rbt_flag, bad in dataset:
+        for i, s in enumerate(dataset.quality.stats):                              # カメラごとの最新の値（測っていなければNone）
+            if s and s['alerts']:
+                print(i, s['alerts'], s['brightness'], s['focus'])
+        print(dataset.quality.stalled)                                             # カメラごとの、ローダーが続けて同じ画像だと判断した回数
+    print(dataset.quality.cost)                                                    # カメラごとに、測るのに使ったCPU（1コアの何割か）
+    python bench.py --loaders T4Streams --cams 4 --quality 0 30 5                  # 測らない / 30枚に1回 / 5枚に1回 の比較
+"""
+
+import time
+import cv2
+import numpy as np
+
+# 警告の閾値。brightness は 0-255 の平均、clipped は 250以上か5以下の画素の割合、focus はラプラシアンの分散、frozen は測った画像が続けて同じだった回数
+# stalled はローダーの止まっている判断の回数が、ローダーが再起動する回数の何割になったら警告するか
+THRESHOLDS = {'dark': 30.0, 'bright': 225.0, 'clipped': 0.25, 'blur': 20.0, 'frozen': 5, 'stalled': 0.5}
+LEVELS = np.arange(256, dtype=np.float32)
+
+
+class QualityMonitor:
+    # 取込スレッドが画像を受け渡す度に measure(i, im) を呼ぶ。every 枚に1回だけ、幅 width 画素程度に間引いた灰色画像で測る
+    # 結果はカメラごとに新しい dict を作って stats[i] に入れ替える（入れ替えは1回の代入なので、読む側はロック無しで最新の組を読める）。入れ替えるのは measure() だけ
+    # CPUの上限: 1回測るのに dt 秒かかったら、次は dt / budget 秒後まで測らない（カメラ1台あたり1コアの budget 割まで）
+    def __init__(self, every=30, width=160, budget=0.02, thresholds=None):
+        self.every, self.width, self.budget = max(1, int(every)), width, budget
+        self.thresholds = dict(THRESHOLDS, **(thresholds or {}))
+        self.stats = [] # カメラごとの最新の値 {'t', 'frame', 'brightness', 'clipped', 'focus', 'frozen', 'stalled', 'alerts'}。まだ測っていなければNone
+        self.stalled = [] # カメラごとの、ローダーが続けて同じ画像だと判断した回数（stall() で受け取る）
+        self.limit = [] # カメラごとの、ローダーが再起動する回数
+        self.n = [] # カメラごとの受け取った枚数
+        self.t_next = [] # カメラごとに、次に測ってよい時刻（CPUの上限のため）
+        self.spent = [] # カメラごとの、測るのに使った合計秒
+        self.samples = [] # カメラごとの測った回数
+        self.work = [] # カメラごとの間引いた画像・灰色画像・ラプラシアン・前回の灰色画像（使い回す）
+        self.t0 = time.perf_counter()
+
+    def bind(self, n):
+        # ローダーからカメラの台数を渡す。restart() で同じものを渡されたら今までの値を続ける
+        while len(self.stats) < n:
+            for v, x in ((self.stats, None), (self.stalled, 0), (self.limit, 0), (self.n, 0), (self.t_next, 0.0), (self.spent, 0.0), (self.samples, 0), (self.work, None)):
+                v.append(x)
+        return self
+
+    @property
+    def cost(self):
+        # カメラごとの、測るのに使ったCPU（作ってからの経過時間に対する割合。1.0 で1コア分）
+        dt = max(time.perf_counter() - self.t0, 1e-9)
+        return [s / dt for s in self.spent]
+
+    @property
+    def ms(self):
+        # カメラごとの1回あたりの ms
+        return [1000 * s / k if k else 0.0 for s, k in zip(self.spent, self.samples)]
+
+    def stall(self, i, same, limit):
+        # ローダーの __next__ から毎回呼ぶ。same はカメラiの中央の切り出しが前回と同じだったか、limit はローダーが再起動する回数
+        # 数えるだけで stats[i] には書かない（stats[i] は取込スレッドの measure() だけが入れ替える。両方が古い組から作り直すと、片方の結果が消える）
+        # 回数と警告は次に measure() した時に stats[i] に入る。ここでは警告になった時に表示だけする
+        prev = self.stalled[i]
+        self.stalled[i], self.limit[i] = prev + 1 if same else 0, limit
+        if self._stalled(i) and not self._stalled(i, prev):
+            print(f'WARNING: Cam{i} image quality: stalled (the loader saw the same image {self.stalled[i]} times in a row, restarts at {limit})')
+
+    def _stalled(self, i, n=None):
+        # ローダーの止まっている判断が警告の回数に達しているか
+        n = self.stalled[i] if n is None else n
+        return bool(self.limit[i]) and n >= max(1, self.thresholds['stalled'] * self.limit[i])
+
+    def measure(self, i, im):
+        # 取込スレッドから呼ぶ。測らない回はすぐ戻る
+        self.n[i] += 1
+        if self.n[i] % self.every:
+            return
+        t = time.perf_counter()
+        if t < self.t_next[i]:
+            return
+        h, w = im.shape[:2]
+        step = max(1, w // self.width)
+        size = (w // step, h // step)
+        work = self.work[i]
+        if work is None or work[0].shape[:2] != size[::-1]:
+            work = self.work[i] = [None, None, None, None]
+        # 間引き（INTER_NEAREST は step 画素おきに拾うだけ）→ 灰色。作った配列は次から使い回す
+        work[0] = small = cv2.resize(im, size, dst=work[0], interpolation=cv2.INTER_NEAREST)
+        work[1] = gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=work[1]) if small.ndim == 3 else small.copy()
+        work[2] = lap = cv2.Laplacian(gray, cv2.CV_16S, dst=work[2])
+        hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() # 比較の配列を作らずに数える
+        brightness = float(hist @ LEVELS) / gray.size
+        clipped = float(hist[250:].sum() + hist[:6].sum()) / gray.size
+        focus = float(cv2.meanStdDev(lap)[1][0, 0] ** 2)
+        prev = self.stats[i]
+        frozen = prev['frozen'] + 1 if prev is not None and work[3] is not None and cv2.norm(gray, work[3], cv2.NORM_INF) == 0 else 0
+        work[1], work[3] = work[3], gray # 今回の灰色画像を次の比較用に取っておく
+        stalled = self.stalled[i] # 検出側の stall() が書き換えるので1回だけ読む
+        th = self.thresholds
+        alerts = tuple(name for name, bad in (('dark', brightness < th['dark']), ('bright', brightness > th['bright']),
+                                              ('clipped', clipped > th['clipped']), ('blur', focus < th['blur']),
+                                              ('frozen', frozen >= th['frozen']), ('stalled', self._stalled(i, stalled))) if bad)
+        if alerts and (prev is None or prev['alerts'] != alerts):
+            print(f'WARNING: Cam{i} image quality: {", ".join(alerts)} (brightness {brightness:.0f}, clipped {clipped:.0%}, focus {focus:.0f}, frozen {frozen}, stalled {stalled})')
+        self.stats[i] = {'t': t, 'frame': self.n[i], 'brightness': brightness, 'clipped': clipped, 'focus': focus, 'frozen': frozen,
+                         'stalled': stalled, 'alerts': alerts}
+        dt = time.perf_counter() - t
+        self.spent[i] += dt
+        self.samples[i] += 1
+        if self.budget:
+            self.t_next[i] = t + dt / self.budget
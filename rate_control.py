@@ -0,0 +1,76 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+検出ループが画像を取りに来る速さに合わせて、取込側の仕事を減らす。ローダーの rate_control 引数で使う。
+usage :
+    dataset = LoadT4TISCams(source, rate_control='skip')    # 読まれない画像は変換しない（カメラは80FPSのまま）
+    dataset = LoadT4TISCams(source, rate_control='device')  # カメラのFPS自体も下げる
+    print(dataset.rate.target, dataset.rate.skipped) # 今の目標FPSと、カメラごとに変換しなかった枚数
+"""
+
+import time
+import cv2
+
+MODES = ('skip', 'device')
+
+
+class RateController:
+    # __next__ の間隔から検出側の速さを測り（指数移動平均）、取込側の目標FPS = 検出側の速さ × headroom を決める
+    # 目標は、今の目標から band（割合）以上ずれた状態が hold 秒続いた時だけ変える（ヒステリシス）。上下に振動しないように
+    # mode='skip'   : 目標FPSより速く届いた画像は retrieve（変換・反転）せずに捨てる
+    # mode='device' : それに加えて、各取込スレッドでカメラのFPSを目標に合わせる（cap.set(cv2.CAP_PROP_FPS)）
+    def __init__(self, max_fps, n, mode='skip', headroom=1.25, band=0.2, hold=1.0, min_fps=1.0, alpha=0.1):
+        if mode not in MODES:
+            raise ValueError(f'unknown rate_control: {mode} (choose from {MODES})')
+        self.mode = mode
+        self.max_fps = max_fps # カメラの本来のFPS
+        self.headroom, self.band, self.hold, self.min_fps, self.alpha = headroom, band, hold, min_fps, alpha
+        self.target = max_fps # 取込側の目標FPS
+        self.version = 0 # 目標を変えた回数
+        self.interval = None # 検出側の画像を取りに来る間隔（平均）
+        self.t_pull = None # 前回取りに来た時刻
+        self.t_off = None # 目標からずれ始めた時刻
+        self.t_take = [0.0] * n # カメラごとに最後に変換した時刻
+        self.skipped = [0] * n # カメラごとに変換しなかった枚数
+        self.applied = [0] * n # カメラごとに、機器のFPSを合わせた時の version
+
+    def reset(self, max_fps):
+        # カメラの本来のFPSが後から分かった時（USBカメラは開くまで分からない）
+        self.max_fps = self.target = max_fps
+
+    @property
+    def demand(self):
+        # 検出側が画像を取りに来る速さ (1/秒)
+        return 1 / self.interval if self.interval else 0.0
+
+    def pulled(self):
+        # __next__ から呼ぶ
+        now = time.perf_counter()
+        if self.t_pull is not None:
+            dt = now - self.t_pull
+            self.interval = dt if self.interval is None else self.interval + self.alpha * (dt - self.interval)
+            want = min(self.max_fps, max(self.min_fps, self.demand * self.headroom))
+            if abs(want - self.target) > self.band * self.target:
+                if self.t_off is None:
+                    self.t_off = now
+                elif now - self.t_off >= self.hold: # ずれた状態が続いたら目標を変える
+                    self.target = want
+                    self.version += 1
+                    self.t_off = None
+            else:
+                self.t_off = None
+        self.t_pull = now
+
+    def want(self, i):
+        # 取込スレッドiから grab() の後に呼ぶ。この画像を変換して渡すならTrue。目標FPSより速く来た分はFalse
+        now = time.perf_counter()
+        if now - self.t_take[i] >= 0.9 / self.target: # 取込間隔の揺らぎの分だけ少し早めでも受け取る
+            self.t_take[i] = now
+            return True
+        self.skipped[i] += 1
+        return False
+
+    def apply(self, i, cap):
+        # 取込スレッドiから呼ぶ。mode='device' で目標が変わっていれば、カメラのFPSを変える
+        if self.mode == 'device' and self.applied[i] != self.version:
+            self.applied[i] = self.version
+            cap.set(cv2.CAP_PROP_FPS, self.target)
@@ -0,0 +1,87 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+IPカメラ（RTSPなど）の映像が切れた時に、取込スレッドを止めずに別スレッドで開き直す。ウェブカメラ用ローダーの中で使う。
+開き直しに失敗する度に待ち時間を倍にする（指数バックオフ）ので、ネットワークが戻るまで毎フレーム開き直すことはない。
+usage :
+    dataset = LoadT4Streams('rtsp.txt', backoff=(0.5, 30.0), hold='last') # 切れている間は最後に取れた画像のまま
+    print(dataset.reconnects, dataset.downtime) # カメラごとの開き直した回数と、切れていた合計秒
+"""
+
+import time
+from threading import Thread, Event
+
+HOLDS = ('placeholder', 'last')
+
+
+class Reconnector:
+    # カメラ1台分の状態:
+    #   'live'       : 取り込める。取込スレッドは retrieve() に失敗したら lost() を呼ぶ
+    #   'waiting'    : 次に開き直すまで delay 秒待っている
+    #   'connecting' : 開き直している（cap.open はネットワークのタイムアウトまで戻らないことがあるので、取込スレッドではなくここで呼ぶ）
+    # 開き直しに失敗したら delay を factor 倍にして（最大 max_delay 秒）また待つ。成功したら 'live' に戻り、delay は base に戻る
+    # 取込スレッドは live でない間は cap に触らず、up.wait() で戻るのを待つだけ
+    def __init__(self, cap, source, base=0.5, max_delay=30.0, factor=2.0, name='cam'):
+        self.cap, self.source, self.name = cap, source, name
+        self.base, self.max_delay, self.factor = base, max_delay, factor
+        self.state = 'live'
+        self.delay = base # 次に開き直すまでの秒
+        self.attempts = 0 # 開き直しを試した回数
+        self.reconnects = 0 # 開き直せた回数
+        self.lost_count = 0 # 切れた回数
+        self.down = 0.0 # 切れていた合計秒（今切れている分は含まない）
+        self.t_down = None # 今切れているなら切れた時刻
+        self.up = Event() # live の間はセット
+        self.up.set()
+        self.stopped = Event()
+        self.thread = None
+
+    @property
+    def live(self):
+        return self.state == 'live'
+
+    @property
+    def downtime(self):
+        # 切れていた合計秒（今切れていればその分も含む）
+        return self.down + (time.perf_counter() - self.t_down if self.t_down is not None else 0.0)
+
+    def lost(self):
+        # 取込スレッドから呼ぶ。待たずに戻り、開き直しは別スレッドで行う
+        if self.state != 'live' or self.stopped.is_set():
+            return
+        self.state, self.delay = 'waiting', self.base
+        self.t_down = time.perf_counter()
+        self.lost_count += 1
+        self.up.clear()
+        print(f'WARNING: {self.name}: video stream lost, reconnecting to {self.source} in the background')
+        self.thread = Thread(target=self.run, name=f'{self.name}-reconnect', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # 開き直すスレッド
+        tries = 0
+        while not self.stopped.wait(self.delay):
+            self.state = 'connecting'
+            self.attempts += 1
+            tries += 1
+            try:
+                ok = self.cap.open(self.source) and self.cap.isOpened()
+            except Exception: # cv2.error など。失敗として扱って待ち直す
+                ok = False
+            if self.stopped.is_set():
+                break
+            if ok:
+                dt = time.perf_counter() - self.t_down
+                self.down += dt
+                self.t_down = None
+                self.reconnects += 1
+                self.state = 'live'
+                print(f'{self.name}: reconnected to {self.source} after {tries} attempts ({dt:.1f} s down)')
+                self.up.set()
+                return
+            self.state = 'waiting'
+            self.delay = min(self.delay * self.factor, self.max_delay)
+
+    def close(self):
+        # 待っている開き直しをやめる（cap.open の途中なら、戻った所で終わる）
+        self.stopped.set()
+        self.up.set()
@@ -0,0 +1,98 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+4台分の合成画像（mosaic）と、1台ずつ元の解像度で順番に返す（roundrobin）のを、検出側の速さに合わせて切り替える。ローダーの schedule 引数で使う。
+budget 秒ごとに全カメラを1回ずつ見られる範囲で、できるだけ高い解像度で見る。
+usage :
+    dataset = LoadT4TISCams(source, schedule='auto')                            # 速さに合わせて自動で切り替える
+    dataset = LoadT4TISCams(source, schedule=Scheduler('auto', budget=0.2, priority=0)) # カメラ0は合成画像と交互に毎回元の解像度で見る
+    for sources, img_lb, img, rbt_flag, bad in dataset:
+        print(dataset.meta['kind'], dataset.meta['cams']) # 'mosaic' [0, 1, 2, 3] / 'single' [2] など
+"""
+
+import time
+
+MODES = ('auto', 'mosaic', 'roundrobin', 'mix')
+
+
+class Scheduler:
+    # 検出側が取りに来る間隔 T（指数移動平均）から、毎回何を返すかを決める
+    #   'mosaic'     : 毎回全カメラの合成画像。どのカメラも T ごとに見るが、解像度は1/2程度
+    #   'roundrobin' : 毎回1台を元の解像度で順番に。各カメラは n*T ごと（priority を指定するとそのカメラと他の1台を交互に）
+    #   'mix'        : 合成画像と priority のカメラ（無ければ順番に1台）の元の解像度を交互に。合成画像に入るカメラは 2T ごと
+    # mode='auto' は、各カメラを見る間隔が budget 秒以内に収まる中で一番解像度の高いものを選ぶ
+    # 切り替えは、選ぶものが変わった状態が hold 秒続いた時だけ（行ったり来たりしないように）
+    def __init__(self, mode='auto', budget=0.1, priority=None, alpha=0.1, hold=1.0):
+        if mode not in MODES:
+            raise ValueError(f'unknown schedule: {mode} (choose from {MODES})')
+        self.mode = mode
+        self.budget, self.priority, self.alpha, self.hold = budget, priority, alpha, hold
+        self.plan = 'mosaic' if mode == 'auto' else mode # 今の返し方
+        self.cams = [] # 開けたカメラの番号
+        self.interval = None # 検出側が取りに来る間隔（平均）
+        self.t_pull = None
+        self.t_off = None # 選ぶものが今と変わり始めた時刻
+        self.tick = 0 # 何回返したか
+        self.rr = 0 # 順番に返す時の次のカメラ（self.cams の中の位置）
+        self.switches = 0 # 返し方を変えた回数
+
+    def bind(self, cams):
+        # ローダーから開けたカメラの番号を渡す
+        self.cams = list(cams)
+        if self.priority is not None and self.priority not in self.cams:
+            self.priority = None
+
+    def worst(self, plan):
+        # plan で返した時に、一番長く見られないカメラの間隔（T の何倍か）
+        n = len(self.cams)
+        if plan == 'mosaic':
+            return 1
+        if plan == 'roundrobin':
+            return 2 * max(1, n - 1) if self.priority is not None and n > 1 else n
+        return 2 # mix
+
+    def choose(self):
+        # budget に収まる中で解像度の高い順に roundrobin > mix > mosaic
+        T = self.interval or 0.0
+        for plan in ('roundrobin', 'mix'):
+            if self.worst(plan) * T <= self.budget:
+                return plan
+        return 'mosaic'
+
+    def pulled(self):
+        # __next__ から呼ぶ
+        now = time.perf_counter()
+        if self.t_pull is not None:
+            dt = now - self.t_pull
+            self.interval = dt if self.interval is None else self.interval + self.alpha * (dt - self.interval)
+            if self.mode == 'auto':
+                want = self.choose()
+                if want == self.plan:
+                    self.t_off = None
+                elif self.t_off is None:
+                    self.t_off = now
+                elif now - self.t_off >= self.hold:
+                    self.plan, self.t_off = want, None
+                    self.switches += 1
+        self.t_pull = now
+
+    def _next_single(self, skip=None):
+        # 順番で次のカメラ（skip は飛ばす）
+        for _ in range(len(self.cams)):
+            i = self.cams[self.rr % len(self.cams)]
+            self.rr += 1
+            if i != skip or len(self.cams) == 1:
+                return i
+        return self.cams[0]
+
+    def next(self):
+        # 今回返すもの。None なら合成画像、カメラ番号ならそのカメラを元の解像度で
+        self.tick += 1
+        if not self.cams or self.plan == 'mosaic':
+            return None
+        if self.plan == 'mix':
+            if self.tick % 2:
+                return None
+            return self.priority if self.priority is not None else self._next_single()
+        if self.priority is not None and len(self.cams) > 1: # roundrobin で priority が有れば、priority と他のカメラを交互に
+            return self.priority if self.tick % 2 else self._next_single(skip=self.priority)
+        return self._next_single()
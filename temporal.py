@@ -0,0 +1,94 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+続けて取り込んだ K 枚の合成画像を1つのバッチ (K, H, W, 3) にまとめて返す。録画の再生や後からの監査のように、1枚ごとの遅れより全体の速さが大事な時に、モデルをバッチ K で回すため。
+バッファは最初の1枚の大きさで作って使い回す。flush 秒たっても K 枚揃わなければ、揃った所までで返す（録画の終わりも同じ）。
+usage :
+    dataset = LoadT4Streams('replay.txt', backend='replay', policy='block') # 'block' なら毎回新しい画像を待つので、同じ画像が並ばない
+    for sources, imgs_lb, imgs, stamps, rbt_flag, bad in dataset.temporal(8, flush=0.5):
+        preds = model(imgs_lb)                              # (k, 640, 640, 3)。k は普通 8、最後や flush の時は少ない
+        print(len(imgs), stamps[-1] - stamps[0])            # stamps は各合成画像を受け取った時刻（time.time()）
+    python bench.py --loaders T4Streams --cams 4 --temporal 1 4 8 16 --batch-cost 20 2 # K ごとの frames/s（モデルの代わりに1回20ms + 1枚2ms待つ）
+"""
+
+import time
+import numpy as np
+
+
+class TemporalBatcher:
+    # dataset（ローダー）から K 枚続けて取り出して、前もって作ったバッファ (K, ...) の k 番目に写していく
+    # letterbox=True ならletterbox後の画像（モデル入力）、composed=True なら合成画像もまとめる。要らない方は None で返す
+    # 返したバッチは次の buffers-1 回の間は書き換えない（ローダーの buffers と同じ）
+    # 合成画像の大きさが変わった時（schedule で1台だけ返した時など）は、そこまでで返してから新しい大きさのバッファを作る
+    # flush は1枚目を受け取ってからの秒数。取り出しの途中で待っている間は切れないので、その1枚が届いた所で返す
+    def __init__(self, dataset, k=8, flush=0.5, letterbox=True, composed=True, buffers=2, pull=next):
+        self.dataset, self.k, self.flush = dataset, max(1, int(k)), flush
+        self.letterbox, self.composed = letterbox, composed
+        self.buffers = max(1, int(buffers))
+        self.pull = pull # dataset から1枚取り出す関数
+        self.sets = [] # バッファの組 [(letterbox, 合成画像, 時刻)]。最初の1枚の大きさで作る
+        self.shapes = None # 今のバッファの (letterbox, 合成画像) の1枚の大きさ
+        self.nout = 0 # 返したバッチの数（使うバッファの番号）
+        self.metas = [] # 直前に返したバッチの各画像の dataset.meta
+        self.pending = None # 大きさが変わって次のバッチに回す1枚
+        self.frames = 0 # 返した画像の枚数
+        self.partial = 0 # K 枚揃わずに返したバッチの数
+        self.done = False
+        iter(dataset) # ローダーは __iter__ で数え始めるので
+
+    def __iter__(self):
+        return self
+
+    def buffer(self, lb, img):
+        # lb と img の大きさのバッファの組を返す。大きさが変わったら作り直す
+        shapes = (lb.shape if self.letterbox else None, img.shape if self.composed else None)
+        if shapes != self.shapes:
+            self.shapes = shapes
+            self.sets = [(np.empty((self.k,) + shapes[0], dtype=lb.dtype) if self.letterbox else None,
+                          np.empty((self.k,) + shapes[1], dtype=img.dtype) if self.composed else None,
+                          np.zeros(self.k, dtype=np.float64)) for _ in range(self.buffers)]
+        return self.sets[self.nout % self.buffers]
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        n, lbs, imgs, stamps, metas = 0, None, None, None, []
+        t_first = None
+        sources, rbt_flag, bad = None, False, ''
+        while n < self.k:
+            if self.pending is not None:
+                item, self.pending = self.pending, None
+            else:
+                if n and time.perf_counter() - t_first >= self.flush: # 揃うのを待ちすぎた
+                    break
+                try:
+                    s, lb, img, flag, bad_cam = self.pull(self.dataset)
+                except StopIteration: # 録画の終わりなど。揃った所までを返して終わる
+                    self.done = True
+                    break
+                item = (s, lb, img, time.time(), getattr(self.dataset, 'meta', None), flag, bad_cam)
+            s, lb, img, stamp, meta, flag, bad_cam = item # 次のバッチに回した1枚も、その時の rbt_flag と bad を持っている
+            if n and ((self.letterbox and lb.shape != lbs.shape[1:]) or (self.composed and img.shape != imgs.shape[1:])):
+                self.pending = item # 大きさが違うので次のバッチの1枚目にする
+                break
+            if n == 0:
+                lbs, imgs, stamps = self.buffer(lb, img)
+                t_first = time.perf_counter()
+            if self.letterbox:
+                np.copyto(lbs[n], lb)
+            if self.composed:
+                np.copyto(imgs[n], img)
+            stamps[n] = stamp
+            metas.append(meta)
+            sources, rbt_flag, bad = s, flag, bad_cam # バッチの rbt_flag と bad は入れた最後の1枚のもの
+            n += 1
+            if rbt_flag: # ローダーが止まろうとしているので、ここまでで返す
+                break
+        if n == 0:
+            self.done = True
+            raise StopIteration
+        self.nout += 1
+        self.frames += n
+        self.partial += n < self.k
+        self.metas = metas
+        return (sources, lbs[:n] if self.letterbox else None, imgs[:n] if self.composed else None,
+                stamps[:n], rbt_flag, bad)
@@ -5,43 +5,77 @@ import numpy as np
 import os, sys
 import subprocess
 from cam_loader import LoadT4TISCams, LoadV4TISCams
+from preview import Preview, WebPreview
+from tracer import Tracer
+from blackbox import BlackBox
 
 #★★★★　ここから、次の★★★★までの間を用途・環境に合わせて書き換えて下さい。★★★★
 # 画面に表示する倍率
 DisplayScale = 1.0
+# 画面表示の上限FPS（表示は別スレッドなので、ここを下げても検出ループは遅くならない）
+DisplayFPS = 15
 
 #★★★★ ここまでの間を用途・環境に合わせて書き換えて下さい。★★★★
 
 def run(source= 'sources.txt',
+        trace= '',
+        blackbox= '',
+        warm_restart= 0,
+        web= 0,
         ): 
     # 引数 --source で指定されたファイル名に応じてcam_loader.pyのクラスを呼び出す
     if source == 'sources.txt': # 通常のUSBカメラ複数使用の場合
-        cams = LoadT4TISCams(source)
         src_name = '4 Tile TIS cams '
+        loader = LoadT4TISCams
 
     elif source == 'sources_V.txt': # TIS社の産業用カメラの場合
-        cams = LoadV4TISCams(source)
         src_name = '4 Vertical TIS cams '
+        loader = LoadV4TISCams
 
-    for sources, frame_lb, frame, rbt_flag, bad in cams:
-        h, w, _ = frame.shape # 画像のサイズ取り込み
-        # 例えばの話このあたりにAIの処理などを挟んでみる
-        frame_disp = cv2.resize(frame, dsize=None, fx=DisplayScale, fy=DisplayScale)
-        #--- 描画した画像を表示
-        cv2.imshow('Cameras from 4direction -source ' + src_name + '  **Hit "q" to stop', frame_disp)
-        k = cv2.waitKey(1)
-        if k == ord('r') or cams.rbt_flag:
-            global rbt, bad_cam
-            rbt = True
-            bad_cam = cams.bad_cam
-            cams.flag = False #インスタンス化した画像取り込みプログラムに停止の合図を送る
-            cv2.destroyAllWindows()
-            break
-    time.sleep(3) #　数秒スリープしてthreadを先に終了させる
+    # 表示とキー入力(q:停止 r:再起動)は別スレッドのPreviewに任せる
+    preview = Preview('Cameras from 4direction -source ' + src_name + '  **Hit "q" to stop', fps=DisplayFPS, scale=DisplayScale)
+    # --trace が指定されたら各区間の処理時間を記録して、終了時にChrome trace形式で書き出す
+    tracer = Tracer(trace) if trace else None
+    # --blackbox が指定されたら取り込んだ画像をそのファイルに残し続ける（落ちた後で python blackbox.py で見返す）
+    box = BlackBox(blackbox, size_mb=512, fps=20) if blackbox else None
+    # --web が指定されたらそのポートでブラウザ向けにMJPEG配信する（http://このPC:ポート/ 、圧縮は別スレッドで見ている人がいる時だけ）
+    webview = WebPreview(port=web, fps=DisplayFPS, scale=DisplayScale) if web else None
+    restarts = 0 # --warm-restart で開き直した回数
+    # withを抜ける時に取込スレッドの終了を待ってカメラを開放する（以前は数秒スリープしてthreadが終わるのを待っていた）
+    with loader(source, preview=preview, tracer=tracer, blackbox=box) as cams:
+        for sources, frame_lb, frame, rbt_flag, bad in cams:
+            h, w, _ = frame.shape # 画像のサイズ取り込み
+            # 例えばの話このあたりにAIの処理などを挟んでみる
+            #--- 描画した画像を表示（置いていくだけで表示を待たない）
+            preview.show(frame)
+            if webview is not None:
+                webview.show(frame, cams.meta)
+            if cams.rbt_flag and restarts < warm_restart: # 画像が止まったら、まずはプロセスを再起動せずにカメラを開き直す
+                restarts += 1
+                print(f'{cams.bad_cam} カメラの画像が止まったので開き直します ({restarts}/{warm_restart})')
+                cams.restart()
+                continue
+            if preview.reboot or cams.rbt_flag:
+                global rbt, bad_cam
+                rbt = True
+                bad_cam = cams.bad_cam
+                cams.flag = False #インスタンス化した画像取り込みプログラムに停止の合図を送る
+                break
+    preview.close()
+    if webview is not None:
+        webview.close()
+    if tracer is not None:
+        tracer.stop()
+    if box is not None:
+        box.close()
 
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--source', type=str, default= '4TISCams.txt', help='file/dir/URL/glob, 0 for webcam')
+    parser.add_argument('--trace', type=str, default= '', help='save Chrome trace (Perfetto) JSON to this file on stop')
+    parser.add_argument('--warm-restart', type=int, default= 0, help='reopen the cameras in-process up to this many times before rebooting')
+    parser.add_argument('--blackbox', type=str, default= '', help='keep recent frames in this memory-mapped ring file (blackbox.py)')
+    parser.add_argument('--web', type=int, default= 0, help='serve an MJPEG preview of the frames on this HTTP port (0: off)')
     #parser.add_argument('--dummy',action='store_true', help='指定すれば開けないカメラ部分にダミー画像を使う。')
     opt = parser.parse_args()
     return opt
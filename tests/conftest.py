@@ -0,0 +1,6 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# モジュールはリポジトリ直下にあるので、tests/ から import できるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# 定常状態の1枚あたりのメモリ確保量（取込スレッドも含む）が上限を超えないこと。bench.py --alloc-limit と同じ測り方
+import time
+import numpy as np
+import pytest
+import bench
+from cam_backends import SyntheticCapture
+
+LIMIT_KB = 64 # 640x480 の画像1枚（900KB）を毎回作り直したら必ず超える
+FPS = 60
+
+
+class FreshCapture(SyntheticCapture):
+    # 渡されたバッファを使わずに毎回新しい画像を作る疑似カメラ（測り方が取込スレッドの確保を拾えているかの確認用）
+    def retrieve(self, image=None):
+        return super().retrieve(None)
+
+
+def measure(tmp_path, loader, capture=SyntheticCapture, frames=20):
+    src = tmp_path / 'cams.txt'
+    src.write_text('\n'.join(f'cam{i}' for i in range(4)))
+    dataset = bench.LOADERS[loader](str(src), preview=False, backend=lambda s, w, h, fps: capture(s, w, h, FPS, seed=s))
+    try:
+        iter(dataset)
+        time.sleep(0.3)
+        for _ in range(10):
+            bench.pull(dataset)
+        return float(np.median(bench.alloc_per_frame(dataset, frames, FPS))) / 1024
+    finally:
+        dataset.close()
+
+
+@pytest.mark.parametrize('loader', list(bench.LOADERS))
+def test_steady_state_allocation(tmp_path, loader):
+    kb = measure(tmp_path, loader)
+    assert kb < LIMIT_KB, f'{loader} allocates {kb:.1f} KB/frame'
+
+
+def test_capture_thread_allocation_is_counted(tmp_path):
+    # 取り出し側は何も変わらず、取込スレッドだけが毎回確保する
+    kb = measure(tmp_path, 'T4Streams', FreshCapture)
+    assert kb > LIMIT_KB, f'only {kb:.1f} KB/frame seen, the capture threads are not measured'
@@ -0,0 +1,68 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# Preview / WebPreview が show() された画像をコピーして持つことを、ウインドウやブラウザ無しで確かめる
+import time
+from threading import Event
+import numpy as np
+import preview
+from preview import Preview, WebPreview
+
+
+def test_show_copies_the_frame(monkeypatch):
+    shown, drawing, done = [], Event(), Event()
+
+    def imshow(title, frame):
+        drawing.set()
+        done.wait(1.0) # 表示している間にローダーがバッファを書き換える
+        shown.append(frame.copy())
+
+    monkeypatch.setattr(preview.cv2, 'imshow', imshow)
+    monkeypatch.setattr(preview.cv2, 'waitKey', lambda ms: time.sleep(ms / 1000) or -1)
+    monkeypatch.setattr(preview.cv2, 'destroyWindow', lambda title: None)
+    view = Preview(fps=0, scale=1.0)
+    try:
+        ring = np.full((48, 64, 3), 1, dtype=np.uint8) # ローダーの出力バッファの代わり
+        view.show(ring)
+        assert drawing.wait(1.0)
+        ring[:] = 2 # 次のフレームで上書き
+        view.show(ring)
+        ring[:] = 3
+        view.show(ring) # まだ表示されていない 2 は捨てる
+        done.set()
+        t_end = time.perf_counter() + 1.0
+        while len(shown) < 2 and time.perf_counter() < t_end:
+            time.sleep(0.01)
+        assert [int(x.min()) for x in shown] == [1, 3]
+        assert all(x.min() == x.max() for x in shown) # 混ざった画像を表示していない
+        assert view.dropped == 1 and len(view.bufs) == 2
+    finally:
+        view.close()
+
+
+def test_web_show_copies_the_frame(monkeypatch):
+    encoded, encoding, done = [], Event(), Event()
+
+    def imencode(ext, im, params):
+        encoding.set()
+        done.wait(1.0) # 圧縮している間にローダーがバッファを書き換える
+        encoded.append(im.copy())
+        return True, np.zeros(1, dtype=np.uint8)
+
+    monkeypatch.setattr(preview.cv2, 'imencode', imencode)
+    web = WebPreview(port=0, fps=0, scale=1.0)
+    try:
+        with web.cond:
+            web.viewers['mosaic'] = 1 # ブラウザが1つ見ている
+        ring = np.full((48, 64, 3), 1, dtype=np.uint8)
+        web.show(ring)
+        assert encoding.wait(1.0)
+        ring[:] = 2
+        web.show(ring)
+        done.set()
+        t_end = time.perf_counter() + 1.0
+        while len(encoded) < 2 and time.perf_counter() < t_end:
+            time.sleep(0.01)
+        assert [int(x.min()) for x in encoded] == [1, 2]
+        assert all(x.min() == x.max() for x in encoded)
+        assert len(web.bufs) == 2
+    finally:
+        web.close()
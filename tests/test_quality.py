@@ -0,0 +1,20 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# QualityMonitor の stall()（検出側）と measure()（取込スレッド）が stats[i] を取り合わないことを確かめる
+import numpy as np
+from quality import QualityMonitor
+
+
+def test_stall_is_merged_by_measure():
+    qm = QualityMonitor(every=1, budget=0).bind(1)
+    im = np.full((48, 64, 3), 128, dtype=np.uint8)
+    qm.measure(0, im)
+    s = qm.stats[0]
+    for _ in range(3):
+        qm.stall(0, True, 4)
+    assert qm.stats[0] is s # stall() は数えるだけ
+    assert qm.stalled[0] == 3
+    qm.measure(0, im)
+    assert qm.stats[0]['stalled'] == 3 and 'stalled' in qm.stats[0]['alerts']
+    qm.stall(0, False, 4)
+    qm.measure(0, im)
+    assert qm.stats[0]['stalled'] == 0 and 'stalled' not in qm.stats[0]['alerts']
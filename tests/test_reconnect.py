@@ -0,0 +1,134 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# Reconnector の開き直し（指数バックオフ）と、開き直している間もローダーの __next__ が止まらないこと
+import time
+from threading import Event
+import numpy as np
+from cam_backends import SyntheticCapture
+from cam_loader import LoadT4Streams
+from reconnect import Reconnector
+
+
+class FakeCap:
+    # open() が fails 回失敗してから成功する。gate を渡すと、open() はそれがセットされるまで戻らない
+    def __init__(self, fails=0, gate=None):
+        self.fails, self.gate = fails, gate
+        self.calls = [] # open() を呼ばれた時刻
+        self.opened = False
+
+    def open(self, source):
+        self.calls.append(time.perf_counter())
+        if self.gate is not None:
+            self.gate.wait()
+        if len(self.calls) <= self.fails:
+            return False
+        self.opened = True
+        return True
+
+    def isOpened(self):
+        return self.opened
+
+
+def test_backoff_doubles_until_max():
+    cap = FakeCap(fails=4)
+    link = Reconnector(cap, 'rtsp://x', base=0.05, max_delay=0.2, factor=2.0)
+    t0 = time.perf_counter()
+    link.lost()
+    assert not link.live and not link.up.is_set()
+    assert link.up.wait(3.0)
+    # 待ち時間は 0.05, 0.1, 0.2, 0.2（max_delay）, 0.2
+    gaps = np.diff([t0] + cap.calls)
+    assert np.allclose(gaps, [0.05, 0.1, 0.2, 0.2, 0.2], atol=0.04), gaps
+    assert link.live and link.attempts == 5 and link.reconnects == 1 and link.lost_count == 1
+    assert link.downtime >= 0.7
+    # 次に切れた時は base から待ち直す
+    cap.fails, cap.calls = 0, []
+    t0 = time.perf_counter()
+    link.lost()
+    assert link.up.wait(1.0)
+    assert cap.calls[0] - t0 < 0.05 + 0.04
+    assert link.reconnects == 2
+
+
+def test_open_that_throws_is_a_failure():
+    class Broken(FakeCap):
+        def open(self, source):
+            super().open(source)
+            if len(self.calls) == 1:
+                raise RuntimeError('cv2.error')
+            self.opened = True
+            return True
+    cap = Broken()
+    link = Reconnector(cap, 'rtsp://x', base=0.02, max_delay=0.1)
+    link.lost()
+    assert link.up.wait(1.0)
+    assert link.attempts == 2 and link.live
+
+
+def test_blocking_open_does_not_block_the_caller():
+    gate = Event()
+    cap = FakeCap(gate=gate)
+    link = Reconnector(cap, 'rtsp://x', base=0.01)
+    t = time.perf_counter()
+    link.lost()
+    assert time.perf_counter() - t < 0.05 # lost() はすぐ戻る
+    time.sleep(0.1)
+    assert link.state == 'connecting' and len(cap.calls) == 1
+    link.lost() # 開き直している間にもう一度呼ばれても、2本目のスレッドは作らない
+    link.close()
+    assert link.up.is_set() # close() で待っている取込スレッドを起こす
+    gate.set()
+    link.thread.join(1.0)
+    assert not link.thread.is_alive() and not link.live and link.reconnects == 0
+
+
+class FlakyCapture(SyntheticCapture):
+    # cam0 は down 枚目から retrieve() に失敗し、open() は gate がセットされるまで戻らない（ネットワークのタイムアウトの代わり）
+    gate = Event()
+    down = 15
+
+    def __init__(self, source, *args, **kwargs):
+        super().__init__(source, *args, **kwargs)
+        self.flaky = source == 'cam0'
+
+    def retrieve(self, image=None):
+        if self.flaky and self.n >= self.down:
+            return False, None
+        return super().retrieve(image)
+
+    def open(self, source):
+        FlakyCapture.gate.wait()
+        self.flaky = False # 開き直したら直っている
+        return super().open(source)
+
+
+def test_loader_keeps_running_while_a_camera_reconnects(tmp_path):
+    src = tmp_path / 'cams.txt'
+    src.write_text('cam0\ncam1\n')
+    FlakyCapture.gate.clear()
+    dataset = LoadT4Streams(str(src), backend=lambda s, w, h, fps: FlakyCapture(s, w, h, 60, seed=s), size=(320, 240),
+                            hold='placeholder', backoff=(0.05, 0.2), preview=False)
+    try:
+        iter(dataset)
+        t_end = time.perf_counter() + 1.0
+        worst, down_frames, cam1 = 0.0, 0, set()
+        while time.perf_counter() < t_end:
+            t = time.perf_counter()
+            next(dataset)
+            worst = max(worst, time.perf_counter() - t)
+            if not dataset.links[0].live:
+                down_frames += 1
+                assert not dataset.imgs[0].any() # 切れている間は黒い画像
+                cam1.add(int(dataset.imgs[1][120, 160].sum())) # もう1台は更新され続ける
+            time.sleep(1 / 60)
+        assert down_frames > 10
+        assert len(cam1) > 1
+        assert worst < 0.2, f'__next__ took {worst * 1000:.0f} ms while cam0 was reconnecting'
+        assert dataset.links[0].state == 'connecting' # open() はまだ戻っていない
+        FlakyCapture.gate.set()
+        assert dataset.links[0].up.wait(1.0)
+        time.sleep(0.1)
+        next(dataset)
+        assert dataset.imgs[0].any() and dataset.reconnects[0] == 1 and dataset.downtime[0] > 0.5
+    finally:
+        FlakyCapture.gate.set()
+        dataset.close()
@@ -0,0 +1,76 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# ReplayCapture を画像フォルダで動かし、取込めなかった時に前の画像を返さないことを確かめる
+from functools import partial
+import cv2
+import numpy as np
+from cam_backends import ReplayCapture
+from cam_loader import LoadT4Streams
+
+
+def frames(folder, n=5, w=64, h=48):
+    # 1枚ごとに明るさが違う画像フォルダを作る
+    for k in range(n):
+        cv2.imwrite(str(folder / f'{k:03d}.png'), np.full((h, w, 3), 10 * (k + 1), dtype=np.uint8))
+    return folder
+
+
+def test_grab_after_end_returns_no_frame(tmp_path):
+    cap = ReplayCapture(frames(tmp_path), w=64, h=48, loop=False, speed=0)
+    try:
+        seen = []
+        while cap.grab():
+            ok, im = cap.retrieve()
+            assert ok
+            seen.append(int(im[0, 0, 0]))
+        assert seen == [10, 20, 30, 40, 50]
+        assert cap.retrieve() == (False, None) # 最後の画像をもう一度返さない
+        assert not cap.isOpened()
+    finally:
+        cap.release()
+
+
+def test_grab_timeout_drops_the_old_frame(tmp_path):
+    cap = ReplayCapture(frames(tmp_path, n=1), w=64, h=48, loop=False, speed=0)
+    try:
+        assert cap.grab()
+        assert cap.retrieve()[0]
+        with cap.cond: # 先読みが間に合わない状態にする
+            cap.q.clear()
+        assert not cap.grab()
+        assert cap.retrieve() == (False, None)
+    finally:
+        cap.release()
+
+
+class Hiccup(ReplayCapture):
+    # 3回目の grab() だけ失敗する。retrieve() は cv2.VideoCapture のように前の画像を返し続ける
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.grabs = 0
+
+    def grab(self):
+        self.grabs += 1
+        return self.grabs != 3 and super().grab()
+
+    def retrieve(self, image=None):
+        return self.im is not None, self.im
+
+
+def test_loader_checks_grab(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    frames(src, n=8)
+    (tmp_path / 'replay.txt').write_text(str(src) + '\n')
+    dataset = LoadT4Streams(str(tmp_path / 'replay.txt'), size=(64, 48), policy='block', hold='placeholder',
+                            backend=partial(Hiccup, speed=0), backoff=(0.01, 0.05), preview=False)
+    try:
+        seen = []
+        for _ in dataset:
+            seen.append(int(dataset.imgs[0][0, 0, 0]))
+            if len(seen) == 6:
+                break
+        assert 0 in seen # 取込めなかった時は前の画像ではなく黒い画像
+        real = [x for x in seen if x]
+        assert len(real) == len(set(real)), seen # 同じ画像を2回渡していない
+    finally:
+        dataset.close()
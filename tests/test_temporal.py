@@ -0,0 +1,28 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# TemporalBatcher が次のバッチに回した1枚の rbt_flag と bad を、その1枚のバッチで返すことを確かめる
+import numpy as np
+from temporal import TemporalBatcher
+
+
+class Frames:
+    # ローダーの代わり。(大きさ, rbt_flag, bad) の順に1枚ずつ返す
+    def __init__(self, items):
+        self.items = list(items)
+        self.meta = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.items:
+            raise StopIteration
+        (h, w), flag, bad = self.items.pop(0)
+        img = np.zeros((h, w, 3), dtype=np.uint8)
+        return ['cam0'], img, img, flag, bad
+
+
+def test_pending_frame_keeps_its_flags():
+    batches = list(TemporalBatcher(Frames([((48, 64), False, ''), ((48, 64), False, ''),
+                                            ((48, 32), True, 'cam1'), ((48, 32), False, '')]), k=4, flush=10))
+    assert [len(b[1]) for b in batches] == [2, 1, 1] # 大きさが変わった所と、rbt_flag の1枚の所で返す
+    assert [b[4:] for b in batches] == [(False, ''), (True, 'cam1'), (False, '')]
@@ -0,0 +1,86 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# acquisition='callback' の取込みを tisgrabber のスタブ（tis_stub）で、ctypes のコールバック込みで通す
+import time
+import ctypes
+import numpy as np
+import pytest
+import bench
+import tis_stub
+import tis_manager
+from cam_backends import TISCallbackCapture
+from cam_loader import LoadT4TISCams, LoadV4TISCams
+
+FPS = 60
+
+
+def stamps(dataset, n):
+    # tis_stub のRGB24画像の最後の行の先頭8バイトは、ドライバ（スタブ）がフレームを作った時刻
+    return [int(dataset.imgs[i][-1].reshape(-1)[:8].view(np.int64)[0]) for i in range(n)]
+
+
+@pytest.fixture
+def sources(tmp_path):
+    src = tmp_path / 'cams.txt'
+    src.write_text('A\nB\n')
+    return str(src)
+
+
+@pytest.mark.parametrize('loader', [LoadT4TISCams, LoadV4TISCams])
+def test_callback_delivers_fresh_frames(sources, loader):
+    ic, tis = lib = tis_stub.load(fps=FPS)
+    dataset = loader(sources, tis_lib=lib, acquisition='callback', preview=False)
+    try:
+        caps = dataset.caps[:2]
+        assert all(isinstance(cap, TISCallbackCapture) for cap in caps)
+        for cap in caps: # StartLive の前に登録して、毎フレーム呼ばれる連続モードにしてある
+            g = ic.grabbers[cap.hGrabber]
+            assert g.callback is cap.callback and g.continuous and g.live
+        iter(dataset)
+        time.sleep(0.2)
+        seen, ages = set(), []
+        for _ in range(20):
+            bench.pull(dataset)
+            seen.add(tuple(stamps(dataset, 2)))
+            ages += bench.frame_age(dataset, 2)
+            time.sleep(1 / FPS)
+        assert len(seen) >= 15 # 毎回ドライバの新しいフレームを受け取っている
+        assert np.median(ages) < 1000 / FPS * 3
+        assert all(cap.frames.seq > 20 for cap in caps) # コールバックはローダーのスレッドとは別に呼ばれ続ける
+    finally:
+        dataset.close()
+    for cap in caps: # close() でライブを止めて、グラバーは manager に返してある
+        assert not ic.grabbers[cap.hGrabber].live
+    assert all(h.refs == 0 for h in tis_manager.manager(lib).handles.values())
+
+
+def test_callback_converts_y800(sources):
+    lib = tis_stub.load(fps=FPS)
+    dataset = LoadT4TISCams(sources, tis_lib=lib, acquisition='callback', pixel_format='Y800', preview=False)
+    try:
+        iter(dataset)
+        time.sleep(0.2)
+        _, img_lb, img, _, _ = bench.pull(dataset)
+        im = dataset.imgs[0]
+        assert im.shape == (480, 640, 3) and im.dtype == np.uint8
+        assert (im[..., 0] == im[..., 1]).all() and (im[..., 1] == im[..., 2]).all() # 灰色をBGRに広げたもの
+        assert img_lb.shape[-1] == 3
+    finally:
+        dataset.close()
+
+
+def test_callback_timeout_without_frames(sources):
+    # フレームが来なければ grab() は timeout 秒で False を返す（ローダーのスレッドが止まったままにならない）
+    ic, tis = lib = tis_stub.load(fps=FPS)
+    ic.IC_InitLibrary(0)
+    h = ic.IC_CreateGrabber()
+    ic.IC_OpenDevByUniqueName(h, tis.T('A'))
+    ic.IC_SetVideoFormat(h, tis.T('RGB24 (64x48)'))
+    cap = TISCallbackCapture(ic, h, tis, ctypes, timeout=0.1)
+    t = time.perf_counter()
+    assert not cap.grab() # StartLive していない
+    assert 0.08 < time.perf_counter() - t < 1.0
+    ic.IC_StartLive(h, 0)
+    assert cap.grab()
+    ok, im = cap.retrieve()
+    assert ok and im.shape == (48, 64, 3)
+    cap.release()
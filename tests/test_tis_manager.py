@@ -0,0 +1,123 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# 同じカメラを2つのTISローダーで使う時の tis_manager（tis_stub で）
+import time
+import numpy as np
+import pytest
+import tis_stub
+import tis_manager
+from cam_backends import SharedCapture, TISCapture
+from cam_loader import LoadT4TISCams, LoadV4TISCams
+
+FPS = 60
+TONE = (b'Tone Mapping', b'Enable')
+
+
+@pytest.fixture
+def sources(tmp_path):
+    src = tmp_path / 'cams.txt'
+    src.write_text('A\nB\n')
+    return str(src)
+
+
+def stamp(im):
+    # tis_stub がフレームを作った時刻（RGB24の最後の行の先頭8バイト）
+    return int(im[-1].reshape(-1)[:8].view(np.int64)[0])
+
+
+def test_refuses_a_different_format_while_live(sources, capsys):
+    lib = tis_stub.load(fps=FPS)
+    a = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    b = LoadT4TISCams(sources, tis_lib=lib, preview=False, pixel_format='Y800')
+    try:
+        assert b.caps[:2] == [None, None] # 変換できない画像を受け取らずに、そのカメラを飛ばす
+        assert 'is live as RGB24 (640x480) in another loader, cannot share it as Y800' in capsys.readouterr().out
+        assert all(h.refs == 1 for h in a.tis_manager.handles.values())
+    finally:
+        b.close()
+        a.close()
+
+
+@pytest.mark.parametrize('acquisition', ['snap', 'callback'])
+def test_loaders_sharing_a_grabber_get_the_same_frames(sources, acquisition):
+    lib = tis_stub.load(fps=FPS)
+    a = LoadT4TISCams(sources, tis_lib=lib, preview=False, acquisition=acquisition)
+    b = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    try:
+        assert all(isinstance(cap, SharedCapture) for cap in b.caps[:2])
+        frames = a.tis_manager.handles['A'].frames
+        time.sleep(0.3)
+        n0 = frames.seq
+        seen_a, seen_b = set(), set()
+        t_end = time.perf_counter() + 0.5
+        while time.perf_counter() < t_end:
+            seen_a.add(stamp(a.queues[0].get()))
+            seen_b.add(stamp(b.queues[0].get()))
+        # 取り込んでいるのは1本だけなので、カメラのFPSのまま両方に届く（IC_SnapImage を取り合うと半分ずつになる）
+        assert frames.seq - n0 > 0.5 * FPS * 0.8
+        assert len(seen_a & seen_b) > 0.8 * min(len(seen_a), len(seen_b))
+    finally:
+        b.close()
+        a.close()
+
+
+def test_grabbing_continues_after_the_first_loader_closes(sources):
+    lib = tis_stub.load(fps=FPS)
+    a = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    b = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    handle = a.tis_manager.handles['A']
+    try:
+        a.close()
+        assert handle.refs == 1 and handle.pump is not None # manager のスレッドが代わりに取り込む
+        n0 = b.caps[0].read_seq
+        time.sleep(0.3)
+        assert b.caps[0].read_seq - n0 > 0.3 * FPS * 0.7
+    finally:
+        b.close()
+    assert handle.pump is None and not lib[0].grabbers[handle.h].live
+
+
+def test_resets_only_when_the_last_loader_releases(sources):
+    ic, tis = lib = tis_stub.load(fps=FPS)
+    a = LoadV4TISCams(sources, tis_lib=lib, preview=False)
+    b = LoadV4TISCams(sources, tis_lib=lib, preview=False)
+    g = ic.grabbers[a.tis_manager.handles['A'].h]
+    assert g.switches[TONE] == 1
+    a.close()
+    assert g.switches[TONE] == 1 and g.live # b がまだWDRで使っている
+    b.close()
+    assert g.switches[TONE] == 0 and not g.live
+
+
+def test_restart_reuses_the_grabber(sources):
+    lib = tis_stub.load(fps=FPS)
+    a = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    mgr = tis_manager.manager(lib)
+    opened = mgr.opened
+    a.restart()
+    try:
+        assert mgr.opened == opened and mgr.reused >= 2
+        assert all(isinstance(cap, TISCapture) for cap in a.caps[:2])
+    finally:
+        a.close(close_library=True)
+
+
+def test_snap_after_callback_does_not_call_the_old_callback(sources):
+    # コールバックはグラバーに登録されたまま残る。次に 'snap' で借りた時にドライバが呼ばないこと、呼ばれても関数が生きていること
+    ic, tis = lib = tis_stub.load(fps=FPS)
+    a = LoadT4TISCams(sources, tis_lib=lib, preview=False, acquisition='callback')
+    old = a.caps[0]
+    a.close()
+    handle = tis_manager.manager(lib).handles['A']
+    g = ic.grabbers[handle.h]
+    assert handle.refs == 0 and not g.continuous
+    assert handle.callback is g.callback is old.callback # 開放するまで manager が持っている
+    del a, old
+    b = LoadT4TISCams(sources, tis_lib=lib, preview=False)
+    try:
+        assert type(b.caps[0]) is TISCapture and g.live
+        assert g.thread is None or not g.thread.is_alive() # コールバックを呼ぶドライバのスレッドは動いていない
+        n = g.n
+        time.sleep(0.2)
+        assert g.n > n # snap で取り込めている
+    finally:
+        b.close(close_library=True)
@@ -0,0 +1,109 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+# V4L2Capture を VideoCapture の代わり（api=）で、カメラ無しで確かめる
+import time
+from functools import partial
+import cv2
+import numpy as np
+import bench
+from cam_backends import V4L2Capture
+from cam_loader import LoadT4Streams
+
+MJPG = cv2.VideoWriter_fourcc(*'MJPG')
+YUYV = cv2.VideoWriter_fourcc(*'YUYV')
+
+
+class FakeV4L2:
+    # cv2.VideoCapture(source, cv2.CAP_V4L2) の代わり。set() を順に記録し、ドライバのように値を決めて get() で返す
+    # mjpg=False ならMJPGを持っていないカメラ（FOURCC の指定を無視してYUYVのまま）
+    opened = []
+
+    def __init__(self, source, api, mjpg=True):
+        FakeV4L2.opened.append((source, api))
+        self.mjpg = mjpg
+        self.calls = []
+        self.props = {cv2.CAP_PROP_FOURCC: YUYV, cv2.CAP_PROP_FRAME_WIDTH: 640, cv2.CAP_PROP_FRAME_HEIGHT: 480,
+                      cv2.CAP_PROP_FPS: 30.0, cv2.CAP_PROP_BUFFERSIZE: 4}
+        self.n = 0
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        self.calls.append((prop, value))
+        if prop == cv2.CAP_PROP_FOURCC and not self.mjpg:
+            return False
+        self.props[prop] = value
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_MSEC: # ドライバがフレームに付ける CLOCK_MONOTONIC の時刻（5ms前に届いた）
+            return time.monotonic() * 1000 - 5
+        return self.props.get(prop, 0.0)
+
+    def grab(self):
+        self.n += 1
+        return True
+
+    def retrieve(self, image=None):
+        h, w = int(self.props[cv2.CAP_PROP_FRAME_HEIGHT]), int(self.props[cv2.CAP_PROP_FRAME_WIDTH])
+        if image is None or image.shape != (h, w, 3):
+            image = np.empty((h, w, 3), dtype=np.uint8)
+        image[:] = self.n % 256 # 毎フレーム変わる
+        return True, image
+
+    def open(self, source, api):
+        return True
+
+    def release(self):
+        pass
+
+
+def test_requests_mjpg_and_one_buffer(capsys):
+    cap = V4L2Capture(0, 1280, 720, 30, api=FakeV4L2)
+    assert FakeV4L2.opened[-1] == (0, cv2.CAP_V4L2)
+    calls = dict(cap.cap.calls)
+    assert calls[cv2.CAP_PROP_FOURCC] == MJPG
+    assert calls[cv2.CAP_PROP_BUFFERSIZE] == 1
+    assert (calls[cv2.CAP_PROP_FRAME_WIDTH], calls[cv2.CAP_PROP_FRAME_HEIGHT], calls[cv2.CAP_PROP_FPS]) == (1280, 720, 30)
+    assert cap.cap.calls[0][0] == cv2.CAP_PROP_FOURCC # 形式を先に決めないと解像度やFPSがYUYVの範囲で決まる
+    assert cap.mode == {'fourcc': 'MJPG', 'size': (1280, 720), 'fps': 30, 'buffers': 1}
+    assert cap.source == '/dev/video0'
+    assert 'WARNING' not in capsys.readouterr().out
+
+
+def test_warns_when_the_camera_has_no_mjpg(capsys):
+    cap = V4L2Capture('/dev/video2', 640, 480, 30, api=partial(FakeV4L2, mjpg=False))
+    assert cap.mode['fourcc'] == 'YUYV'
+    assert 'WARNING: v4l2 /dev/video2: asked for MJPG 640x480, got YUYV 640x480' in capsys.readouterr().out
+
+
+def test_reopen_configures_again():
+    cap = V4L2Capture(0, 640, 480, 30, api=FakeV4L2)
+    cap.cap.calls.clear()
+    assert cap.open(0)
+    assert dict(cap.cap.calls)[cv2.CAP_PROP_FOURCC] == MJPG and dict(cap.cap.calls)[cv2.CAP_PROP_BUFFERSIZE] == 1
+
+
+def test_latency_from_driver_timestamps():
+    cap = V4L2Capture(0, 64, 48, 30, api=FakeV4L2)
+    image = np.empty((48, 64, 3), dtype=np.uint8)
+    for _ in range(5):
+        ok, im = cap.read(image)
+        assert ok and im is image # 渡したバッファに書き込む
+    assert 4 < cap.latency() < 100
+
+
+def test_loader_on_v4l2(tmp_path):
+    src = tmp_path / 'cams.txt'
+    src.write_text('0\n1\n')
+    dataset = LoadT4Streams(str(src), backend=partial(V4L2Capture, api=FakeV4L2), size=(320, 240), preview=False)
+    try:
+        assert all(isinstance(cap, V4L2Capture) for cap in dataset.caps[:2])
+        assert all(dict(cap.cap.calls)[cv2.CAP_PROP_BUFFERSIZE] == 1 for cap in dataset.caps[:2])
+        iter(dataset)
+        time.sleep(0.1)
+        for _ in range(5):
+            bench.pull(dataset)
+        assert dataset.latency()[0] is not None
+    finally:
+        dataset.close()
@@ -0,0 +1,212 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+TISのライブラリ（tisgrabber_x64.dll）とグラバーをプロセスで1つずつだけ持つ。TISローダーの中で使う。
+1つのプロセスで複数のローダー（例えば2つのステーション）を動かしても、ライブラリの初期化と IC_CloseLibrary は全体で1回だけ。
+カメラの一覧は1回だけ問い合わせて覚えておき、グラバーはシリアル（unique name）ごとに参照数を数えて貸し出す。
+ローダーが返したグラバーは開いたまま取っておくので、restart() で開き直す時はデバイスを開く所を飛ばせる。
+2つのローダーが同じカメラを使う時は、取り込むスレッドは1本だけで、その画像を両方に配る（同じビデオフォーマットの時だけ）。
+usage :
+    mgr = tis_manager.manager()                  # tisgrabber_x64.dll（tis_lib=(ic, tis) を渡すとその組）
+    print(mgr.devices())                         # 繋がっているカメラのシリアル（覚えておいたもの）
+    a = LoadT4TISCams('station_a.txt')           # 2つのローダーが同じライブラリを使う
+    b = LoadV4TISCams('station_b.txt')
+    a.close(); b.close(close_library=True)       # 最後のローダーが閉じる時だけ IC_CloseLibrary
+    print(mgr.opened, mgr.reused, mgr.users)     # デバイスを開いた回数、開いたままのグラバーを使い回した回数、使っているローダーの数
+"""
+
+from threading import Thread, Lock, Event
+
+_managers = [] # プロセスのTISManager（ライブラリごとに1つ）
+_lock = Lock()
+
+
+def manager(tis_lib=None):
+    # ライブラリごとにプロセスで1つの TISManager を返す。tis_lib=None なら tisgrabber_x64.dll を1回だけロードする
+    # tis_lib=(ic, tis) なら tisgrabber の代わり（tis_stub.load() など）。同じ ic なら同じ TISManager
+    with _lock:
+        for mgr in _managers:
+            if (mgr.ic is tis_lib[0]) if tis_lib is not None else mgr.default:
+                return mgr
+        if tis_lib is None:
+            import ctypes
+            import tisgrabber as tis
+            ic = ctypes.cdll.LoadLibrary("./tisgrabber_x64.dll") # TISおまじない1
+            tis.declareFunctions(ic) # TISおまじない2
+            mgr = TISManager(ic, tis, default=True)
+        else:
+            mgr = TISManager(*tis_lib)
+        _managers.append(mgr)
+        return mgr
+
+
+class _Handle:
+    # グラバー1つ分。refs はそのグラバーを使っているローダーの数（0なら止めて取ってある）
+    # source はライブを始めたローダーのキャプチャ（取り込む側）、frames は他のローダーに配る SharedFrames
+    # resets は参照数が0になった時に戻すプロパティ {(プロパティ, 要素): 値}
+    # callback は IC_SetFrameReadyCallback で登録したコールバック（ctypes の関数）。ドライバが覚えているので、グラバーを開放するまで持っておく
+    def __init__(self, serial, h, vformat):
+        self.serial, self.h, self.vformat = serial, h, vformat
+        self.refs = 0
+        self.source = None
+        self.frames = None
+        self.pump = None # source のローダーが先に閉じた後、代わりに取り込むスレッド
+        self.stop = Event()
+        self.resets = {}
+        self.callback = None
+
+
+class TISManager:
+    # ライブラリ1つ分の状態。ローダーは attach() してから acquire() でグラバーを借り、release() で返し、最後に detach() する
+    # グラバーの参照数が0になったら IC_StopLive だけして開いたまま取っておき、同じシリアルを次に acquire() した時に使い回す
+    # IC_ReleaseGrabber と IC_CloseLibrary は、使っているローダーが無くなって detach(close_library=True) された時にまとめて呼ぶ
+    # ライブ中のグラバーを他のローダーが借りる時は、IC_SnapImage を2本のスレッドから呼ぶと1枚おきに取り合うので、
+    # 取り込むのは source の1本だけにして、その画像を SharedFrames で配る（受け取る側は cam_backends.SharedCapture）
+    def __init__(self, ic, tis, default=False):
+        self.ic, self.tis, self.default = ic, tis, default
+        self.lock = Lock()
+        self.initialised = False
+        self.users = 0 # attach() しているローダーの数
+        self.handles = {} # シリアル → _Handle
+        self.by_h = {} # グラバー → _Handle
+        self.serials = None # 覚えておいたカメラの一覧（問い合わせられないライブラリならNone）
+        self.opened = 0 # デバイスを開いた回数（IC_OpenDevByUniqueName）
+        self.reused = 0 # 開いたままのグラバーを使い回した回数
+        self.enumerated = 0 # カメラの一覧を問い合わせた回数
+
+    def attach(self):
+        # ローダーが使い始める時に呼ぶ。IC_InitLibrary はプロセスで1回だけ
+        with self.lock:
+            if not self.initialised:
+                self.ic.IC_InitLibrary(0) # TISおまじない3
+                self.initialised = True
+            self.users += 1
+        return self
+
+    def detach(self, close_library=False):
+        # ローダーが使い終わった時に呼ぶ（グラバーを全て release() した後）
+        # close_library=True なら、他に使っているローダーが無い時だけグラバーを開放して IC_CloseLibrary する
+        with self.lock:
+            self.users = max(0, self.users - 1)
+            if not close_library or self.users or not self.initialised:
+                return False
+            for handle in list(self.handles.values()):
+                if handle.refs == 0:
+                    self._drop(handle)
+            self.ic.IC_CloseLibrary()
+            self.initialised = False
+            self.serials = None
+            return True
+
+    def devices(self, refresh=False):
+        # 繋がっているカメラのシリアル。問い合わせは1回だけで、refresh=True の時だけ問い合わせ直す
+        # IC_GetDeviceCount の無い（数えられない）ライブラリならNone
+        if self.serials is None or refresh:
+            count = self.ic.IC_GetDeviceCount() if hasattr(self.ic, 'IC_GetDeviceCount') else -1
+            self.enumerated += 1
+            if count < 0:
+                return None
+            names = [self.ic.IC_GetUniqueNamefromList(k) for k in range(count)]
+            self.serials = [n.decode() if isinstance(n, bytes) else str(n) for n in names]
+        return self.serials
+
+    def acquire(self, serial, vformat, resets=None):
+        # シリアルのカメラのグラバーを借りる。戻り値は (グラバー, first)。開けなければ (None, False)
+        # first=True ならこのローダーだけが使うので、カメラの設定と IC_StartLive をして、キャプチャを作ること
+        # first=False なら他のローダーがライブで使っているグラバーを一緒に使う（設定と IC_StartLive はしない。cam_backends.SharedCapture で受け取る）
+        # ライブ中のグラバーのビデオフォーマットが vformat と違えば貸さない（画像の大きさや画素の形式が違うので）
+        # resets {(プロパティ, 要素): 値} は、最後のローダーが返した時に IC_SetPropertySwitch で戻す
+        with self.lock:
+            handle = self.handles.get(serial)
+            if handle is not None and handle.refs == 0 and not self.ic.IC_IsDevValid(handle.h): # 取っておいた間に外れた
+                self._drop(handle)
+                handle = None
+            if handle is not None:
+                if handle.refs and handle.vformat != vformat:
+                    print(f'WARNING: TIS {serial} is live as {handle.vformat} in another loader, cannot share it as {vformat}')
+                    return None, False
+                if handle.refs == 0 and handle.vformat != vformat:
+                    self.ic.IC_SetVideoFormat(handle.h, self.tis.T(vformat))
+                    handle.vformat = vformat
+                handle.refs += 1
+                handle.resets.update(resets or {})
+                self.reused += handle.refs == 1
+                return handle.h, handle.refs == 1
+            serials = self.devices()
+            if serials is not None and serial not in serials:
+                serials = self.devices(refresh=True) # 後から挿したカメラかもしれないので1回だけ問い合わせ直す
+                if serial not in serials: # 繋がっていないカメラはデバイスを開きに行かない
+                    return None, False
+            h = self.ic.IC_CreateGrabber()
+            self.ic.IC_OpenDevByUniqueName(h, self.tis.T(serial)) # シリアルナンバーの指定も可能
+            self.ic.IC_SetVideoFormat(h, self.tis.T(vformat))
+            self.opened += 1
+            if not self.ic.IC_IsDevValid(h):
+                self.ic.IC_ReleaseGrabber(h)
+                return None, False
+            handle = self.handles[serial] = self.by_h[h] = _Handle(serial, h, vformat)
+            handle.refs = 1
+            handle.resets.update(resets or {})
+            return h, True
+
+    def bind(self, h, cap):
+        # first=True で借りたローダーが作ったキャプチャ（取り込む側）を覚える。TISCapture が作られた時に呼ぶ
+        with self.lock:
+            handle = self.by_h.get(h)
+            if handle is not None and handle.source is None:
+                handle.source = cap
+
+    def share(self, h):
+        # first=False で借りたローダーが受け取る SharedFrames。取り込む側はこれ以降、取り込んだ画像をここにも写す
+        with self.lock:
+            handle = self.by_h[h]
+            if handle.frames is None:
+                handle.frames = handle.source.share()
+            return handle.frames
+
+    def release(self, h, cap=None):
+        # 借りたグラバーを返す。最後の1つなら止めて、resets のプロパティを戻して取っておく（デバイスは開いたまま）
+        # cap は返すローダーのキャプチャ。取り込む側のローダーが先に閉じたら、残ったローダーのために manager のスレッドが取り込みを続ける
+        with self.lock:
+            handle = self.by_h.get(h)
+            if handle is None or handle.refs == 0:
+                return
+            handle.refs -= 1
+            if handle.refs and cap is not None and cap is handle.source and not cap.pushed and handle.pump is None:
+                handle.stop.clear()
+                handle.pump = Thread(target=self._pump, args=(handle, cap), name=f'tis-{handle.serial}', daemon=True)
+                handle.pump.start()
+            elif handle.refs == 1 and handle.pump is None and handle.source is not None and not handle.source.pushed:
+                handle.source.frames = handle.frames = None # 受け取る側がいなくなったので、写すのをやめる
+            if handle.refs:
+                return
+            if handle.pump is not None: # IC_SnapImage の途中なら戻るのを待つ（_pump は lock を使わない）
+                handle.stop.set()
+                handle.pump.join(timeout=2.0)
+                handle.pump = None
+            for (prop, element), value in handle.resets.items(): # WDRなど、ローダーが変えたものを戻してから止める
+                self.ic.IC_SetPropertySwitch(h, self.tis.T(prop), self.tis.T(element), value)
+            handle.resets = {}
+            if handle.source is not None and handle.source.pushed:
+                # コールバックは登録したままグラバーに残るので、次に 'snap' で借りても呼ばれないように連続モードを切る
+                # ローダーが無くなってもコールバックの関数が消されないように、グラバーを開放するまで handle で持つ
+                handle.callback = handle.source.callback
+                self.ic.IC_SetContinuousMode(h, 1)
+            handle.source = handle.frames = None
+            self.ic.IC_StopLive(h)
+            if not self.ic.IC_IsDevValid(h): # 外れたカメラは取っておかない
+                self._drop(handle)
+
+    def _pump(self, handle, cap):
+        # 取り込む側のローダーが閉じた後、残ったローダーのために取り込みを続ける（cap.retrieve() が frames に配る）
+        image = None
+        while not handle.stop.is_set():
+            if cap.grab():
+                _, image = cap.retrieve(image)
+            else:
+                handle.stop.wait(0.01)
+
+    def _drop(self, handle):
+        # グラバーを開放して忘れる（lock の中で呼ぶ）
+        self.ic.IC_ReleaseGrabber(handle.h)
+        self.handles.pop(handle.serial, None)
+        self.by_h.pop(handle.h, None)
@@ -0,0 +1,191 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+tisgrabber_x64.dll の代わりに使うスタブ。TISカメラもWindowsも無い所で、TISローダーの取込み（snap / callback）をctypes込みで動かす
+usage :
+    dataset = LoadT4TISCams('sources.txt', tis_lib=tis_stub.load(fps=80), acquisition='callback', preview=False)
+    python bench.py --loaders T4TIS --tis stub --acquisition callback
+"""
+
+import re
+import sys
+import time
+import ctypes
+from threading import Thread, Lock
+import numpy as np
+from cam_backends import SyntheticCapture, PIXEL_FORMATS, raw_image
+
+IC_SUCCESS = 1
+# tisgrabber.py と同じコールバックの型 (hGrabber, pBuffer, framenumber, pData)
+FRAMEREADYCALLBACK = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong, ctypes.py_object)
+
+
+def T(s):
+    # tisgrabber.T と同じく文字列をバイト列にする
+    return s.encode('utf-8')
+
+
+def load(fps=None, devices=None):
+    # ローダーの tis_lib 引数に渡す (ic, tis) の組を返す
+    # fps を指定するとカメラに設定されたFPSの代わりにそれで動く。devices を指定するとその名前のカメラだけ開ける
+    return StubIC(fps, devices), sys.modules[__name__]
+
+
+class _Grabber:
+    # グラバー1つ分の状態
+    def __init__(self):
+        self.name = None
+        self.valid = False
+        self.w, self.h, self.bpp = 640, 480, 24
+        self.pixel_format = 'RGB24'
+        self.fps = 30.0
+        self.live = False
+        self.callback = None
+        self.userdata = None
+        self.continuous = False
+        self.buffers = [] # ドライバのリングバッファの代わり
+        self.patterns = []
+        self.n = 0 # 何枚目か
+        self.cur = None # 最後に書いたバッファ
+        self.t0 = None
+        self.thread = None
+        self.started = False # 1回でもStartLiveしたか
+        self.switches = {} # IC_SetPropertySwitch で設定した (プロパティ, 要素) → 値
+
+
+class StubIC:
+    # tisgrabber.declareFunctions(ic) 後の ic と同じ名前の関数を持つ。画像は SyntheticCapture と同じ絵を下から上の順に入れる
+    # RGB24の時は各フレームの先頭8バイトに書いた時刻（perf_counter_ns）を入れておく。ローダーの画像では最後の行の先頭になる
+    def __init__(self, fps=None, devices=None):
+        self.fps = fps
+        self.devices = devices
+        self.grabbers = {}
+        self.lock = Lock()
+
+    def IC_InitLibrary(self, key):
+        return IC_SUCCESS
+
+    def IC_CloseLibrary(self):
+        return IC_SUCCESS
+
+    def IC_GetDeviceCount(self):
+        # devices を指定しなかった時は、どの名前でも開けるので数えられない（-1）
+        return len(self.devices) if self.devices is not None else -1
+
+    def IC_GetUniqueNamefromList(self, index):
+        return T(self.devices[index])
+
+    def IC_CreateGrabber(self):
+        with self.lock:
+            h = len(self.grabbers) + 1
+            self.grabbers[h] = _Grabber()
+        return h
+
+    def IC_OpenDevByUniqueName(self, h, name):
+        g = self.grabbers[h]
+        g.name = name.decode() if isinstance(name, bytes) else name
+        g.valid = self.devices is None or g.name in self.devices
+        return int(g.valid)
+
+    def IC_SetVideoFormat(self, h, vformat):
+        # "RGB24 (640x480)" の形
+        g = self.grabbers[h]
+        m = re.match(r'(\w+) \((\d+)x(\d+)\)', vformat.decode() if isinstance(vformat, bytes) else vformat)
+        if m is None or m.group(1) not in PIXEL_FORMATS:
+            return 0
+        g.pixel_format, g.w, g.h = m.group(1), int(m.group(2)), int(m.group(3))
+        g.bpp = PIXEL_FORMATS[g.pixel_format] * 8
+        return IC_SUCCESS
+
+    def IC_IsDevValid(self, h):
+        return int(self.grabbers[h].valid)
+
+    def IC_SetFrameRate(self, h, fps):
+        self.grabbers[h].fps = getattr(fps, 'value', fps)
+        return IC_SUCCESS
+
+    def IC_SetPropertySwitch(self, h, prop, element, on):
+        self.grabbers[h].switches[(prop, element)] = on
+        return IC_SUCCESS
+
+    def IC_SetPropertyValue(self, h, prop, element, value):
+        return IC_SUCCESS
+
+    def IC_SetPropertyAbsoluteValue(self, h, prop, element, value):
+        return IC_SUCCESS
+
+    def IC_SetFrameReadyCallback(self, h, callback, userdata):
+        g = self.grabbers[h]
+        g.callback, g.userdata = callback, userdata
+        return IC_SUCCESS
+
+    def IC_SetContinuousMode(self, h, mode):
+        self.grabbers[h].continuous = mode == 0 # 0 で連続モード（毎フレームコールバック）
+        return IC_SUCCESS
+
+    def IC_StartLive(self, h, show):
+        g = self.grabbers[h]
+        if self.fps and not g.started: # 最初だけ load(fps) の値で動かす。その後の IC_SetFrameRate は効く
+            g.fps = self.fps
+        g.started = True
+        g.n = 0
+        size = g.w * g.h * g.bpp // 8
+        if not g.buffers or len(g.buffers[0]) != size: # FPSを変えるために止めて再開した時は作り直さない
+            g.buffers = [(ctypes.c_ubyte * size)() for _ in range(3)]
+            # 毎フレーム絵を描くと重いので、SyntheticCaptureの絵を生画像にして上下反転したものを使い回す
+            bgr = SyntheticCapture(g.name, g.w, g.h, 0).patterns
+            g.patterns = [np.ascontiguousarray(raw_image(im, g.pixel_format)[::-1]) for im in bgr]
+        g.live = True
+        g.t0 = time.perf_counter()
+        if g.callback is not None and g.continuous:
+            g.thread = Thread(target=self._run, args=(h,), name=f'stub{h}', daemon=True)
+            g.thread.start()
+        return IC_SUCCESS
+
+    def _wait_frame(self, g):
+        # 次のフレームの時刻まで待って、リングバッファの次の場所に書く
+        g.n += 1
+        wait = g.t0 + g.n / g.fps - time.perf_counter() if g.fps else 0
+        if wait > 0:
+            time.sleep(wait)
+        buf = g.buffers[g.n % len(g.buffers)]
+        src = g.patterns[g.n % len(g.patterns)]
+        ctypes.memmove(buf, src.ctypes.data, len(buf))
+        if g.pixel_format == 'RGB24':
+            ctypes.c_int64.from_buffer(buf).value = time.perf_counter_ns()
+        g.cur = buf
+        return buf
+
+    def _run(self, h):
+        # ドライバのスレッドの代わり。フレームができる度にコールバックを呼ぶ
+        g = self.grabbers[h]
+        while g.live:
+            buf = self._wait_frame(g)
+            if g.live:
+                g.callback(h, ctypes.cast(buf, ctypes.POINTER(ctypes.c_ubyte)), g.n, g.userdata)
+
+    def IC_SnapImage(self, h, timeout=-1):
+        g = self.grabbers[h]
+        if not g.live:
+            return 0
+        self._wait_frame(g)
+        return IC_SUCCESS
+
+    def IC_GetImageDescription(self, h, width, height, bits, colorformat):
+        g = self.grabbers[h]
+        width.value, height.value, bits.value = g.w, g.h, g.bpp
+        return IC_SUCCESS
+
+    def IC_GetImagePtr(self, h):
+        g = self.grabbers[h]
+        return ctypes.cast(g.cur, ctypes.POINTER(ctypes.c_ubyte)) if g.cur is not None else None
+
+    def IC_StopLive(self, h):
+        g = self.grabbers[h]
+        g.live = False
+        if g.thread is not None:
+            g.thread.join(timeout=1.0)
+        return IC_SUCCESS
+
+    def IC_ReleaseGrabber(self, h):
+        self.grabbers[h].valid = False
+        return IC_SUCCESS
@@ -0,0 +1,109 @@
+# THIS 📷 by SWCC Corporation, GPL-3.0 license
+"""
+Chrome trace / Perfetto 形式の簡易トレーサー。取込スレッドと検出ループの各区間（snap, flip, compose, letterbox, yield）を記録する。
+usage :
+    tracer = Tracer('trace.json')
+    dataset = LoadV4TISCams(source, tracer=tracer)
+    ...
+    tracer.stop() # trace.json に書き出す。chrome://tracing や ui.perfetto.dev で開く
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+class _NullSpan:
+    # 何もしない with 用オブジェクト
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NullTracer:
+    # トレースしない時に使う。何もしないので、ほぼコストはかからない
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, name, cam=-1):
+        return self._span
+
+    def add(self, name, t0, cam=-1):
+        pass
+
+    def now(self):
+        return 0
+
+    def dump(self, path=None):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class _Span:
+    def __init__(self, tracer, name, cam):
+        self.tracer, self.name, self.cam = tracer, name, cam
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.add(self.name, self.t0, self.cam)
+        return False
+
+
+class Tracer:
+    # 区間を (名前, スレッド, 開始ns, 長さns, カメラ番号) として上限付きのリングバッファに貯める。古いものから捨てる
+    enabled = True
+
+    def __init__(self, path=None, size=200000):
+        self.path = path # stop() の時に書き出すファイル名
+        self.events = deque(maxlen=size)
+        self.names = {} # スレッドID → スレッド名
+        self.pid = os.getpid()
+
+    def span(self, name, cam=-1):
+        # with tracer.span('snap', i): で区間を記録する
+        return _Span(self, name, cam) if self.enabled else NULL_TRACER._span
+
+    def add(self, name, t0, cam=-1):
+        # t0 (perf_counter_ns) から今までを1区間として記録する。t0が0なら何もしない
+        if not (self.enabled and t0):
+            return
+        t1 = time.perf_counter_ns()
+        tid = threading.get_ident()
+        if tid not in self.names:
+            self.names[tid] = threading.current_thread().name
+        self.events.append((name, tid, t0, t1 - t0, cam)) # deque.appendはスレッドセーフ
+
+    def now(self):
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def dump(self, path=None):
+        # バッファの内容を Chrome trace 形式のJSONに書き出す（記録は続ける）
+        path = path or self.path
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in list(self.names.items())]
+        for name, tid, t0, dur, cam in list(self.events):
+            e = {'name': name, 'ph': 'X', 'pid': self.pid, 'tid': tid, 'ts': t0 / 1000, 'dur': dur / 1000}
+            if cam >= 0:
+                e['args'] = {'cam': cam}
+            events.append(e)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+    def stop(self):
+        # 記録を止めて、pathが指定されていれば書き出す
+        self.enabled = False
+        if self.path:
+            self.dump()